@@ -0,0 +1,301 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from config import *
+from Metrics import metrics
+
+
+class Slot:
+    """
+    Outcome of one request made in a concurrency slot.
+    Attributes:
+        status (int): HTTP status code, if a response was received.
+        latency (float): Latency of the request in seconds, if measured by the caller.
+        failed (bool): Whether the request failed without a response.
+    """
+
+    def __init__(self):
+        self.status = None
+        self.latency = None
+        self.failed = False
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD (additive increase, multiplicative decrease) controller of the number of
+    requests in flight, globally and per host.
+    While responses are healthy, every limit grows by about one slot per round
+    trip of its current size. A timeout or connection error, 429/503 or a latency
+    spike halves the limit of the host; timeouts and connection errors cut the
+    global limit too, since 429/503 only say that one host is overloaded.
+    Limits and decisions are exported in metrics.
+    Attributes:
+        global_limit (float): Current global limit of requests in flight.
+        host_limits (dict): Current limit of every host.
+        in_flight (dict): Number of requests in flight per host.
+    """
+
+    def __init__(
+        self,
+        initial=None,
+        maximum=None,
+        host_initial=None,
+        host_maximum=None,
+        minimum=None,
+    ):
+        self.initial = initial or CONCURRENCY_INITIAL
+        self.maximum = maximum or CONCURRENCY_MAX
+        self.host_initial = host_initial or HOST_CONCURRENCY_INITIAL
+        self.host_maximum = host_maximum or HOST_CONCURRENCY_MAX
+        self.minimum = minimum or CONCURRENCY_MIN
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.global_limit = float(self.initial)
+        self.host_limits = {}
+        self.in_flight = {}
+        self.in_flight_total = 0
+        self.latency = {}
+        self.samples = {}
+        self.last_decrease = {}
+        metrics.set_gauge("concurrency_limit", self.global_limit, scope="global")
+
+    def can_start(self, host):
+        limit = self.host_limits.setdefault(host, float(self.host_initial))
+        return self.in_flight_total < int(self.global_limit) and self.in_flight.get(
+            host, 0
+        ) < int(limit)
+
+    def start(self, host):
+        self.in_flight[host] = self.in_flight.get(host, 0) + 1
+        self.in_flight_total += 1
+        metrics.set_gauge("in_flight", self.in_flight_total, scope="global")
+
+    def record(self, status=None, latency=None, failed=False):
+        """
+        Records the outcome of the request made in the current slot.
+        Called by request code running inside map_unordered; ignored elsewhere.
+        Request code that handles its own exceptions reports them with failed.
+        Args:
+            status (int): HTTP status code.
+            latency (float): Latency of the request in seconds.
+            failed (bool): Whether the request failed without a response.
+        """
+        slot = getattr(self.local, "slot", None)
+        if slot is not None:
+            slot.status = status
+            slot.latency = latency
+            slot.failed = failed
+
+    def finish(self, host, slot, elapsed, failed):
+        """
+        Frees the slot and adapts the limits to the outcome of the request.
+        Args:
+            host (str): Host of the request.
+            slot (Slot): Recorded outcome.
+            elapsed (float): Wall time of the task in seconds.
+            failed (bool): Whether the task raised an exception.
+        """
+        latency = slot.latency if slot.latency is not None else elapsed
+        with self.lock:
+            self.in_flight[host] -= 1
+            self.in_flight_total -= 1
+            metrics.set_gauge("in_flight", self.in_flight_total, scope="global")
+
+            reason = None
+            if (failed or slot.failed) and slot.status is None:
+                reason = "error"
+            elif slot.status in (429, 503):
+                reason = f"status_{slot.status}"
+            else:
+                baseline = self.latency.get(host)
+                if (
+                    baseline is not None
+                    and self.samples.get(host, 0) >= 5
+                    and latency > CONCURRENCY_LATENCY_SPIKE * baseline
+                ):
+                    reason = "latency_spike"
+                else:
+                    self.samples[host] = self.samples.get(host, 0) + 1
+                    if baseline is None:
+                        self.latency[host] = latency
+                    else:
+                        self.latency[host] = 0.8 * baseline + 0.2 * latency
+
+            if reason is None:
+                self.increase(host)
+            else:
+                self.decrease(host, reason)
+
+    def increase(self, host):
+        limit = self.host_limits[host]
+        if limit < self.host_maximum:
+            self.host_limits[host] = min(self.host_maximum, limit + 1 / limit)
+            metrics.set_gauge(
+                "concurrency_limit", self.host_limits[host], scope="host", host=host
+            )
+            metrics.inc(
+                "concurrency_decisions_total", scope="host", decision="increase"
+            )
+        if self.global_limit < self.maximum:
+            self.global_limit = min(
+                self.maximum, self.global_limit + 1 / self.global_limit
+            )
+            metrics.set_gauge("concurrency_limit", self.global_limit, scope="global")
+            metrics.inc(
+                "concurrency_decisions_total", scope="global", decision="increase"
+            )
+
+    def decrease(self, host, reason):
+        # Requests already in flight report the same congestion, so a host is
+        # cut at most once per cooldown (one round trip, at least a second).
+        now = time.monotonic()
+        cooldown = max(1.0, self.latency.get(host) or 0)
+        if now - self.last_decrease.get(host, 0) < cooldown:
+            return
+        self.last_decrease[host] = now
+
+        self.host_limits[host] = max(
+            self.minimum, self.host_limits[host] * CONCURRENCY_DECREASE
+        )
+        metrics.set_gauge(
+            "concurrency_limit", self.host_limits[host], scope="host", host=host
+        )
+        metrics.inc(
+            "concurrency_decisions_total",
+            scope="host",
+            decision="decrease",
+            reason=reason,
+        )
+        logging.info(
+            f"Concurrency for {host} was decreased to {int(self.host_limits[host])}, reason: {reason}"
+        )
+        if reason == "error":
+            self.global_limit = max(
+                self.minimum, self.global_limit * CONCURRENCY_DECREASE
+            )
+            metrics.set_gauge("concurrency_limit", self.global_limit, scope="global")
+            metrics.inc(
+                "concurrency_decisions_total",
+                scope="global",
+                decision="decrease",
+                reason=reason,
+            )
+
+    def call(self, function, item, host):
+        slot = Slot()
+        self.local.slot = slot
+        started = time.perf_counter()
+        failed = False
+        try:
+            return function(item)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self.local.slot = None
+            self.finish(host, slot, time.perf_counter() - started, failed)
+
+    def map_unordered(
+        self,
+        function,
+        items,
+        host_of,
+        stage,
+        window=1000,
+        host_window=None,
+        executor=None,
+    ):
+        """
+        Calls function for every item, keeping the number of calls in flight within
+        the global and per-host limits. Items are read from the iterable lazily and
+        queued per host. At most host_window queued items of a host count towards
+        the window, so a slow host whose items fill its queue doesn't stop reading:
+        the input is read on until the window holds enough work of other hosts,
+        or up to 10 times the window in all. Hosts are served round-robin, one
+        call per host in turn, starting each pass after the host served last, so
+        a slow host doesn't hold slots that other hosts could use.
+        Args:
+            function (callable): Function of one item that makes a request.
+            items (iterable): Items to process.
+            host_of (callable): Returns the host of an item.
+            stage (str): Name of the stage for the queue depth metric.
+            window (int): Number of queued items, at most host_window per host,
+                after which reading stops.
+            host_window (int): Queued items of one host that count towards the
+                window, twice the maximum per-host limit by default.
+            executor (ThreadPoolExecutor): Long-lived pool to make the calls in,
+                e.g. of the service. A pool of the maximum global limit is
+                created for the call by default.
+        Return:
+            generator of tuple: (item, future) as calls complete.
+        """
+        host_window = host_window or 2 * self.host_maximum
+        items = iter(items)
+        queues = {}
+        # Hosts with queued items, in the order they are served.
+        order = deque()
+        queued = ready = 0
+        exhausted = False
+        running = {}
+
+        owned = executor is None
+        if owned:
+            executor = ThreadPoolExecutor(max_workers=self.maximum)
+        try:
+            while True:
+                while not exhausted and ready < window and queued < 10 * window:
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    host = host_of(item)
+                    queue = queues.get(host)
+                    if queue is None:
+                        queue = queues[host] = deque()
+                        order.append(host)
+                    if len(queue) < host_window:
+                        ready += 1
+                    queue.append(item)
+                    queued += 1
+
+                with self.lock:
+                    blocked = 0
+                    while order and blocked < len(order):
+                        if self.in_flight_total >= int(self.global_limit):
+                            break
+                        host = order[0]
+                        order.rotate(-1)
+                        if not self.can_start(host):
+                            blocked += 1
+                            continue
+                        blocked = 0
+                        queue = queues[host]
+                        if len(queue) <= host_window:
+                            ready -= 1
+                        item = queue.popleft()
+                        queued -= 1
+                        self.start(host)
+                        future = executor.submit(self.call, function, item, host)
+                        running[future] = item
+                        if not queue:
+                            # The served host was rotated to the end.
+                            order.pop()
+                            del queues[host]
+                metrics.set_gauge("queue_depth", queued + len(running), stage=stage)
+
+                if not running:
+                    if exhausted and not queues:
+                        return
+                    # Slots are held by another user of the controller.
+                    time.sleep(0.05)
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield running.pop(future), future
+        finally:
+            if owned:
+                executor.shutdown()
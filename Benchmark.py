@@ -0,0 +1,894 @@
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+WORDS = [
+    "security",
+    "network",
+    "scanner",
+    "report",
+    "manual",
+    "install",
+    "configure",
+    "sensor",
+    "module",
+    "detection",
+    "traffic",
+    "packet",
+    "server",
+    "policy",
+    "access",
+    "audit",
+    "kernel",
+    "agent",
+    "update",
+    "incident",
+]
+
+
+class SyntheticCorpus:
+    """
+    Generates synthetic HTML pages and PDF documents of configurable size.
+    Attributes:
+        page_size (int): Approximate size of one HTML page in bytes.
+        document_pages (int): Number of pages in one PDF document.
+        words_per_page (int): Number of words on one PDF page.
+        seed (int): Seed for the pseudo-random text generator.
+    """
+
+    def __init__(self, page_size=20000, document_pages=5, words_per_page=300, seed=0):
+        self.page_size = page_size
+        self.document_pages = document_pages
+        self.words_per_page = words_per_page
+        self.seed = seed
+
+    def text(self, index, count):
+        """
+        Builds deterministic pseudo-random text.
+        Args:
+            index (int): Number of the document, used to vary the text.
+            count (int): Number of words.
+        Return:
+            str: Generated text.
+        """
+        rnd = random.Random(self.seed * 1000003 + index)
+        return " ".join(rnd.choice(WORDS) for _ in range(count))
+
+    def html(self, index):
+        """
+        Builds an HTML page with scripts, styles and paragraphs of text.
+        Args:
+            index (int): Number of the page.
+        Return:
+            bytes: HTML page encoded in UTF-8.
+        """
+        head = (
+            '<!DOCTYPE html>\n<html lang="en">\n<head>\n'
+            f"<title>Page {index}</title>\n"
+            "<style>body { font-family: sans-serif; }</style>\n"
+            "<script>var counter = 0; function tick() { counter++; }</script>\n"
+            "</head>\n<body>\n"
+        )
+        tail = "</body>\n</html>\n"
+        parts = [head]
+        size = len(head) + len(tail)
+        paragraph = 0
+        while size < self.page_size:
+            line = f"<p>{self.text(index * 7919 + paragraph, 60)}</p>\n"
+            parts.append(line)
+            size += len(line)
+            paragraph += 1
+        parts.append(tail)
+        return "".join(parts).encode("utf-8")
+
+    def pdf(self, index):
+        """
+        Builds a minimal valid PDF document with a text layer on every page.
+        Args:
+            index (int): Number of the document.
+        Return:
+            bytes: PDF document.
+        """
+        objects = [
+            b"<< /Type /Catalog /Pages 2 0 R >>",
+            None,
+            b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+        ]
+        kids = []
+        for page in range(self.document_pages):
+            words = self.text(index * 104729 + page, self.words_per_page).split()
+            lines = [" ".join(words[i : i + 12]) for i in range(0, len(words), 12)]
+            stream = "BT /F1 10 Tf 40 800 Td 12 TL\n"
+            stream += "".join(f"({line}) '\n" for line in lines)
+            stream += "ET"
+            stream = stream.encode("latin-1")
+            content_number = len(objects) + 2
+            objects.append(
+                b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                b"/Resources << /Font << /F1 3 0 R >> >> "
+                + f"/Contents {content_number} 0 R >>".encode()
+            )
+            kids.append(f"{len(objects)} 0 R")
+            objects.append(
+                f"<< /Length {len(stream)} >>\nstream\n".encode()
+                + stream
+                + b"\nendstream"
+            )
+        objects[1] = (
+            f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(kids)} >>"
+        ).encode()
+
+        output = bytearray(b"%PDF-1.4\n")
+        offsets = []
+        for number, body in enumerate(objects, start=1):
+            offsets.append(len(output))
+            output += f"{number} 0 obj\n".encode() + body + b"\nendobj\n"
+        xref = len(output)
+        output += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+        for offset in offsets:
+            output += f"{offset:010d} 00000 n \n".encode()
+        output += (
+            f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\n"
+            f"startxref\n{xref}\n%%EOF\n"
+        ).encode()
+        return bytes(output)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Request handler of the local stand-in server.
+    Routes:
+        /robots.txt                 robots rules, everything under /private/ is disallowed
+        /pages/<n>.html             HTML page
+        /documents/<n>.pdf          PDF document
+        /redirect/<path>            302 redirect to /<path>
+        /missing/<path>             404 Not Found
+        /unavailable/<path>         503 Service Unavailable
+        /nohead/<path>              405 on HEAD, normal response on GET
+        /private/<path>             normal response, disallowed by robots.txt
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.respond(send_body=False)
+
+    def do_GET(self):
+        self.respond(send_body=True)
+
+    def send(self, status, content_type, body, send_body, extra_headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (extra_headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def respond(self, send_body):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency * (0.5 + server.random.random()))
+
+        path = urlparse(self.path).path
+        if path == "/robots.txt":
+            body = b"User-agent: *\nDisallow: /private/\n"
+            self.send(200, "text/plain", body, send_body)
+            return
+
+        prefix, _, rest = path.lstrip("/").partition("/")
+        if prefix == "redirect":
+            self.send(302, "text/plain", b"", send_body, {"Location": "/" + rest})
+            return
+        if prefix == "missing":
+            self.send(404, "text/plain", b"Not Found", send_body)
+            return
+        if prefix == "unavailable":
+            self.send(
+                503, "text/plain", b"Unavailable", send_body, {"Retry-After": "1"}
+            )
+            return
+        if prefix == "nohead":
+            if not send_body:
+                self.send(405, "text/plain", b"", send_body, {"Allow": "GET"})
+                return
+            path = "/" + rest
+        elif prefix == "private":
+            path = "/" + rest
+
+        body = server.resources.get(path)
+        if body is None:
+            self.send(404, "text/plain", b"Not Found", send_body)
+        elif path.endswith(".pdf"):
+            self.send(200, "application/pdf", body, send_body)
+        else:
+            self.send(200, "text/html; charset=utf-8", body, send_body)
+
+
+class StandInServer(ThreadingHTTPServer):
+    """
+    Local HTTP server that serves a synthetic corpus instead of the real sites.
+    Attributes:
+        resources (dict): Mapping of URL path to response body.
+        latency (float): Mean simulated latency of every response in seconds.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, resources, latency=0.0, seed=0):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.resources = resources
+        self.latency = latency
+        self.random = random.Random(seed)
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class Benchmark:
+    """
+    Benchmark harness that runs the pipeline against a local stand-in server.
+    The whole pipeline (Main.main) and the stages in isolation are measured in
+    separate child processes, each in its own working directory, so the fixed
+    output paths and the peak RSS of one run don't leak into another. The
+    stages run one after another in one child, which resets its peak RSS
+    before every stage.
+    Attributes:
+        args (Namespace): Parsed command line arguments.
+    """
+
+    STAGES = [
+        "registry_init",
+        "cleaner",
+        "html_or_pdf",
+        "download_files_request",
+        "download_html_request",
+        "processing_pdf",
+        "processing_html",
+        "registry_build",
+    ]
+
+    # Module, class, method and position of the argument that identifies the
+    # URL: the URL itself or the path of the raw file downloaded from it.
+    TIMED_METHODS = [
+        ("URLProcessing", "URLProcessing", "check_html_or_pdf", 1),
+        ("DownloadContent", "DownloadContent", "download_one_file", 3),
+        ("DownloadContent", "DownloadContent", "download_one_html", 3),
+        (
+            "ProcessingDownloadContent",
+            "ProcessingDownloadContent",
+            "processing_one_pdf",
+            1,
+        ),
+        (
+            "ProcessingDownloadContent",
+            "ProcessingDownloadContent",
+            "processing_one_html",
+            1,
+        ),
+    ]
+
+    def __init__(self, args):
+        self.args = args
+
+    def build_corpus(self):
+        """
+        Generates the corpus served by the stand-in server and the input URL list.
+        Return:
+            tuple: Mapping of URL path to body and list of URL paths for the input file.
+        """
+        args = self.args
+        corpus = SyntheticCorpus(
+            args.page_size, args.document_pages, args.words_per_page, args.seed
+        )
+        resources, paths = {}, []
+        for i in range(args.pages):
+            resources[f"/pages/{i}.html"] = corpus.html(i)
+            paths.append(f"/pages/{i}.html")
+        for i in range(args.documents):
+            resources[f"/documents/{i}.pdf"] = corpus.pdf(i)
+            paths.append(f"/documents/{i}.pdf")
+
+        special = [
+            ("redirect", args.redirects),
+            ("missing", args.missing),
+            ("unavailable", args.unavailable),
+            ("nohead", args.no_head),
+            ("private", args.disallowed),
+        ]
+        for prefix, count in special:
+            for i in range(count):
+                paths.append(f"/{prefix}/pages/{i % max(args.pages, 1)}.html")
+
+        rnd = random.Random(args.seed)
+        rnd.shuffle(paths)
+        return resources, paths
+
+    def write_input(self, base_url, paths, filename):
+        """
+        Writes the input URL list, with tracking parameters, duplicates and junk lines
+        so the cleaner has real work to do.
+        Args:
+            base_url (str): Base URL of the stand-in server.
+            paths (list): URL paths to include.
+            filename (str): Path of the input file.
+        """
+        rnd = random.Random(self.args.seed + 1)
+        with open(filename, "w") as file:
+            for path in paths:
+                url = base_url + path
+                if rnd.random() < 0.2:
+                    url += "?utm_source=bench&utm_medium=email"
+                file.write(url + "\n")
+                if rnd.random() < 0.05:
+                    file.write(url + "\n")
+            file.write("not a url\n")
+
+    def run(self):
+        """
+        Starts the stand-in server, runs the selected modes and returns the report.
+        Return:
+            dict: Machine-readable benchmark report.
+        """
+        args = self.args
+        resources, paths = self.build_corpus()
+        server = StandInServer(resources, args.latency, args.seed)
+        server.start()
+        root = tempfile.mkdtemp(prefix="webdataparser-bench-")
+        report = {
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "commit": self.commit(),
+            "config": {
+                key: value for key, value in vars(args).items() if key != "output"
+            },
+            "corpus": {
+                "urls": len(paths),
+                "bytes": sum(len(body) for body in resources.values()),
+            },
+            "runs": {},
+        }
+        try:
+            if args.mode in ("all", "imports"):
+                report["imports"] = self.measure_imports(root)
+            modes = ["e2e", "stages"] if args.mode == "all" else [args.mode]
+            for mode in modes:
+                if mode == "imports":
+                    continue
+                workdir = os.path.join(root, mode)
+                os.makedirs(workdir)
+                input_file = os.path.join(workdir, "input.csv")
+                self.write_input(server.base_url, paths, input_file)
+                report["runs"][mode] = self.run_child(mode, workdir, input_file)
+        finally:
+            server.stop()
+            if not args.keep:
+                shutil.rmtree(root, ignore_errors=True)
+        return report
+
+    IMPORT_MODULES = [
+        "Main",
+        "Cli",
+        "URLProcessing",
+        "DownloadContent",
+        "ProcessingDownloadContent",
+        "FormingResultsRegistry",
+    ]
+
+    BUDGETED_MODULES = ["Main", "Cli"]
+
+    def measure_imports(self, root):
+        """
+        Measures the import time and RSS of the entry points and stage modules,
+        each in a fresh interpreter, and checks the entry points against the
+        IMPORT_TIME_BUDGET from config.py.
+        Args:
+            root (str): Folder for the working directory of the measurements.
+        Return:
+            dict: Import time and RSS per module and whether the budget is met.
+        """
+        workdir = os.path.join(root, "imports")
+        os.makedirs(workdir)
+        package = os.path.dirname(os.path.abspath(__file__))
+        script = (
+            "import json, sys, time\n"
+            f"sys.path.insert(0, {package!r})\n"
+            "started = time.perf_counter()\n"
+            "__import__(sys.argv[1])\n"
+            "seconds = time.perf_counter() - started\n"
+            "rss = None\n"
+            "for line in open('/proc/self/status'):\n"
+            "    if line.startswith('VmHWM:'):\n"
+            "        rss = int(line.split()[1]) * 1024\n"
+            "from config import IMPORT_TIME_BUDGET\n"
+            "print(json.dumps({'seconds': seconds, 'peak_rss_bytes': rss,"
+            " 'budget_seconds': IMPORT_TIME_BUDGET}))\n"
+        )
+        modules = {}
+        for module in self.IMPORT_MODULES:
+            samples = []
+            for _ in range(self.args.import_repeat):
+                result = subprocess.run(
+                    [sys.executable, "-c", script, module],
+                    cwd=workdir,
+                    capture_output=True,
+                    text=True,
+                    check=True,
+                )
+                samples.append(json.loads(result.stdout))
+            modules[module] = min(samples, key=lambda sample: sample["seconds"])
+
+        budget = modules[self.BUDGETED_MODULES[0]].pop("budget_seconds")
+        for module in modules.values():
+            module.pop("budget_seconds", None)
+        return {
+            "budget_seconds": budget,
+            "within_budget": all(
+                modules[module]["seconds"] <= budget for module in self.BUDGETED_MODULES
+            ),
+            "modules": modules,
+        }
+
+    def run_child(self, mode, workdir, input_file):
+        """
+        Runs one benchmark mode in a child process.
+        Args:
+            mode (str): 'e2e' or 'stages'.
+            workdir (str): Working directory of the child process.
+            input_file (str): Path of the input URL list.
+        Return:
+            dict: Results reported by the child.
+        """
+        env = dict(os.environ)
+        for name in ("no_proxy", "NO_PROXY"):
+            env[name] = ",".join(
+                filter(None, [env.get(name), "127.0.0.1", "localhost"])
+            )
+        subprocess.run(
+            [
+                sys.executable,
+                os.path.abspath(__file__),
+                "--child",
+                mode,
+                "--input",
+                input_file,
+            ],
+            cwd=workdir,
+            env=env,
+            check=True,
+        )
+        with open(os.path.join(workdir, "benchmark_result.json")) as file:
+            return json.load(file)
+
+    def commit(self):
+        try:
+            result = subprocess.run(
+                ["git", "rev-parse", "--short", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                capture_output=True,
+                text=True,
+            )
+            return result.stdout.strip() or None
+        except OSError:
+            return None
+
+
+def percentile(samples, fraction):
+    """
+    Nearest-rank percentile.
+    Args:
+        samples (list): Measured values.
+        fraction (float): Percentile as a fraction, e.g. 0.99.
+    Return:
+        float: Percentile value or None for an empty sample list.
+    """
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered))) - 1))
+    return ordered[rank]
+
+
+def peak_rss_bytes():
+    """
+    Peak RSS of the current process. VmHWM is preferred on Linux: ru_maxrss of a
+    child survives exec and can report the peak of the benchmark parent instead.
+    Return:
+        int: Peak resident set size in bytes.
+    """
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def reset_peak_rss():
+    """
+    Resets the peak RSS of the current process to its current RSS, so the next
+    peak_rss_bytes covers only what runs after the reset.
+    Return:
+        bool: Whether the peak was reset; /proc/self/clear_refs needs Linux 4.0+.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def folder_bytes(folder):
+    total = 0
+    if os.path.isdir(folder):
+        for file_name in os.listdir(folder):
+            file_path = os.path.join(folder, file_name)
+            if os.path.isfile(file_path):
+                total += os.path.getsize(file_path)
+    return total
+
+
+def raw_bytes(folder):
+    """
+    Size of the raw downloads of a folder, saved as files or packed into an archive.
+    """
+    from PackedArchive import PackedArchive
+
+    return folder_bytes(folder) + folder_bytes(PackedArchive.folder_for(folder))
+
+
+def stage_result(elapsed, urls, size, samples, rss_reset=False):
+    """
+    Results of a run or a stage.
+    Args:
+        elapsed (float): Wall-clock time in seconds.
+        urls (int): Number of URLs.
+        size (int): Number of bytes.
+        samples (list): Latencies in seconds.
+        rss_reset (bool): Whether the peak RSS was reset before the stage;
+            otherwise it's the peak of the whole child process so far.
+    Return:
+        dict: Results.
+    """
+    return {
+        "seconds": round(elapsed, 6),
+        "urls": urls,
+        "bytes": size,
+        "urls_per_second": round(urls / elapsed, 3) if elapsed else None,
+        "bytes_per_second": round(size / elapsed, 3) if elapsed else None,
+        "latency_p50_seconds": percentile(samples, 0.50),
+        "latency_p99_seconds": percentile(samples, 0.99),
+        "peak_rss_bytes": peak_rss_bytes(),
+        "peak_rss_scope": "stage" if rss_reset else "process",
+    }
+
+
+def install_timers(samples, keyed=None):
+    """
+    Wraps the per-URL methods of the pipeline classes to record their latency.
+    Args:
+        samples (dict): Mapping of method name to the list that collects latencies.
+        keyed (dict): Mapping of method name to the dict that collects the
+            time.perf_counter() at which the method finished with every URL or
+            raw file path, if given.
+    """
+    import importlib
+
+    lock = threading.Lock()
+    for module_name, class_name, method_name, key_index in Benchmark.TIMED_METHODS:
+        cls = getattr(importlib.import_module(module_name), class_name)
+        method = getattr(cls, method_name)
+        collected = samples.setdefault(method_name, [])
+        by_key = keyed.setdefault(method_name, {}) if keyed is not None else None
+
+        def timed(
+            *args,
+            _method=method,
+            _collected=collected,
+            _by_key=by_key,
+            _key_index=key_index,
+            **kwargs,
+        ):
+            started = time.perf_counter()
+            try:
+                return _method(*args, **kwargs)
+            finally:
+                finished = time.perf_counter()
+                with lock:
+                    _collected.append(finished - started)
+                    if _by_key is not None and len(args) > _key_index:
+                        key = args[_key_index]
+                        _by_key[key] = max(_by_key.get(key, finished), finished)
+
+        setattr(cls, method_name, timed)
+
+
+def url_latencies(keyed, started):
+    """
+    End-to-end wall-clock latency of every checked URL: all URLs of the input
+    are submitted when the run starts, so the latency of a URL is the time from
+    the start of the run until the last stage that handled it (the check, the
+    download or the processing of its raw file) finished with it. Time spent
+    waiting in the queues of the stages is included.
+    Args:
+        keyed (dict): Finish time per URL or raw file path of every timed method.
+        started (float): time.perf_counter() at the start of the run.
+    Return:
+        list: Latency of every URL in seconds.
+    """
+    from FormingResultsRegistry import FormingResultsRegistry
+
+    finished = dict(keyed.get("check_html_or_pdf", {}))
+    for method_name in ("download_one_file", "download_one_html"):
+        for url, seconds in keyed.get(method_name, {}).items():
+            finished[url] = max(finished.get(url, seconds), seconds)
+
+    downloaded_urls = FormingResultsRegistry().get_downloaded_urls()
+    for method_name in ("processing_one_pdf", "processing_one_html"):
+        for file_path, seconds in keyed.get(method_name, {}).items():
+            url = downloaded_urls.get(file_path)
+            if url is not None:
+                finished[url] = max(finished.get(url, seconds), seconds)
+    return [seconds - started for seconds in finished.values()]
+
+
+def run_e2e(input_file):
+    """
+    Runs Main.main end to end in the current working directory.
+    Args:
+        input_file (str): Path of the input URL list.
+    Return:
+        dict: Results of the run.
+    """
+    import Main
+    from Reader import Reader
+
+    samples, keyed = {}, {}
+    install_timers(samples, keyed)
+    urls = Reader().read_file(input_file)
+
+    sys.argv = ["Main.py", input_file]
+    started = time.perf_counter()
+    Main.main()
+    elapsed = time.perf_counter() - started
+
+    size = raw_bytes("raw_downloads/documents/") + raw_bytes("raw_downloads/pages/")
+    result = stage_result(elapsed, len(urls), size, url_latencies(keyed, started))
+    result["latency"] = {
+        name: {
+            "count": len(values),
+            "p50_seconds": percentile(values, 0.50),
+            "p99_seconds": percentile(values, 0.99),
+        }
+        for name, values in samples.items()
+    }
+    return result
+
+
+def run_stages(input_file):
+    """
+    Runs every pipeline stage in isolation in the current working directory.
+    Args:
+        input_file (str): Path of the input URL list.
+    Return:
+        dict: Results of every stage.
+    """
+    from Reader import Reader
+    from URLProcessing import URLProcessing
+    from DownloadContent import DownloadContent
+    from ProcessingDownloadContent import ProcessingDownloadContent
+    from FormingResultsRegistry import FormingResultsRegistry
+
+    from config import setup_logging
+
+    setup_logging()
+    samples = {}
+    install_timers(samples)
+    results = {}
+    urls = Reader().read_file(input_file)
+    registry = FormingResultsRegistry()
+
+    reset = reset_peak_rss()
+    started = time.perf_counter()
+    registry.create_results_registry_csv()
+    registry.add_source_url(urls)
+    results["registry_init"] = stage_result(
+        time.perf_counter() - started,
+        len(urls),
+        os.path.getsize(registry.store.path),
+        [],
+        rss_reset=reset,
+    )
+
+    urlProcessing = URLProcessing()
+    reset = reset_peak_rss()
+    started = time.perf_counter()
+    new_urls = urlProcessing.cleaner(urls)
+    results["cleaner"] = stage_result(
+        time.perf_counter() - started,
+        len(urls),
+        sum(len(url) for url in urls),
+        [],
+        rss_reset=reset,
+    )
+
+    reset = reset_peak_rss()
+    started = time.perf_counter()
+    urls_html, urls_pdf = urlProcessing.html_or_pdf(new_urls)
+    results["html_or_pdf"] = stage_result(
+        time.perf_counter() - started,
+        len(new_urls),
+        0,
+        samples["check_html_or_pdf"],
+        rss_reset=reset,
+    )
+    # The registry is updated from analytics.log right after the stage it
+    # describes, in the same order as Main.main, so later log lines don't match.
+    reset = reset_peak_rss()
+    started = time.perf_counter()
+    registry.add_processing_info_from_check()
+    registry_seconds = time.perf_counter() - started
+    registry_rss = peak_rss_bytes()
+
+    downloadContent = DownloadContent(urls_html, urls_pdf)
+    reset = reset_peak_rss()
+    started = time.perf_counter()
+    downloadContent.download_files_request()
+    results["download_files_request"] = stage_result(
+        time.perf_counter() - started,
+        len(urls_pdf),
+        raw_bytes("raw_downloads/documents/"),
+        samples["download_one_file"],
+        rss_reset=reset,
+    )
+
+    reset = reset_peak_rss()
+    started = time.perf_counter()
+    downloadContent.download_html_request()
+    results["download_html_request"] = stage_result(
+        time.perf_counter() - started,
+        len(urls_html),
+        raw_bytes("raw_downloads/pages/"),
+        samples["download_one_html"],
+        rss_reset=reset,
+    )
+    reset = reset_peak_rss()
+    started = time.perf_counter()
+    registry.add_download_info()
+    registry_seconds += time.perf_counter() - started
+    registry_rss = max(registry_rss, peak_rss_bytes())
+
+    processingDownloadContent = ProcessingDownloadContent()
+    reset = reset_peak_rss()
+    started = time.perf_counter()
+    processingDownloadContent.processing_pdf()
+    results["processing_pdf"] = stage_result(
+        time.perf_counter() - started,
+        len(samples["processing_one_pdf"]),
+        raw_bytes("raw_downloads/documents/"),
+        samples["processing_one_pdf"],
+        rss_reset=reset,
+    )
+
+    reset = reset_peak_rss()
+    started = time.perf_counter()
+    processingDownloadContent.processing_html()
+    results["processing_html"] = stage_result(
+        time.perf_counter() - started,
+        len(samples["processing_one_html"]),
+        raw_bytes("raw_downloads/pages/"),
+        samples["processing_one_html"],
+        rss_reset=reset,
+    )
+
+    reset = reset_peak_rss()
+    started = time.perf_counter()
+    registry.add_processed_info()
+    registry.add_other()
+    registry.registry_sort()
+    registry_seconds += time.perf_counter() - started
+    results["registry_build"] = stage_result(
+        registry_seconds,
+        len(urls),
+        os.path.getsize("results_registry.csv"),
+        [],
+        rss_reset=reset,
+    )
+    # The registry is built in three steps between the other stages.
+    results["registry_build"]["peak_rss_bytes"] = max(
+        registry_rss, results["registry_build"]["peak_rss_bytes"]
+    )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the pipeline against a local stand-in HTTP server."
+    )
+    parser.add_argument(
+        "--mode", choices=["all", "e2e", "stages", "imports"], default="all"
+    )
+    parser.add_argument(
+        "--import-repeat",
+        type=int,
+        default=3,
+        help="fresh interpreters per module for import timing, the fastest one counts",
+    )
+    parser.add_argument(
+        "--check-import-budget",
+        action="store_true",
+        help="exit with status 1 if an entry point exceeds IMPORT_TIME_BUDGET",
+    )
+    parser.add_argument("--pages", type=int, default=40)
+    parser.add_argument("--documents", type=int, default=20)
+    parser.add_argument("--page-size", type=int, default=20000)
+    parser.add_argument("--document-pages", type=int, default=5)
+    parser.add_argument("--words-per-page", type=int, default=300)
+    parser.add_argument("--redirects", type=int, default=3)
+    parser.add_argument("--missing", type=int, default=3)
+    parser.add_argument("--unavailable", type=int, default=3)
+    parser.add_argument("--no-head", type=int, default=3)
+    parser.add_argument("--disallowed", type=int, default=3)
+    parser.add_argument(
+        "--latency", type=float, default=0.02, help="mean response latency, seconds"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument(
+        "--keep", action="store_true", help="keep the working directories"
+    )
+    parser.add_argument("--child", choices=["e2e", "stages"], help=argparse.SUPPRESS)
+    parser.add_argument("--input", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        if args.child == "e2e":
+            result = run_e2e(args.input)
+        else:
+            result = run_stages(args.input)
+        with open("benchmark_result.json", "w") as file:
+            json.dump(result, file)
+        return
+
+    report = Benchmark(args).run()
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(text + "\n")
+    else:
+        print(text)
+    if args.check_import_budget and not report.get("imports", {}).get(
+        "within_budget", True
+    ):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import json
+import os
+import threading
+import time
+
+from config import *
+
+
+class Checkpoint:
+    """
+    Durable per-URL progress of a run, used to resume it after a crash or kill.
+    Progress is appended to a JSON Lines file as records with a state:
+    'classified' (url, url_type), 'downloaded' (url, path, sha256, size) and
+    'processed' (url, path). Records are buffered and written in batches, so
+    after a crash at most the last batch is redone.
+    Attributes:
+        path (str): Path of the checkpoint file.
+        batch_size (int): Number of records buffered before they are written.
+        interval (float): Maximum age of buffered records in seconds.
+        resumed (bool): Whether progress of a previous run was loaded.
+        classified (dict): URL -> detected type ('html', 'pdf' or '').
+        downloaded (dict): URL -> downloaded record.
+        paths (dict): Raw file path -> URL.
+        processed (set): Raw file paths that were processed.
+    """
+
+    def __init__(self, path=None, batch_size=None, interval=None):
+        self.path = path or CHECKPOINT_FILE
+        self.batch_size = batch_size or CHECKPOINT_BATCH_SIZE
+        self.interval = interval or CHECKPOINT_FLUSH_INTERVAL
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        self.resumed = False
+        self.classified = {}
+        self.downloaded = {}
+        self.paths = {}
+        self.processed = set()
+
+    def reset(self):
+        """
+        Starts a new run: removes the progress of the previous run.
+        """
+        with self.lock:
+            self.buffer = []
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def load(self, resume=True):
+        """
+        Loads the progress of a previous run. A truncated last line, left by a
+        crash in the middle of a write, is ignored.
+        Args:
+            resume (bool): Whether work recorded in the checkpoint is skipped.
+                Otherwise the progress of the earlier steps of the run is only
+                read, e.g. to find the URLs of raw files.
+        """
+        self.resumed = resume
+        if not os.path.exists(self.path):
+            logging.info(f"Checkpoint {self.path} not found, nothing to resume")
+            return
+
+        with open(self.path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                self.apply(record)
+        logging.info(
+            f"Checkpoint {self.path} was loaded: {len(self.classified)} classified, "
+            f"{len(self.downloaded)} downloaded, {len(self.processed)} processed"
+        )
+
+    def apply(self, record):
+        state = record.get("state")
+        if state == "classified":
+            self.classified[record["url"]] = record["url_type"]
+        elif state == "downloaded":
+            self.downloaded[record["url"]] = record
+            self.paths[record["path"]] = record["url"]
+        elif state == "processed":
+            self.processed.add(record["path"])
+
+    def record(self, state, **fields):
+        """
+        Adds a progress record. It is written to disk with the next batch.
+        Args:
+            state (str): 'classified', 'downloaded' or 'processed'.
+            **fields: Fields of the record.
+        """
+        fields["state"] = state
+        with self.lock:
+            self.apply(fields)
+            self.buffer.append(json.dumps(fields, ensure_ascii=False) + "\n")
+            due = (
+                len(self.buffer) >= self.batch_size
+                or time.monotonic() - self.last_flush >= self.interval
+            )
+        if due:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes buffered records to the checkpoint file and syncs it to disk.
+        """
+        with self.write_lock:
+            with self.lock:
+                lines, self.buffer = self.buffer, []
+                self.last_flush = time.monotonic()
+            if not lines:
+                return
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.writelines(lines)
+                file.flush()
+                os.fsync(file.fileno())
+
+    def is_downloaded(self, url):
+        """
+        Checks whether the URL was downloaded and its file is still on disk.
+        Args:
+            url (str): URL to check.
+        Return:
+            bool: True if the download can be skipped.
+        """
+        record = self.downloaded.get(url)
+        # Records of a packed archive are addressed as 'container#offset'.
+        return record is not None and os.path.exists(record["path"].split("#", 1)[0])
+
+    def url_of(self, path):
+        """
+        Returns the URL a raw file was downloaded from.
+        Args:
+            path (str): Path of the raw file.
+        Return:
+            str: URL or None if unknown.
+        """
+        return self.paths.get(path)
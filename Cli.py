@@ -0,0 +1,327 @@
+import argparse
+import sys
+
+URLS_HTML_FILE = "urls_html.txt"
+URLS_PDF_FILE = "urls_pdf.txt"
+# Subcommands that run a pipeline step and write its metrics.
+PIPELINE_COMMANDS = ("classify", "download", "process", "registry", "index")
+
+
+def write_urls(filename, urls):
+    with open(filename, "w") as file:
+        for url in urls:
+            file.write(url + "\n")
+
+
+def read_urls(filename):
+    try:
+        with open(filename, "r") as file:
+            return [line.strip() for line in file if line.strip() != ""]
+    except FileNotFoundError:
+        raise ValueError(f"{filename} not found, run classify first")
+
+
+def open_checkpoint(resume):
+    from Checkpoint import Checkpoint
+
+    checkpoint = Checkpoint()
+    if resume:
+        checkpoint.load()
+    return checkpoint
+
+
+def classify(args):
+    """
+    Cleans the input file, detects content types and starts a new registry.
+    Writes the classified URLs to urls_html.txt and urls_pdf.txt for the download step.
+    """
+    from Reader import Reader
+    from URLProcessing import URLProcessing
+    from FormingResultsRegistry import FormingResultsRegistry
+    from Metrics import metrics
+
+    checkpoint = open_checkpoint(args.resume)
+    if not args.resume:
+        checkpoint.reset()
+
+    options = Reader.options(args.column, args.header, args.delimiter)
+    records = Reader().iter_records(args.filename, **options)
+    registry = FormingResultsRegistry()
+    registry.create_results_registry_csv()
+    urlProcessing = URLProcessing(checkpoint=checkpoint)
+    cleaned = urlProcessing.iter_cleaner(records)
+    selected = None
+    if args.recrawl_budget is not None:
+        from RecrawlScheduler import RecrawlScheduler
+
+        scheduler = RecrawlScheduler().load()
+        selected = scheduler.select(
+            (
+                url
+                for _, _, url, status in urlProcessing.iter_cleaner(
+                    Reader().iter_records(args.filename, **options)
+                )
+                if status == "clean_url"
+            ),
+            args.recrawl_budget,
+        )
+        cleaned = scheduler.schedule(cleaned, selected)
+    try:
+        with metrics.stage("html_or_pdf"):
+            new_urls = registry.add_cleaned_records(cleaned)
+            urls_html, urls_pdf = urlProcessing.html_or_pdf(new_urls)
+            registry.add_processing_info_from_check()
+    finally:
+        checkpoint.flush()
+    if selected is not None:
+        urls_html = scheduler.order(urls_html, selected)
+        urls_pdf = scheduler.order(urls_pdf, selected)
+    write_urls(URLS_HTML_FILE, urls_html)
+    write_urls(URLS_PDF_FILE, urls_pdf)
+
+
+def download(args):
+    """
+    Downloads the classified URLs and adds download information to the registry.
+    """
+    from DownloadContent import DownloadContent
+    from FormingResultsRegistry import FormingResultsRegistry
+    from RecrawlScheduler import RecrawlScheduler
+    from Metrics import metrics
+
+    checkpoint = open_checkpoint(args.resume)
+    downloadContent = DownloadContent(
+        read_urls(URLS_HTML_FILE), read_urls(URLS_PDF_FILE), checkpoint
+    )
+    try:
+        with metrics.stage("download_pdf"):
+            if args.wget:
+                downloadContent.download_files_wget()
+            else:
+                downloadContent.download_files_request()
+        with metrics.stage("download_html"):
+            if args.render:
+                downloadContent.download_html_requestsHTMLsession()
+            else:
+                downloadContent.download_html_request()
+    finally:
+        checkpoint.flush()
+    FormingResultsRegistry().add_download_info()
+    scheduler = RecrawlScheduler().load()
+    scheduler.observe_checkpoint(checkpoint)
+    scheduler.save()
+
+
+def process(args):
+    """
+    Extracts text from the downloaded documents and pages.
+    """
+    from ProcessingDownloadContent import ProcessingDownloadContent
+    from Metrics import metrics
+
+    checkpoint = open_checkpoint(args.resume)
+    if not args.resume:
+        # Raw files of the download step are mapped to their URLs by the checkpoint.
+        checkpoint.load(resume=False)
+    processingDownloadContent = ProcessingDownloadContent(checkpoint)
+    try:
+        if args.only in (None, "pdf"):
+            with metrics.stage("process_pdf"):
+                processingDownloadContent.processing_pdf()
+        if args.only in (None, "html"):
+            with metrics.stage("process_html"):
+                processingDownloadContent.processing_html()
+    finally:
+        checkpoint.flush()
+
+
+def registry(args):
+    """
+    Adds processing information to the registry and sorts it.
+    """
+    from FormingResultsRegistry import FormingResultsRegistry
+    from Metrics import metrics
+
+    formingResultsRegistry = FormingResultsRegistry()
+    with metrics.stage("registry_build"):
+        formingResultsRegistry.add_processed_info()
+        formingResultsRegistry.add_other()
+        formingResultsRegistry.registry_sort()
+
+
+def lookup(args):
+    """
+    Prints processed documents of a JSON Lines sink by id.
+    """
+    import json
+    from ProcessedSink import ProcessedSink
+
+    sink = ProcessedSink(args.folder)
+    for id in args.ids:
+        record = sink.get(id)
+        if record is None:
+            print(f"Error: no record with id {id}")
+        else:
+            print(json.dumps(record, ensure_ascii=False))
+
+
+def index(args):
+    """
+    Adds the processed documents that aren't indexed yet to the full-text index.
+    """
+    from FullTextIndex import FullTextIndex
+    from Metrics import metrics
+
+    with metrics.stage("index_build"):
+        added = FullTextIndex().build()
+    print(f"{added} documents were added to the index")
+
+
+def search(args):
+    """
+    Prints the registry ids and final URLs of documents matching a query.
+    """
+    from FullTextIndex import FullTextIndex
+
+    fullTextIndex = FullTextIndex()
+    try:
+        for result in fullTextIndex.search(args.query, args.limit):
+            print(f"{result['id']},{result['url']},{result['matches']}")
+    finally:
+        fullTextIndex.close()
+
+
+def query(args):
+    """
+    Prints registry aggregations or rows from the registry database.
+    """
+    import csv
+    from RegistryStore import COLUMNS, RegistryStore
+
+    store = RegistryStore(read_only=True)
+    try:
+        if args.what == "status":
+            for status, count in store.status_counts():
+                print(f"{status},{count}")
+        elif args.what == "hosts":
+            for host, count in store.host_counts(args.status or "failed", args.limit):
+                print(f"{host},{count}")
+        else:
+            writer = csv.writer(sys.stdout, lineterminator="\n")
+            writer.writerow(COLUMNS)
+            writer.writerows(store.rows(args.status, args.host, args.limit))
+    finally:
+        store.close()
+
+
+def export(args):
+    """
+    Exports the registry database to CSV or Parquet.
+    """
+    from RegistryStore import RegistryStore
+
+    store = RegistryStore(read_only=True)
+    try:
+        if args.format == "parquet":
+            store.export_parquet(args.path)
+        else:
+            store.export_csv(args.path)
+    finally:
+        store.close()
+    print(f"Registry was exported to {args.path}")
+
+
+def main():
+    """
+    Lightweight entry point that runs one step of the pipeline per invocation.
+    Every subcommand imports only the modules it needs, so short-lived jobs don't
+    pay for requests, PyPDF2, bs4 or langdetect unless they use them.
+    Steps of one run share analytics.log: every step except classify appends to it.
+    """
+    from Reader import Reader
+
+    parser = argparse.ArgumentParser(description="Run one step of the pipeline.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    classify_parser = subparsers.add_parser("classify", help="clean and classify URLs")
+    classify_parser.add_argument("filename")
+    Reader.add_arguments(classify_parser)
+    classify_parser.add_argument(
+        "--recrawl-budget",
+        type=int,
+        help="crawl only this many URLs, those most likely to have changed",
+    )
+    download_parser = subparsers.add_parser("download", help="download classified URLs")
+    download_parser.add_argument(
+        "--wget", action="store_true", help="download PDF with wget"
+    )
+    download_parser.add_argument(
+        "--render", action="store_true", help="render HTML with requests_html"
+    )
+    process_parser = subparsers.add_parser("process", help="extract text")
+    process_parser.add_argument("--only", choices=["pdf", "html"])
+    registry_parser = subparsers.add_parser("registry", help="complete the registry")
+    lookup_parser = subparsers.add_parser(
+        "lookup", help="print processed documents by id (PROCESSED_STORAGE=jsonl)"
+    )
+    lookup_parser.add_argument("folder", help="e.g. processed_data/pages/")
+    lookup_parser.add_argument(
+        "ids", nargs="+", help="registry ids, or URLs of records without an id"
+    )
+    subparsers.add_parser(
+        "index", help="add processed documents to the full-text index"
+    )
+    search_parser = subparsers.add_parser(
+        "search", help='find documents, e.g. network "packet loss"'
+    )
+    search_parser.add_argument("query")
+    search_parser.add_argument("--limit", type=int)
+    query_parser = subparsers.add_parser(
+        "query", help="print status counts, top hosts by status or registry rows"
+    )
+    query_parser.add_argument("what", choices=["status", "hosts", "rows"])
+    query_parser.add_argument(
+        "--status",
+        help="processed, failed, downloaded, not_downloaded, duplicate, not_url "
+        "or not_scheduled; failed by default for hosts",
+    )
+    query_parser.add_argument("--host", help="only rows of this host")
+    query_parser.add_argument("--limit", type=int)
+    export_parser = subparsers.add_parser("export", help="export the registry database")
+    export_parser.add_argument("path")
+    export_parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    for subparser in (classify_parser, download_parser, process_parser):
+        subparser.add_argument(
+            "--resume", action="store_true", help="skip work recorded in the checkpoint"
+        )
+
+    args = parser.parse_args()
+    from config import setup_logging
+
+    setup_logging(append=args.command != "classify" or args.resume)
+    from Metrics import metrics
+
+    commands = {
+        "classify": classify,
+        "download": download,
+        "process": process,
+        "registry": registry,
+        "lookup": lookup,
+        "index": index,
+        "search": search,
+        "query": query,
+        "export": export,
+    }
+    try:
+        commands[args.command](args)
+    except Exception as error:
+        print(f"Error: {error}")
+        sys.exit(1)
+    finally:
+        # Read-only commands don't replace the metrics of a run in progress.
+        if args.command in PIPELINE_COMMANDS:
+            metrics.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+import hashlib
+import ipaddress
+import math
+import os
+import threading
+from collections import deque
+from urllib.parse import urldefrag, urljoin, urlparse
+
+from config import *
+from Metrics import metrics
+from URLProcessing import URLProcessing
+
+# Second-level labels under which country codes register domains, e.g. co.uk.
+SECOND_LEVEL_LABELS = {"ac", "co", "com", "edu", "go", "gov", "ne", "net", "or", "org"}
+
+
+class BloomFilter:
+    """
+    Set of strings in a fixed bit array. Membership tests may give false
+    positives with the chosen probability, never false negatives, and the memory
+    doesn't grow with the number of items: about 1.8 bytes per expected item for
+    a 0.1% error rate.
+    Attributes:
+        size (int): Number of bits.
+        hashes (int): Number of bit positions of every item.
+        count (int): Number of added items.
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.size = max(
+            8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        )
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, item):
+        # Double hashing: k positions from the two halves of one digest.
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def __contains__(self, item):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self.positions(item)
+        )
+
+    def add(self, item):
+        """
+        Adds an item.
+        Args:
+            item (str): Item to add.
+        Return:
+            bool: True if the item wasn't in the filter before.
+        """
+        new = False
+        for position in self.positions(item):
+            mask = 1 << (position & 7)
+            if not self.bits[position >> 3] & mask:
+                self.bits[position >> 3] |= mask
+                new = True
+        if new:
+            self.count += 1
+        return new
+
+
+class CrawlFrontier:
+    """
+    Queue of URLs discovered by following links of processed HTML pages.
+    Links are canonicalized by URLProcessing.clean_url, kept only when they are
+    in the scope of the seed URLs and not deeper than max_depth, and
+    deduplicated by a Bloom filter, so the seen set takes a fixed amount of
+    memory however many URLs are discovered. New URLs are queued per host and
+    drained round-robin, so one large site doesn't fill the start of a round.
+    At most memory_urls URLs are queued in memory, the rest is spilled to a
+    text file.
+    Attributes:
+        max_depth (int): Maximum number of links from a seed URL.
+        scope (str): 'host' - only hosts of the seed URLs, 'domain' - also other
+            hosts of their approximated registrable domains (see scope_of),
+            'any' - every host.
+        memory_urls (int): Maximum number of URLs queued in memory.
+        spill_path (str): Path of the file with the URLs over memory_urls.
+        depth (int): Depth of the pages processed now, links found on them
+            have depth + 1.
+        seen (BloomFilter): Seed and discovered URLs.
+    """
+
+    def __init__(
+        self,
+        max_depth,
+        scope=None,
+        memory_urls=None,
+        spill_path=None,
+        capacity=None,
+        error_rate=None,
+    ):
+        self.max_depth = max_depth
+        self.scope = scope or FRONTIER_SCOPE
+        self.memory_urls = memory_urls or FRONTIER_MEMORY_URLS
+        self.spill_path = spill_path or FRONTIER_SPILL_FILE
+        self.seen = BloomFilter(
+            capacity or FRONTIER_EXPECTED_URLS, error_rate or FRONTIER_FALSE_POSITIVE
+        )
+        self.depth = 0
+        self.scopes = set()
+        self.queues = {}
+        self.queued = 0
+        self.spilled = 0
+        self.spill_file = None
+        self.lock = threading.Lock()
+        self.urlProcessing = URLProcessing()
+        if os.path.exists(self.spill_path):
+            os.remove(self.spill_path)
+
+    def scope_of(self, host):
+        """
+        Returns the part of a host that the scope compares.
+        In the 'domain' scope it is the registrable domain, approximated without
+        the public suffix list: the last two labels, or the last three under a
+        country-code second-level domain such as co.uk, com.au or ac.jp. Hosts
+        under other multi-label public suffixes, e.g. blogspot.com or github.io,
+        still share one domain; use the 'host' scope (the default) for them.
+        IP addresses are compared as a whole.
+        Args:
+            host (str): Lowercase host.
+        Return:
+            str: Host or its approximated registrable domain.
+        """
+        if self.scope != "domain":
+            return host
+        try:
+            ipaddress.ip_address(host)
+            return host
+        except ValueError:
+            pass
+        labels = host.split(".")
+        size = 2
+        if len(labels[-1]) == 2 and labels[-2] in SECOND_LEVEL_LABELS:
+            size = 3
+        return ".".join(labels[-size:])
+
+    def in_scope(self, host):
+        return self.scope == "any" or self.scope_of(host) in self.scopes
+
+    def add_seed(self, url):
+        """
+        Marks a clean URL of the input as seen and adds its host to the scope.
+        Args:
+            url (str): Clean URL.
+        """
+        host = urlparse(url).hostname
+        with self.lock:
+            self.seen.add(url)
+            if host:
+                self.scopes.add(self.scope_of(host))
+
+    def add_links(self, page_url, links):
+        """
+        Queues the new links of a page processed at the current depth.
+        Args:
+            page_url (str): URL of the page, relative links are resolved against it.
+            links (iterable): href values of the links.
+        Return:
+            int: Number of queued URLs.
+        """
+        if self.depth >= self.max_depth:
+            return 0
+        added = 0
+        for link in links:
+            url = urldefrag(urljoin(page_url, link.strip())).url
+            url = self.urlProcessing.clean_url(url)
+            if url is None:
+                continue
+            host = urlparse(url).hostname
+            if not host or not self.in_scope(host):
+                continue
+            with self.lock:
+                if not self.seen.add(url):
+                    continue
+                if self.queued < self.memory_urls:
+                    self.queues.setdefault(host, deque()).append(url)
+                    self.queued += 1
+                else:
+                    if self.spill_file is None:
+                        self.spill_file = open(self.spill_path, "a", encoding="utf-8")
+                    self.spill_file.write(url + "\n")
+                    self.spilled += 1
+            added += 1
+        metrics.inc("frontier_urls_total", added)
+        return added
+
+    def __len__(self):
+        return self.queued + self.spilled
+
+    def drain(self):
+        """
+        Takes all queued URLs for the next round and moves to the next depth.
+        Return:
+            generator of string: URLs, round-robin over hosts, then the spilled ones.
+        """
+        with self.lock:
+            queues, self.queues = self.queues, {}
+            spill_path = None
+            if self.spill_file is not None:
+                self.spill_file.close()
+                self.spill_file = None
+                spill_path = self.spill_path + ".draining"
+                os.replace(self.spill_path, spill_path)
+            logging.info(
+                f"Frontier depth {self.depth + 1}: {self.queued} URLs in memory, "
+                f"{self.spilled} spilled, {self.seen.count} seen"
+            )
+            self.queued = self.spilled = 0
+            self.depth += 1
+        return self.iter_drained(queues, spill_path)
+
+    @staticmethod
+    def iter_drained(queues, spill_path):
+        hosts = deque(queues.values())
+        while hosts:
+            queue = hosts.popleft()
+            yield queue.popleft()
+            if queue:
+                hosts.append(queue)
+
+        if spill_path is not None:
+            with open(spill_path, "r", encoding="utf-8") as file:
+                for line in file:
+                    yield line.rstrip("\n")
+            os.remove(spill_path)
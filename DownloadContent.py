@@ -1,31 +1,61 @@
-import requests
+import codecs
 import os
 from urllib.parse import urlparse, unquote
-from concurrent.futures import ThreadPoolExecutor, as_completed
 import subprocess
 import logging
 from config import *
-from requests_html import HTMLSession
-from urllib.robotparser import RobotFileParser
 import shutil
+import threading
 import time
+import hashlib
 from FormingResultsRegistry import *
+from Metrics import metrics
+from AdaptiveConcurrency import AdaptiveConcurrency
+from PackedArchive import PackedArchive
 
 
 class DownloadContent:
     """
     Class responsible for downloading HTML pages and PDF documents from given URLs.
     Attributes:
-        urls_html (list): List of URLs HTML pages to download.
-        urls_pdf (list): List of URLs PDF files to download.
+        urls_html (iterable): URLs of HTML pages to download.
+        urls_pdf (iterable): URLs of PDF files to download.
+        checkpoint (Checkpoint): Progress of the run or None.
+        concurrency (AdaptiveConcurrency): Controller of requests in flight.
+        archives (dict): Packed archive of every download folder, when
+            RAW_STORAGE is 'archive'.
+        session (requests.Session): Session for requests or None.
+        robots (dict): robots.txt URL -> (parser, fetch time) of the hosts checked
+            recently, shared by the download threads under robots_lock.
     """
 
-    def __init__(self, urls_html, urls_pdf):
+    def __init__(
+        self,
+        urls_html,
+        urls_pdf,
+        checkpoint=None,
+        concurrency=None,
+        session=None,
+        keep_files=False,
+    ):
         """
         Initializes the DownloadContent instance.
         Args:
-            urls_html (list): List of URLs HTML pages to download.
-            urls_pdf (list): List of URLs PDF files to download.
+            urls_html (iterable): URLs of HTML pages to download, e.g. a list or
+                the priority queue of RecrawlScheduler.order. They are read
+                lazily, once.
+            urls_pdf (iterable): URLs of PDF files to download, read the same way.
+            checkpoint (Checkpoint): Progress of the run. Downloads are recorded in it,
+                and when it was resumed, URLs downloaded before are skipped.
+            concurrency (AdaptiveConcurrency): Controller of requests in flight,
+                shared with other stages. A new one is created by default.
+            session (requests.Session): Session whose connection pool is reused
+                by requests, e.g. shared with the other stages of the long-running
+                service. A session timing the phases of its connections
+                (HTTPTimings.timed_session) is created by default.
+            keep_files (bool): Whether to keep the files in the download folders,
+                e.g. of the earlier batches or crawl rounds of the run, instead of
+                starting with empty folders.
         Raises:
             ValueError: If either urls_html or urls_pdf is None.
         """
@@ -35,9 +65,78 @@ class DownloadContent:
             raise ValueError("Enter arguments for downloading")
         self.urls_html = urls_html
         self.urls_pdf = urls_pdf
+        self.checkpoint = checkpoint
+        self.keep_files = keep_files
+        self.concurrency = concurrency or AdaptiveConcurrency()
+        self.archives = {}
+        if session is None:
+            from HTTPTimings import timed_session
+
+            session = timed_session()
+        self.session = session
+        self.robots = {}
+        self.robots_lock = threading.Lock()
 
         self.registry = FormingResultsRegistry()
 
+    def prepare_folder(self, folder):
+        """
+        Prepares the folder for downloads. A new run starts with an empty folder,
+        a resumed run keeps the files of the previous run, like keep_files does.
+        When RAW_STORAGE is 'archive', a packed archive is opened instead of the folder.
+        Args:
+            folder (str): Folder to save files.
+        Return:
+            int: First index to prefix new files with, so they don't overwrite old ones.
+        """
+        if RAW_STORAGE == "archive":
+            archive = PackedArchive(PackedArchive.folder_for(folder))
+            self.archives[folder] = archive
+            if not self.keeps_files():
+                archive.reset()
+                archive.open()
+                return 0
+            archive.open()
+            return archive.next_index()
+
+        if not self.keeps_files():
+            if os.path.exists(folder):
+                shutil.rmtree(folder)
+            os.makedirs(folder)
+            return 0
+
+        os.makedirs(folder, exist_ok=True)
+        indexes = [
+            int(file_name.split("_", 1)[0])
+            for file_name in os.listdir(folder)
+            if file_name.split("_", 1)[0].isdigit()
+        ]
+        return max(indexes, default=-1) + 1
+
+    def keeps_files(self):
+        return self.keep_files or (
+            self.checkpoint is not None and self.checkpoint.resumed
+        )
+
+    def pending_urls(self, urls):
+        """
+        Filters out URLs that were already downloaded according to the checkpoint.
+        Args:
+            urls (iterable): URLs to download.
+        Return:
+            generator of str: URLs that still have to be downloaded.
+        """
+        if self.checkpoint is None or not self.checkpoint.resumed:
+            yield from urls
+            return
+        skipped = 0
+        for url in urls:
+            if self.checkpoint.is_downloaded(url):
+                skipped += 1
+            else:
+                yield url
+        logging.info(f"{skipped} URLs were downloaded before, skipped")
+
     def save_to_file(self, url, folder, header, index, mode):
         """
         Downloads content from a URL and saves it to a file.
@@ -47,37 +146,127 @@ class DownloadContent:
             header (dict): HTTP headers to send with the request.
             index (int): An index number to prefix.
             mode (str): File open mode - 'wb' for binary files (PDFs), 'w' for text files (HTML).
+        Return:
+            tuple: Path of the saved file, or locator of the archive record, and
+                its size in bytes, or (None, None) if the response wasn't 200.
+        Notes:
+            - The phases of the request are exported per host: DNS lookup and
+              connect (of a new connection, see HTTPTimings), time to first byte
+              and the body.
+            - Files are written while the body is received, so memory doesn't
+              depend on the size of the response; archive records are built
+              in memory, since the length of the record precedes the body.
         """
+        from HTTPTimings import request_phases, start_request
+
+        file_path = size = None
+        url_parsed = urlparse(url)
+        host = url_parsed.netloc
         self.check_robot_txt(url, header)
-        response = requests.get(url, headers=header, timeout=15)
-        if response.status_code == 200:
-            logging.info("Url was get correct")
-            url_parsed = urlparse(url)
-            file_name = os.path.basename(url_parsed.path)
-            file_name = unquote(file_name)
-            if mode == "w":
-                if not file_name:
-                    file_name = "index.html"
-                elif "." in file_name:
-                    file_name = file_name.split(".", 1)[0] + ".html"
-                else:
-                    file_name = file_name + ".html"
-            file_path = os.path.join(folder, f"{index}_{file_name}")
 
-            with open(file_path, mode) as file:
-                if mode == "wb":
-                    file.write(response.content)
-                else:
-                    file.write(response.text)
-            logging.info(
-                f"URL {url} with size {os.path.getsize(file_path)} was saved as {file_path}. File was saved correct"
+        start_request()
+        response = self.session.get(url, headers=header, timeout=15, stream=True)
+        with response:
+            elapsed = response.elapsed.total_seconds()
+            self.concurrency.record(response.status_code, elapsed)
+            # Elapsed time runs from sending the request to parsing the headers.
+            dns, connect = request_phases()
+            metrics.observe(
+                "download_ttfb_seconds", max(0.0, elapsed - dns - connect), host=host
             )
-        else:
+            metrics.inc(
+                "download_responses_total", host=host, status=response.status_code
+            )
+            if response.status_code == 200:
+                file_path, size = self.save_response(url, response, folder, index, mode)
+        if file_path is None:
             logging.warning(
-                f"URL {url}. Error:Non-200 status code {response.status_code} received for URL: {url}"
+                f"URL {url}. Error: Non-200 status code {response.status_code} received for URL: {url}"
             )
 
         time.sleep(1.5)
+        return file_path, size
+
+    def save_response(self, url, response, folder, index, mode):
+        """
+        Receives the body of a 200 response and saves it.
+        Args:
+            url (str): Requested URL.
+            response (requests.Response): Response opened with stream=True.
+            folder (str): The folder path where to save the file.
+            index (int): An index number to prefix.
+            mode (str): 'wb' for binary files (PDFs), 'w' for text files (HTML).
+        Return:
+            tuple: Path of the saved file, or locator of the archive record, and
+                its size in bytes.
+        """
+        logging.info("Url was get correct")
+        url_parsed = urlparse(url)
+        host = url_parsed.netloc
+        file_name = os.path.basename(url_parsed.path)
+        file_name = unquote(file_name)
+        if mode == "w":
+            if not file_name:
+                file_name = "index.html"
+            elif "." in file_name:
+                file_name = file_name.split(".", 1)[0] + ".html"
+            else:
+                file_name = file_name + ".html"
+
+        started = time.perf_counter()
+        digest = hashlib.sha256()
+        received = 0
+        archive = self.archives.get(folder)
+        if archive is not None:
+            content = response.content
+            digest.update(content)
+            received = size = len(content)
+            file_path = archive.append(url, response, content, f"{index}_{file_name}")
+        else:
+            file_path = os.path.join(folder, f"{index}_{file_name}")
+            if mode == "w" and response.encoding is None:
+                # requests guesses the encoding of such a response from the whole body.
+                content = response.content
+                digest.update(content)
+                received = len(content)
+                with open(file_path, "w") as file:
+                    file.write(response.text)
+            else:
+                decoder = None
+                if mode == "w":
+                    try:
+                        decoder = codecs.getincrementaldecoder(response.encoding)(
+                            errors="replace"
+                        )
+                    except LookupError:
+                        decoder = codecs.getincrementaldecoder("utf-8")(
+                            errors="replace"
+                        )
+                with open(file_path, mode) as file:
+                    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        digest.update(chunk)
+                        received += len(chunk)
+                        file.write(chunk if decoder is None else decoder.decode(chunk))
+                    if decoder is not None:
+                        file.write(decoder.decode(b"", final=True))
+            size = os.path.getsize(file_path)
+        metrics.observe(
+            "download_body_seconds", time.perf_counter() - started, host=host
+        )
+        metrics.inc("download_bytes_total", received, host=host)
+
+        logging.info(
+            f"URL {url} with size {size} was saved as {file_path}. File was saved correct"
+        )
+        if self.checkpoint is not None:
+            self.checkpoint.record(
+                "downloaded",
+                url=url,
+                path=file_path,
+                sha256=digest.hexdigest(),
+                size=size,
+            )
+        return file_path, size
 
     def download_one_file(self, folder, header, url, index):
         """
@@ -96,31 +285,49 @@ class DownloadContent:
             logging.warning(f"URL {url}. Error: File wasn't saved {error}")
             raise ValueError(f"URL {url}. Error: in downloading {url}: {error}")
 
+    def download_all(self, download_one, folder, header, urls, start, stage):
+        """
+        Downloads URLs concurrently within the limits of the adaptive concurrency
+        controller: requests to a host are throttled when it slows down or answers
+        429/503, while other hosts keep their slots.
+        Args:
+            download_one (callable): download_one_file or download_one_html.
+            folder (str): Folder to save files.
+            header (dict): HTTP headers to send with the request.
+            urls (iterable): URLs to download.
+            start (int): First index to prefix files with.
+            stage (str): Name of the stage for metrics.
+        """
+        for (index, url), future in self.concurrency.map_unordered(
+            lambda item: download_one(folder, header, item[1], item[0]),
+            enumerate(self.pending_urls(urls), start=start),
+            lambda item: urlparse(item[1]).netloc,
+            stage,
+        ):
+            try:
+                future.result()
+                metrics.inc("urls_total", stage=stage, result="success")
+            except Exception as error:
+                metrics.inc("urls_total", stage=stage, result="failed")
+                logging.warning(f"Download failed with error: {error}")
+        if folder in self.archives:
+            self.archives[folder].close()
+
     def download_files_request(self):
         """
-        Downloads all PDF files in parallel using requests.
+        Downloads all PDF files concurrently using requests.
         """
         folder = "raw_downloads/documents/"
-        if os.path.exists(folder):
-            shutil.rmtree(folder)
-
-        os.makedirs(folder)
+        start = self.prepare_folder(folder)
         header = {
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36"
         }
 
         logging.info("Start domload PDF")
 
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            futures = {
-                executor.submit(self.download_one_file, folder, header, url, i): url
-                for i, url in enumerate(self.urls_pdf)
-            }
-            for future in as_completed(futures):
-                try:
-                    future.result()
-                except Exception as error:
-                    logging.warning(f"Download failed with error: {error}")
+        self.download_all(
+            self.download_one_file, folder, header, self.urls_pdf, start, "download_pdf"
+        )
         logging.info("Files was downloaded correct")
 
     def download_files_wget(self):
@@ -168,40 +375,37 @@ class DownloadContent:
         try:
             self.save_to_file(url, folder, header, index, "w")
         except Exception as error:
-            logging.warning(f"File wasn't saved. Error: {error}")
+            logging.warning(f"URL {url}. Error: File wasn't saved {error}")
             raise ValueError(f"Error in downloading {url}: {error}")
 
     def download_html_request(self):
         """
-        Downloads all HTML pages in parallel using requests.
+        Downloads all HTML pages concurrently using requests.
         """
         folder = "raw_downloads/pages/"
-        if os.path.exists(folder):
-            shutil.rmtree(folder)
-
-        os.makedirs(folder)
+        start = self.prepare_folder(folder)
         header = {
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36"
         }
 
         logging.info("Start domload HTML")
 
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            futures = {
-                executor.submit(self.download_one_html, folder, header, url, i): url
-                for i, url in enumerate(self.urls_html)
-            }
-            for future in as_completed(futures):
-                try:
-                    future.result()
-                except Exception as error:
-                    logging.warning(f"Download failed with error: {error}")
+        self.download_all(
+            self.download_one_html,
+            folder,
+            header,
+            self.urls_html,
+            start,
+            "download_html",
+        )
         logging.info("Files was downloaded correct")
 
     def download_html_requestsHTMLsession(self):
         """
         Downloads all HTML pages using requests_html.
         """
+        from requests_html import HTMLSession
+
         folder = "raw_downloads/pages"
         os.makedirs(folder, exist_ok=True)
         header = {
@@ -241,12 +445,23 @@ class DownloadContent:
             url (str): The URL to check robots.txt rules.
             header (dict): HTTP headers to send with the request.
         """
+        from urllib.robotparser import RobotFileParser
+
         url_parser = urlparse(url)
         url_robots = f"{url_parser.scheme}://{url_parser.netloc}/robots.txt"
 
-        rp = RobotFileParser()
-        rp.set_url(url_robots)
-        rp.read()
+        # robots.txt is fetched once per host and cached for ROBOTS_CACHE_TTL.
+        # It is fetched outside the lock, so a slow host doesn't hold the others.
+        with self.robots_lock:
+            cached = self.robots.get(url_robots)
+        if cached is not None and time.time() - cached[1] < ROBOTS_CACHE_TTL:
+            rp = cached[0]
+        else:
+            rp = RobotFileParser()
+            rp.set_url(url_robots)
+            rp.read()
+            with self.robots_lock:
+                self.robots[url_robots] = (rp, time.time())
 
         user_agent = header.get("User-Agent")
 
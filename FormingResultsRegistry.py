@@ -1,15 +1,44 @@
-import os
-import subprocess
+import re
+import time
+from Metrics import metrics
+from RegistryStore import RegistryStore
+
+# Lines of analytics.log: "2024-01-01 12:00:00,123 INFO message".
+LOG_LINE = re.compile(r"(\S+ \S+),\d+ [A-Z]+ (.*)")
+# "URL <url>. Error: <error>"; older logs have no space before "Error:".
+URL_ERROR = re.compile(
+    r"URL (?P<url>\S+?)(?:\.| can't be checked html or pdf\.) ?Error: ?(?P<error>.*)"
+)
+URL_TYPE = re.compile(r"URL (?P<url>\S+) is (?P<type>html|PDF)")
+SAVED = re.compile(
+    r"URL (?P<url>\S+) with size (?P<size>\d+) was saved as (?P<path>.+)\. "
+    r"File was saved correct"
+)
+PROCESSED = re.compile(
+    r"From (?P<path>.+) was successfully processed (?:PDF|HTML) in (?P<output>.+) "
+    r"with language (?P<language>\S+?)(?: and (?P<pages>\d+) pages)?\."
+)
+PROCESSING_ERROR = re.compile(r"Error processing (?P<path>.+?): (?P<error>.*)")
 
 
 class FormingResultsRegistry:
     """
-    A class that generates a summary register based on the results of processing all URLs from the input CSV file
+    A class that generates a summary register based on the results of processing all URLs from the input CSV file.
+    Rows are kept in a RegistryStore database (registry.db), which every stage
+    updates in batched transactions; results_registry.csv is exported from it
+    by registry_sort.
+    Attributes:
+        store (RegistryStore): Database of the registry.
     """
 
+    def __init__(self, store=None):
+        self.store = store or RegistryStore()
+
+    @metrics.timed("registry_write_seconds", method="create_results_registry_csv")
     def create_results_registry_csv(self):
         """
-        Creates a new results_registry.csv file with the appropriate columns.
+        Creates a new registry with the appropriate columns: empties the database
+        and writes results_registry.csv with the header only.
         This method initializes the registry with all necessary fields for tracking document processing.
 
         Columns:
@@ -51,42 +80,72 @@ class FormingResultsRegistry:
         metadata_creation_date : str, optional
             Creation date from document metadata, if available.
         """
-        columns = [
-            "id",
-            "source_url",
-            "final_url",
-            "processing_timestamp",
-            "download_timestamp",
-            "download_status",
-            "error_message",
-            "content_type_detected",
-            "raw_file_path",
-            "processed_file_path",
-            "file_size_bytes",
-            "document_page_count",
-            "detected_language",
-            "extracted_keywords",
-            "extracted_entities",
-            "summary",
-            "metadata_author",
-            "metadata_creation_date",
-        ]
-
-        with open("results_registry.csv", "w") as file:
-            first_line = ",".join(columns) + "\n"
-            file.write(first_line)
+        self.store.reset()
+        self.store.export_csv("results_registry.csv")
 
+    @metrics.timed("registry_write_seconds", method="add_source_url")
     def add_source_url(self, source_urls):
         """
-        Appends source URLs to the results_registry.csv file.
+        Appends source URLs to the registry.
         Args:
-            source_urls (list): A list of source URLs to be added to the registry.
+            source_urls (iterable): Source URLs to be added to the registry.
         """
-        with open("results_registry.csv", "a") as file:
-            for id in range(1, len(source_urls) + 1):
-                line = f"{id},{source_urls[id - 1]}{", "*17}\n"
-                file.write(line)
+        self.store.insert(
+            {"id": id, "source_url": source_url}
+            for id, source_url in enumerate(source_urls, start=1)
+        )
 
+    def add_cleaned_records(self, records):
+        """
+        Appends source URLs together with the results of the URL cleaning step
+        to the registry in a single pass.
+        It is the streaming equivalent of add_source_url followed by
+        add_processing_info_from_cleaner for every URL: rows are written as
+        records arrive, in transactions of REGISTRY_BATCH_SIZE rows, and clean
+        URLs are passed on.
+        Args:
+            records (iterable): (id, source_url, url, status) tuples, where url and
+                status come from URLProcessing.iter_cleaner (or
+                RecrawlScheduler.schedule, which adds the 'not_scheduled' status).
+        Return:
+            generator of string: Clean URLs, in input order and without duplicates.
+        """
+        started = time.perf_counter()
+        batch = []
+        try:
+            for id, source_url, url, status in records:
+                row = {
+                    "id": id,
+                    "source_url": source_url,
+                    "final_url": " ",
+                    "error_message": " ",
+                }
+                if status == "clean_url":
+                    row["final_url"] = url
+                if status == "duplicate_url":
+                    row["final_url"] = "-"
+                    row["error_message"] = "URL was deleted cause URL is duplicate"
+                if status == "Not url":
+                    row["final_url"] = "-"
+                    row["error_message"] = "Line was deleted cause line isn't URL"
+                if status == "not_scheduled":
+                    row["final_url"] = url
+                    row["error_message"] = "URL wasn't scheduled for recrawl"
+                batch.append(row)
+                if len(batch) >= self.store.batch_size:
+                    self.store.insert(batch)
+                    batch = []
+                if status == "clean_url":
+                    yield url
+        finally:
+            self.store.insert(batch)
+            metrics.observe(
+                "registry_write_seconds",
+                time.perf_counter() - started,
+                method="add_cleaned_records",
+            )
+
+    @metrics.timed("registry_write_seconds", method="add_processing_info_from_cleaner")
     def add_processing_info_from_cleaner(self, id, url, status):
         """
         Updates the registry with processing information from the URL cleaning step.
@@ -100,42 +159,38 @@ class FormingResultsRegistry:
         """
 
         id += 1
-        with open("results_registry.csv", "r") as inputfile, open(
-            "results_registry_temp.csv", "a"
-        ) as outputfile:
-            outputfile.write(next(inputfile))
-            for line in inputfile:
-                temp_line = line.rstrip("\n")
-                columns = temp_line.split(",")
-                if columns[0] == str(id):
-                    if status == "clean_url":
-                        columns[2] = url
-                    if status == "duplicate_url":
-                        columns[2] = "-"
-                        columns[6] = "URL was deleted cause URL is duplicate"
-                    if status == "Not url":
-                        columns[2] = "-"
-                        columns[6] = "Line was deleted cause line isn't URL"
-
-                new_line = ",".join(columns) + "\n"
-                outputfile.write(new_line)
-
-        os.replace("results_registry_temp.csv", "results_registry.csv")
+        if status == "clean_url":
+            self.store.update("id = ?", [id], final_url=url)
+        if status == "duplicate_url":
+            self.store.update(
+                "id = ?",
+                [id],
+                final_url="-",
+                error_message="URL was deleted cause URL is duplicate",
+            )
+        if status == "Not url":
+            self.store.update(
+                "id = ?",
+                [id],
+                final_url="-",
+                error_message="Line was deleted cause line isn't URL",
+            )
 
     def get_ids(self):
         """
-        Retrieves all IDs from the results_registry.csv file.
+        Retrieves all IDs from the registry.
         Returns:
             set: A set containing all IDs present in the registry.
         """
-        ids = set()
-        with open("results_registry.csv", "r") as file:
-            next(file)
-            for line in file:
-                temp_line = line.split(",")
-                ids.add(temp_line[0])
+        return {str(id) for (id,) in self.store.select("SELECT id FROM registry")}
 
-        return ids
+    def get_max_id(self):
+        """
+        Retrieves the largest ID of the registry by the primary key index.
+        Returns:
+            int: The largest ID, 0 if the registry is empty.
+        """
+        return self.store.max_id()
 
     def get_ids_without_error(self):
         """
@@ -143,65 +198,94 @@ class FormingResultsRegistry:
         Returns:
             set: A set of IDs with no error messages.
         """
-        ids = set()
-        with open("results_registry.csv", "r") as file:
-            next(file)
-            for line in file:
-                temp_line = line.split(",")
-                if len(temp_line[5]) == 1:
-                    ids.add(temp_line[0])
+        return {
+            str(id)
+            for (id,) in self.store.select(
+                "SELECT id FROM registry WHERE length(download_status) = 1"
+            )
+        }
 
-        return ids
+    def get_url_ids(self):
+        """
+        Retrieves the ID of every clean URL from the registry.
+        Returns:
+            dict: Clean URL -> ID of its first occurrence.
+        """
+        return {
+            url: str(id)
+            for url, id in self.store.select(
+                "SELECT final_url, MIN(id) FROM registry "
+                "WHERE final_url NOT IN ('-', ' ') GROUP BY final_url"
+            )
+        }
 
-    def add_processing_info_from_check(self):
+    def get_downloaded_urls(self):
         """
-        Updates the registry with information from the document type and error checking step based on analytics.log.
-        Notes:
-            - Updates 'error_message' (column 6) if an error is detected during document type or error checking.
-            - Updates 'content_type_detected' (column 7) with the detected content type ('document' or 'page').
+        Retrieves the URL of every downloaded raw file from analytics.log.
+        Returns:
+            dict: Raw file path -> URL it was downloaded from.
         """
-        ids = self.get_ids()
-        with open("analytics.log", "r") as logfile, open(
-            "results_registry.csv", "r"
-        ) as inputfile, open("results_registry_temp.csv", "a") as outputfile:
-            outputfile.write(next(inputfile))
+        urls = {}
+        with open("analytics.log", "r") as logfile:
+            for log_line in logfile:
+                if "File was saved correct" in log_line:
+                    saved = SAVED.search(log_line)
+                    if saved:
+                        urls[saved["path"]] = saved["url"]
+
+        return urls
+
+    def read_log_section(self, start, ends):
+        """
+        Reads the lines of the sections of analytics.log written by one stage.
+        Args:
+            start (str): Message that starts a section.
+            ends (tuple): Messages that end a section.
+        Return:
+            generator of tuple: (timestamp, message) of every line; continuation
+                lines of multi-line messages are skipped.
+        """
+        with open("analytics.log", "r") as logfile:
             is_read = False
             for log_line in logfile:
+                if any(end in log_line for end in ends):
+                    is_read = False
                 if is_read:
-                    inputfile.seek(0)
-                    next(inputfile)
-                    for in_line in inputfile:
-                        temp_line = in_line.rstrip("\n")
-                        columns = temp_line.split(",")
-                        log_line_split = log_line.split(" ")
-                        if columns[2] == log_line_split[4] and len(columns[6]) == 1:
-                            if columns[0] in ids:
-                                ids.remove(columns[0])
-                            if "Error:" in log_line_split:
-                                error_index = log_line_split.index("Error:")
-                                error_text = " ".join(
-                                    log_line_split[error_index + 1 :]
-                                ).strip()
-                                columns[6] = f'"{error_text}"'
-                            else:
-                                columns[7] = log_line_split[6].rstrip("\n")
-                            new_line = ",".join(columns) + "\n"
-                            outputfile.write(new_line)
-                if "Start checking pdf or html" in log_line:
+                    parsed = LOG_LINE.fullmatch(log_line.rstrip("\n"))
+                    if parsed:
+                        yield parsed[1], parsed[2]
+                if start in log_line:
                     is_read = True
 
-            for id_to_find in list(ids):
-                inputfile.seek(0)
-                for line in inputfile:
-                    columns = line.rstrip("\n").split(",")
-                    if columns[0] == id_to_find:
-                        columns[7] = "-"
-                        new_line = ",".join(columns) + "\n"
-                        outputfile.write(new_line)
-                        ids.remove(id_to_find)
+    @metrics.timed("registry_write_seconds", method="add_processing_info_from_check")
+    def add_processing_info_from_check(self):
+        """
+        Updates the registry with information from the document type and error checking step based on analytics.log.
+        Notes:
+            - Updates 'error_message' (column 6) if an error is detected during document type or error checking.
+            - Updates 'content_type_detected' (column 7) with the detected content type ('document' or 'page').
+            - When a URL has several lines, the last one wins.
+        """
+        results = {}
+        for _, message in self.read_log_section(
+            "Start checking pdf or html", ("Start domload PDF",)
+        ):
+            error = URL_ERROR.match(message)
+            if error:
+                results[error["url"]] = {"error_message": error["error"].strip()}
+                continue
+            url_type = URL_TYPE.fullmatch(message)
+            if url_type:
+                results[url_type["url"]] = {"content_type_detected": url_type["type"]}
 
-        os.replace("results_registry_temp.csv", "results_registry.csv")
+        self.store.apply(
+            "final_url",
+            results,
+            {"content_type_detected": "-"},
+            condition="length(error_message) = 1",
+        )
 
+    @metrics.timed("registry_write_seconds", method="add_download_info")
     def add_download_info(self):
         """
         Updates the registry with download information from analytics.log.
@@ -212,55 +296,37 @@ class FormingResultsRegistry:
             - Updates 'raw_file_path' (column 8) with the relative path to the downloaded file.
             - Updates 'file_size_bytes' (column 10) with the size of the downloaded file in bytes.
         """
+        failed = dict.fromkeys(
+            (
+                "download_timestamp",
+                "download_status",
+                "raw_file_path",
+                "file_size_bytes",
+            ),
+            "-",
+        )
+        results = {}
+        for timestamp, message in self.read_log_section(
+            "Start domload PDF", ("Start processing PDF", "Start checking pdf or html")
+        ):
+            error = URL_ERROR.match(message)
+            if error:
+                results[error["url"]] = dict(
+                    failed, error_message=error["error"].strip()
+                )
+                continue
+            saved = SAVED.fullmatch(message)
+            if saved:
+                results[saved["url"]] = {
+                    "download_timestamp": timestamp,
+                    "download_status": "Successful download",
+                    "raw_file_path": saved["path"],
+                    "file_size_bytes": saved["size"],
+                }
 
-        ids = self.get_ids()
-        with open("analytics.log", "r") as logfile, open(
-            "results_registry.csv", "r"
-        ) as inputfile, open("results_registry_temp.csv", "a") as outputfile:
-            outputfile.write(next(inputfile))
-            is_read = False
-            for log_line in logfile:
-                if is_read:
-                    inputfile.seek(0)
-                    next(inputfile)
-                    for in_line in inputfile:
-                        temp_line = in_line.rstrip("\n")
-                        columns = temp_line.split(",")
-                        log_line_split = log_line.split(" ")
-                        if columns[2] == log_line_split[4].rstrip("."):
-                            if columns[0] in ids:
-                                ids.remove(columns[0])
-                            if "Error:" in log_line_split:
-                                columns[4] = columns[5] = columns[8] = columns[10] = "-"
-                                error_index = log_line_split.index("Error:")
-                                error_text = "".join(
-                                    log_line_split[error_index + 1 :]
-                                ).strip()
-                                columns[6] = f'"{error_text}"'
-                            else:
-                                columns[4] = (
-                                    log_line_split[0] + " " + log_line_split[1][:-4]
-                                )
-                                columns[10] = log_line_split[7]
-                                columns[8] = log_line_split[11].rstrip(".")
-                                columns[5] = "Successful download"
-                            new_line = ",".join(columns) + "\n"
-                            outputfile.write(new_line)
-                if "Start domload PDF" in log_line:
-                    is_read = True
-
-            for id_to_find in list(ids):
-                inputfile.seek(0)
-                for line in inputfile:
-                    columns = line.rstrip("\n").split(",")
-                    if columns[0] == id_to_find:
-                        columns[4] = columns[5] = columns[8] = columns[10] = "-"
-                        new_line = ",".join(columns) + "\n"
-                        outputfile.write(new_line)
-                        ids.remove(id_to_find)
-
-        os.replace("results_registry_temp.csv", "results_registry.csv")
+        self.store.apply("final_url", results, failed)
 
+    @metrics.timed("registry_write_seconds", method="add_processed_info")
     def add_processed_info(self):
         """
         Updates the registry with information about processed files from analytics.log.
@@ -271,64 +337,40 @@ class FormingResultsRegistry:
             - Updates 'detected_language' (column 12) with the detected language or 'Not detected'.
             - Updates 'error_message' (column 6) if an error occurred during processing.
         """
-        ids = self.get_ids()
-        with open("analytics.log", "r") as logfile, open(
-            "results_registry.csv", "r"
-        ) as inputfile, open("results_registry_temp.csv", "a") as outputfile:
-            outputfile.write(next(inputfile))
-            is_read = False
-            for log_line in logfile:
-                if is_read:
-                    inputfile.seek(0)
-                    next(inputfile)
-                    for in_line in inputfile:
-                        temp_line = in_line.rstrip("\n")
-                        columns = temp_line.split(",")
-                        log_line_split = log_line.split(" ")
-                        if columns[8] == log_line_split[4]:
-                            if columns[0] in ids:
-                                ids.remove(columns[0])
-                            if "Error:" in log_line_split:
-                                columns[3] = columns[9] = columns[11] = columns[12] = (
-                                    "-"
-                                )
-                                error_index = log_line_split.index("Error")
-                                error_text = "".join(
-                                    log_line_split[error_index + 1 :]
-                                ).strip()
-                                columns[6] = f'"{error_text}"'
-                            else:
-                                columns[3] = (
-                                    log_line_split[0] + " " + log_line_split[1][:-4]
-                                )
-                                columns[9] = log_line_split[10]
-                                if len(log_line_split) > 15:
-                                    columns[11] = log_line_split[15]
-                                else:
-                                    columns[11] = "-"
-                                if "None" not in log_line_split[13]:
-                                    columns[12] = (
-                                        log_line_split[13].rstrip(".").rstrip("\n")
-                                    )
-                                else:
-                                    columns[12] = "Not detected"
-                            new_line = ",".join(columns) + "\n"
-                            outputfile.write(new_line)
-                if "Start processing PDF" in log_line:
-                    is_read = True
+        failed = dict.fromkeys(
+            (
+                "processing_timestamp",
+                "processed_file_path",
+                "document_page_count",
+                "detected_language",
+            ),
+            "-",
+        )
+        results = {}
+        for timestamp, message in self.read_log_section(
+            "Start processing PDF", ("Start checking pdf or html",)
+        ):
+            error = PROCESSING_ERROR.match(message)
+            if error:
+                results[error["path"]] = dict(
+                    failed, error_message=error["error"].strip()
+                )
+                continue
+            processed = PROCESSED.fullmatch(message)
+            if processed:
+                language = processed["language"]
+                results[processed["path"]] = {
+                    "processing_timestamp": timestamp,
+                    "processed_file_path": processed["output"],
+                    "document_page_count": processed["pages"] or "-",
+                    "detected_language": (
+                        language if "None" not in language else "Not detected"
+                    ),
+                }
 
-            for id_to_find in list(ids):
-                inputfile.seek(0)
-                for line in inputfile:
-                    columns = line.rstrip("\n").split(",")
-                    if columns[0] == id_to_find:
-                        columns[3] = columns[9] = columns[11] = columns[12] = "-"
-                        new_line = ",".join(columns) + "\n"
-                        outputfile.write(new_line)
-                        ids.remove(id_to_find)
-
-        os.replace("results_registry_temp.csv", "results_registry.csv")
+        self.store.apply("raw_file_path", results, failed)
 
+    @metrics.timed("registry_write_seconds", method="add_other")
     def add_other(self):
         """
         Fills the remaining columns in the registry with placeholder values.
@@ -340,24 +382,21 @@ class FormingResultsRegistry:
             - Sets 'metadata_creation_date' (column 17) to '-'.
             - Used when no extraction or metadata is available.
         """
-        with open("results_registry.csv", "r") as inputfile, open(
-            "results_registry_temp.csv", "a"
-        ) as outputfile:
-            for line in inputfile:
-                columns = line.rstrip("\n").split(",")
-                columns[13] = columns[14] = columns[15] = columns[16] = "-"
-                new_line = ",".join(columns) + "\n"
-                outputfile.write(new_line)
-
-        os.replace("results_registry_temp.csv", "results_registry.csv")
+        self.store.update(
+            "1",
+            [],
+            extracted_keywords="-",
+            extracted_entities="-",
+            summary="-",
+            metadata_author="-",
+            metadata_creation_date="-",
+        )
 
+    @metrics.timed("registry_write_seconds", method="registry_sort")
     def registry_sort(self):
         """
-        Sorts the 'results_registry.csv' file by the 'id' column.
+        Exports the registry to results_registry.csv sorted by the 'id' column,
+        with values quoted where needed. An id has one row: work redone by a
+        resumed run updates the row of the previous run.
         """
-        input_file = "results_registry.csv"
-        temp_file = "results_registry_temp.csv"
-        cmd = f"(head -n 1 {input_file} && tail -n +2 {input_file} | sort -t, -k1,1n) > {temp_file}"
-
-        subprocess.run(cmd, shell=True, check=True)
-        os.replace(temp_file, input_file)
+        self.store.export_csv("results_registry.csv")
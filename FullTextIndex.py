@@ -0,0 +1,615 @@
+import bisect
+import csv
+import gzip
+import hashlib
+import json
+import mmap
+import os
+import re
+import sqlite3
+import struct
+import time
+
+from config import *
+from Metrics import metrics
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+# Term offset and length in the .terms file, postings offset and length in the .post file.
+TERM_ENTRY = struct.Struct("<IHQI")
+
+# Live version of every indexed URL: the segment and document number that hold
+# it, the fingerprint of its text, its registry id and the build that saw it last.
+DOCUMENTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    url TEXT PRIMARY KEY,
+    id TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    segment TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    build INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS documents_segment ON documents (segment, number);
+"""
+
+
+def tokenize(text):
+    """
+    Splits text into lowercase word tokens.
+    Args:
+        text (str): Text to split.
+    Return:
+        list: Tokens in text order.
+    """
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def encode_varint(value, out):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_varint(data, position):
+    value = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+class Segment:
+    """
+    Immutable part of the index, memory-mapped for queries.
+    A segment consists of four files:
+        .terms - sorted terms, concatenated;
+        .tix - fixed-size entries (TERM_ENTRY) of the terms, searched by bisection;
+        .post - postings: number of documents, then for every document the
+            delta of its number, the number of occurrences and the deltas of
+            the positions, all as varints;
+        .docs.json - URL of every document number.
+    Attributes:
+        path (str): Path of the segment without extension.
+        name (str): Name of the segment in meta.json.
+        docs (list): URL of every document number.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        with open(path + ".docs.json", "r", encoding="utf-8") as file:
+            self.docs = json.load(file)
+        self.files = []
+        self.terms = self.map(".terms")
+        self.tix = self.map(".tix")
+        self.post = self.map(".post")
+        self.count = len(self.tix) // TERM_ENTRY.size if self.tix else 0
+
+    def map(self, extension):
+        file = open(self.path + extension, "rb")
+        self.files.append(file)
+        if os.path.getsize(self.path + extension) == 0:
+            return b""
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        for data in (self.terms, self.tix, self.post):
+            if isinstance(data, mmap.mmap):
+                data.close()
+        for file in self.files:
+            file.close()
+
+    def term_at(self, number):
+        term_offset, term_length, _, _ = TERM_ENTRY.unpack_from(
+            self.tix, number * TERM_ENTRY.size
+        )
+        return self.terms[term_offset : term_offset + term_length]
+
+    def postings(self, term):
+        """
+        Reads the postings of a term.
+        Args:
+            term (str): Term.
+        Return:
+            dict: Document number -> list of positions.
+        """
+        key = term.encode("utf-8")
+        terms = TermsView(self)
+        number = bisect.bisect_left(terms, key)
+        if number == self.count or terms[number] != key:
+            return {}
+        return self.postings_at(number)
+
+    def postings_at(self, number):
+        """
+        Reads the postings of the term with the given number in the sorted terms.
+        Args:
+            number (int): Number of the term.
+        Return:
+            dict: Document number -> list of positions.
+        """
+        _, _, offset, length = TERM_ENTRY.unpack_from(
+            self.tix, number * TERM_ENTRY.size
+        )
+        data = self.post[offset : offset + length]
+        count, position = decode_varint(data, 0)
+        postings = {}
+        doc = 0
+        for _ in range(count):
+            delta, position = decode_varint(data, position)
+            doc += delta
+            frequency, position = decode_varint(data, position)
+            positions = []
+            token = 0
+            for _ in range(frequency):
+                delta, position = decode_varint(data, position)
+                token += delta
+                positions.append(token)
+            postings[doc] = positions
+        return postings
+
+
+class TermsView:
+    """
+    Sequence view of the sorted terms of a segment, for bisection.
+    """
+
+    def __init__(self, segment):
+        self.segment = segment
+
+    def __len__(self):
+        return self.segment.count
+
+    def __getitem__(self, number):
+        return self.segment.term_at(number)
+
+
+class FullTextIndex:
+    """
+    On-disk inverted index over processed documents, for term and phrase
+    queries returning registry ids and final URLs.
+    Documents are read from the processed files (or JSON Lines shards) listed in
+    results_registry.csv and identified by URL, since registry ids start from 1
+    in every run. Every build adds only new documents and documents whose text
+    changed, as new segments of at most INDEX_SEGMENT_DOCS documents, so the
+    index grows incrementally. The live version of every URL, with its current
+    registry id, is kept in documents.db: superseded versions and documents
+    that are no longer in the registry are left out of results, and segments
+    without live documents are removed. When there are more than
+    merge_segments segments, the smallest ones are merged, so queries don't
+    open a segment per build. The list of segments is kept in meta.json, which
+    is replaced atomically after the segment files are written.
+    Attributes:
+        folder (str): Folder with the index.
+        segment_docs (int): Maximum number of documents in one segment.
+        merge_segments (int): Number of segments above which segments are merged.
+    """
+
+    def __init__(self, folder=None, segment_docs=None, merge_segments=None):
+        self.folder = folder or INDEX_FOLDER
+        self.segment_docs = segment_docs or INDEX_SEGMENT_DOCS
+        self.merge_segments = merge_segments or INDEX_MERGE_SEGMENTS
+        self.segments = None
+        self.connection = None
+
+    def meta_path(self):
+        return os.path.join(self.folder, "meta.json")
+
+    def load_meta(self):
+        try:
+            with open(self.meta_path(), "r", encoding="utf-8") as file:
+                meta = json.load(file)
+        except FileNotFoundError:
+            return {"segments": [], "builds": 0}
+        if "ids" in meta:
+            # Segments of an index keyed by registry ids are rebuilt.
+            logging.info(f"Index {self.folder} has an old format, it is rebuilt")
+            for name in meta["segments"]:
+                self.remove_segment(name)
+            return {"segments": [], "builds": 0}
+        return meta
+
+    def save_meta(self, meta):
+        temp_path = self.meta_path() + ".temp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump(meta, file)
+        os.replace(temp_path, self.meta_path())
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(
+                os.path.join(self.folder, "documents.db"), timeout=60
+            )
+            self.connection.executescript(DOCUMENTS_SCHEMA)
+        return self.connection
+
+    def remove_segment(self, name):
+        for extension in (".terms", ".tix", ".post", ".docs.json"):
+            path = os.path.join(self.folder, name + extension)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def documents(self, registry_path="results_registry.csv"):
+        """
+        Reads the processed documents listed in the registry.
+        Args:
+            registry_path (str): Path of the registry.
+        Return:
+            generator of tuple: (id, url, text) tuples, where url is the final
+                URL the document was downloaded from, as in JSON Lines records.
+        """
+        sink_folders = set()
+        with open(registry_path, "r", newline="") as file:
+            rows = csv.reader(file)
+            next(rows, None)
+            for columns in rows:
+                path = columns[9]
+                if path in ("-", " ", ""):
+                    continue
+                if "#" in path:
+                    sink_folders.add(os.path.dirname(path.split("#", 1)[0]))
+                    continue
+                try:
+                    with open(path, "r", encoding="utf-8", errors="replace") as text:
+                        yield columns[0], columns[2], text.read()
+                except FileNotFoundError:
+                    logging.warning(f"Index. Error: processed file {path} not found")
+
+        # Documents of a JSON Lines sink are read by a sequential scan of its shards.
+        for folder in sorted(sink_folders):
+            for name in sorted(os.listdir(folder)):
+                if not (name.startswith("part-") and name.endswith(".jsonl.gz")):
+                    continue
+                with gzip.open(
+                    os.path.join(folder, name), "rt", encoding="utf-8"
+                ) as shard:
+                    for line in shard:
+                        record = json.loads(line)
+                        if record.get("url") is None:
+                            continue
+                        id = "-" if record.get("id") is None else str(record["id"])
+                        yield id, record["url"], record.get("text", "")
+
+    def build(self, registry_path="results_registry.csv"):
+        """
+        Indexes the documents of the registry that are new or changed, updates
+        the ids of the unchanged ones and drops the documents that are no longer
+        in the registry.
+        Args:
+            registry_path (str): Path of the registry.
+        Return:
+            int: Number of added documents.
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        meta = self.load_meta()
+        connection = self.connect()
+        generation = meta["builds"] + 1
+        added = 0
+        batch, unchanged = [], []
+
+        def touch():
+            with connection:
+                connection.executemany(
+                    "UPDATE documents SET id = ?, build = ? WHERE url = ?", unchanged
+                )
+
+        started = time.perf_counter()
+        for id, url, text in self.documents(registry_path):
+            fingerprint = hashlib.blake2b(
+                text.encode("utf-8", errors="replace"), digest_size=16
+            ).hexdigest()
+            row = connection.execute(
+                "SELECT fingerprint FROM documents WHERE url = ?", (url,)
+            ).fetchone()
+            if row is not None and row[0] == fingerprint:
+                unchanged.append((id, generation, url))
+                if len(unchanged) >= self.segment_docs:
+                    touch()
+                    unchanged = []
+                continue
+            batch.append((id, url, fingerprint, text))
+            if len(batch) >= self.segment_docs:
+                added += self.write_segment(meta, batch, generation)
+                batch = []
+        if batch:
+            added += self.write_segment(meta, batch, generation)
+        touch()
+
+        with connection:
+            removed = connection.execute(
+                "DELETE FROM documents WHERE build < ?", (generation,)
+            ).rowcount
+        live = {
+            segment
+            for segment, in connection.execute("SELECT DISTINCT segment FROM documents")
+        }
+        dead = [name for name in meta["segments"] if name not in live]
+        meta["segments"] = [name for name in meta["segments"] if name in live]
+        meta["builds"] = generation
+        self.save_meta(meta)
+        for name in dead:
+            self.remove_segment(name)
+        merged = 0
+        while True:
+            count = self.merge(meta)
+            if not count:
+                break
+            merged += count
+        self.close()
+
+        metrics.observe("index_build_seconds", time.perf_counter() - started)
+        logging.info(
+            f"Index {self.folder} was updated with {added} documents, "
+            f"{removed} documents not in the registry were removed, "
+            f"{merged} segments were merged"
+        )
+        return added
+
+    def write_segment(self, meta, batch, generation):
+        """
+        Writes documents as a new segment, registers it in meta.json and makes
+        its documents the live versions of their URLs.
+        Args:
+            meta (dict): Index metadata, updated in place.
+            batch (list): (id, url, fingerprint, text) tuples.
+            generation (int): Number of the build.
+        Return:
+            int: Number of written documents.
+        """
+        postings = {}
+        for number, (_, _, _, text) in enumerate(batch):
+            for position, token in enumerate(tokenize(text)):
+                postings.setdefault(token, {}).setdefault(number, []).append(position)
+
+        name = self.next_name(meta)
+        self.write_files(
+            os.path.join(self.folder, name), postings, [url for _, url, _, _ in batch]
+        )
+
+        meta["segments"].append(name)
+        self.save_meta(meta)
+        # Documents become live only after their segment is listed; a later
+        # version of a URL in the same batch replaces the earlier one.
+        with self.connect() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    (url, id, fingerprint, name, number, generation)
+                    for number, (id, url, fingerprint, _) in enumerate(batch)
+                ),
+            )
+        metrics.inc("index_documents_total", len(batch))
+        return len(batch)
+
+    @staticmethod
+    def next_name(meta):
+        numbers = [
+            int(name[len("seg_") :])
+            for name in meta["segments"]
+            if name.startswith("seg_")
+        ]
+        return f"seg_{max(numbers, default=-1) + 1:05d}"
+
+    @staticmethod
+    def write_files(path, postings, urls):
+        """
+        Writes the files of a segment.
+        Args:
+            path (str): Path of the segment without extension.
+            postings (dict): Term -> document number -> list of positions.
+            urls (list): URL of every document number.
+        """
+        terms, tix, post = bytearray(), bytearray(), bytearray()
+        for term in sorted(postings, key=lambda term: term.encode("utf-8")):
+            key = term.encode("utf-8")
+            if len(key) > 0xFFFF:
+                continue
+            data = bytearray()
+            docs = postings[term]
+            encode_varint(len(docs), data)
+            previous_doc = 0
+            for doc in sorted(docs):
+                encode_varint(doc - previous_doc, data)
+                previous_doc = doc
+                positions = docs[doc]
+                encode_varint(len(positions), data)
+                previous_position = 0
+                for position in positions:
+                    encode_varint(position - previous_position, data)
+                    previous_position = position
+            tix += TERM_ENTRY.pack(len(terms), len(key), len(post), len(data))
+            terms += key
+            post += data
+
+        for extension, content in ((".terms", terms), (".tix", tix), (".post", post)):
+            with open(path + extension, "wb") as file:
+                file.write(content)
+        with open(path + ".docs.json", "w", encoding="utf-8") as file:
+            json.dump(urls, file, ensure_ascii=False)
+
+    def merge(self, meta):
+        """
+        Merges the segments with the fewest live documents into one segment of
+        at most segment_docs documents, when there are more than merge_segments
+        segments. Only live documents are copied, so superseded versions are
+        dropped too. The merged segment is listed before its documents become
+        live, and the old segments are removed after that, so a crash leaves
+        segments without live documents, which the next build removes.
+        Args:
+            meta (dict): Index metadata, updated in place.
+        Return:
+            int: Number of merged segments.
+        """
+        if len(meta["segments"]) <= self.merge_segments:
+            return 0
+        connection = self.connect()
+        live = dict(
+            connection.execute(
+                "SELECT segment, COUNT(*) FROM documents GROUP BY segment"
+            )
+        )
+        chosen, total = set(), 0
+        for name in sorted(meta["segments"], key=lambda name: live.get(name, 0)):
+            if total + live.get(name, 0) > self.segment_docs:
+                break
+            chosen.add(name)
+            total += live.get(name, 0)
+        if len(chosen) < 2:
+            return 0
+        chosen = [name for name in meta["segments"] if name in chosen]
+
+        numbers, urls = {}, []
+        for old in chosen:
+            for number, url in connection.execute(
+                "SELECT number, url FROM documents WHERE segment = ? ORDER BY number",
+                (old,),
+            ):
+                numbers[old, number] = len(urls)
+                urls.append(url)
+        postings = {}
+        for old in chosen:
+            segment = Segment(os.path.join(self.folder, old))
+            try:
+                for term_number in range(segment.count):
+                    term = bytes(segment.term_at(term_number)).decode("utf-8")
+                    for doc, positions in segment.postings_at(term_number).items():
+                        if (old, doc) in numbers:
+                            postings.setdefault(term, {})[numbers[old, doc]] = positions
+            finally:
+                segment.close()
+
+        name = self.next_name(meta)
+        self.write_files(os.path.join(self.folder, name), postings, urls)
+        meta["segments"].append(name)
+        self.save_meta(meta)
+        with connection:
+            connection.executemany(
+                "UPDATE documents SET segment = ?, number = ? "
+                "WHERE segment = ? AND number = ?",
+                ((name, new, old, number) for (old, number), new in numbers.items()),
+            )
+        meta["segments"] = [name for name in meta["segments"] if name not in chosen]
+        self.save_meta(meta)
+        for old in chosen:
+            self.remove_segment(old)
+        metrics.inc("index_segments_merged_total", len(chosen))
+        return len(chosen)
+
+    def open(self):
+        if self.segments is None:
+            self.segments = [
+                Segment(os.path.join(self.folder, name))
+                for name in self.load_meta()["segments"]
+            ]
+        return self.segments
+
+    def close(self):
+        for segment in self.segments or []:
+            segment.close()
+        self.segments = None
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def live_ids(self, segment, numbers):
+        """
+        Returns the registry ids of the documents of a segment that are the live
+        versions of their URLs.
+        Args:
+            segment (Segment): Segment of the documents.
+            numbers (iterable): Document numbers.
+        Return:
+            dict: Document number -> registry id.
+        """
+        numbers = list(numbers)
+        ids = {}
+        for start in range(0, len(numbers), 500):
+            chunk = numbers[start : start + 500]
+            ids.update(
+                self.connect().execute(
+                    "SELECT number, id FROM documents WHERE segment = ? AND number "
+                    f"IN ({', '.join('?' * len(chunk))})",
+                    [segment.name] + chunk,
+                )
+            )
+        return ids
+
+    def search(self, query, limit=None):
+        """
+        Finds documents matching a query. Words are matched as terms and all of
+        them must occur in a document; words in double quotes must occur as a phrase.
+        Args:
+            query (str): Query, e.g. 'network "packet loss"'.
+            limit (int): Maximum number of results.
+        Return:
+            list: Dicts with id, url and matches (number of occurrences),
+                most matches first.
+        """
+        started = time.perf_counter()
+        phrases = [tokenize(phrase) for phrase in re.findall(r'"([^"]*)"', query)]
+        phrases += [[term] for term in tokenize(re.sub(r'"[^"]*"', " ", query))]
+        phrases = [phrase for phrase in phrases if phrase]
+        if not phrases:
+            return []
+
+        results = []
+        for segment in self.open():
+            matches = None
+            for phrase in phrases:
+                found = self.match_phrase(segment, phrase)
+                if matches is None:
+                    matches = found
+                else:
+                    matches = {
+                        doc: matches[doc] + found[doc]
+                        for doc in matches
+                        if doc in found
+                    }
+                if not matches:
+                    break
+            matches = matches or {}
+            ids = self.live_ids(segment, matches)
+            for doc, count in matches.items():
+                if doc in ids:
+                    results.append(
+                        {"id": ids[doc], "url": segment.docs[doc], "matches": count}
+                    )
+
+        results.sort(
+            key=lambda result: (
+                -result["matches"],
+                int(result["id"]) if result["id"].isdigit() else float("inf"),
+                result["url"],
+            )
+        )
+        metrics.observe("index_query_seconds", time.perf_counter() - started)
+        return results[:limit] if limit else results
+
+    @staticmethod
+    def match_phrase(segment, phrase):
+        """
+        Finds the documents of a segment containing a phrase.
+        Args:
+            segment (Segment): Segment to search.
+            phrase (list): Tokens of the phrase.
+        Return:
+            dict: Document number -> number of occurrences.
+        """
+        postings = segment.postings(phrase[0])
+        starts = {doc: set(positions) for doc, positions in postings.items()}
+        for offset, term in enumerate(phrase[1:], start=1):
+            if not starts:
+                break
+            postings = segment.postings(term)
+            next_starts = {}
+            for doc, positions in starts.items():
+                if doc in postings:
+                    following = set(postings[doc])
+                    kept = {start for start in positions if start + offset in following}
+                    if kept:
+                        next_starts[doc] = kept
+            starts = next_starts
+        return {doc: len(positions) for doc, positions in starts.items()}
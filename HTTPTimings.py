@@ -0,0 +1,125 @@
+import socket
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from urllib3.util.connection import allowed_gai_family
+
+from config import *
+from Metrics import metrics
+
+# DNS and connect time of the connections opened by the current thread since
+# start_request, so the caller can tell them apart from the time to first byte.
+phases = threading.local()
+
+
+def start_request():
+    """
+    Starts collecting the phases of a request made by the current thread.
+    """
+    phases.dns = phases.connect = 0.0
+
+
+def request_phases():
+    """
+    Return:
+        tuple: DNS and connect time in seconds of the connections opened by the
+            current thread since start_request, 0 for a reused connection.
+    """
+    return getattr(phases, "dns", 0.0), getattr(phases, "connect", 0.0)
+
+
+class TimedConnection:
+    """
+    Connection that resolves the host itself, so the DNS lookup and the TCP
+    connect (with the TLS handshake for HTTPS) are timed separately and exported
+    as download_dns_seconds and download_connect_seconds.
+    """
+
+    def _new_conn(self):
+        host = self._dns_host
+        started = time.perf_counter()
+        try:
+            addresses = socket.getaddrinfo(
+                host, self.port, allowed_gai_family(), socket.SOCK_STREAM
+            )
+        except socket.gaierror:
+            # urllib3 resolves the host again and reports the error its own way.
+            return super()._new_conn()
+        self.dns_seconds = time.perf_counter() - started
+        metrics.observe("download_dns_seconds", self.dns_seconds, host=self.host)
+        phases.dns = getattr(phases, "dns", 0.0) + self.dns_seconds
+
+        # Addresses are tried in order, like socket.create_connection does.
+        error = None
+        try:
+            for *_, address in addresses:
+                self._dns_host = address[0]
+                try:
+                    return super()._new_conn()
+                except (ConnectTimeoutError, NewConnectionError) as exception:
+                    error = exception
+            raise error
+        finally:
+            self._dns_host = host
+
+    def connect(self):
+        self.dns_seconds = 0.0
+        started = time.perf_counter()
+        super().connect()
+        seconds = time.perf_counter() - started - self.dns_seconds
+        metrics.observe("download_connect_seconds", seconds, host=self.host)
+        phases.connect = getattr(phases, "connect", 0.0) + seconds
+
+
+class TimedHTTPConnection(TimedConnection, HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(TimedConnection, HTTPSConnection):
+    pass
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """
+    Adapter whose connection pools open TimedConnection connections.
+    Requests through a proxy use the usual connections and aren't timed.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": TimedHTTPConnectionPool,
+            "https": TimedHTTPSConnectionPool,
+        }
+
+
+def timed_session(pool_connections=100, pool_maxsize=None):
+    """
+    Creates a session that keeps connections alive and times their phases.
+    Args:
+        pool_connections (int): Number of hosts whose connections are kept.
+        pool_maxsize (int): Connections kept per host, CONCURRENCY_MAX by default.
+    Return:
+        requests.Session: The session.
+    """
+    session = requests.Session()
+    adapter = TimedHTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize or CONCURRENCY_MAX,
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
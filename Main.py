@@ -1,52 +1,226 @@
+import argparse
 import sys
 from Reader import Reader
-from URLProcessing import *
-from DownloadContent import *
-from ProcessingDownloadContent import *
-from FormingResultsRegistry import *
+from URLProcessing import URLProcessing
+from DownloadContent import DownloadContent
+from ProcessingDownloadContent import ProcessingDownloadContent
+from FormingResultsRegistry import FormingResultsRegistry
+from Metrics import metrics
+from Checkpoint import Checkpoint
+from AdaptiveConcurrency import AdaptiveConcurrency
+from RecrawlScheduler import RecrawlScheduler
+from CrawlFrontier import CrawlFrontier
+from config import PIPELINE_BATCH_SIZE, setup_logging
+
+
+def run_batch(
+    urls, checkpoint, concurrency, session, processing, keep_files, selected=None
+):
+    """
+    Checks, downloads and processes one batch of clean URLs, so only the URLs
+    of the batch are kept in memory. Their registry rows must be written already.
+    Args:
+        urls (list): Clean URLs of the batch.
+        checkpoint (Checkpoint): Progress of the run.
+        concurrency (AdaptiveConcurrency): Controller of requests in flight.
+        session (requests.Session): Session shared by the requests of all batches.
+        processing (ProcessingDownloadContent): Processing shared by all batches.
+        keep_files (bool): Whether the raw and processed files of the earlier
+            batches are kept; the first batch of a new run starts with empty folders.
+        selected (dict): URL -> priority of the recrawl budget, or None.
+    """
+    urlProcessing = URLProcessing(
+        checkpoint=checkpoint, concurrency=concurrency, session=session
+    )
+    with metrics.stage("html_or_pdf"):
+        urls_html, urls_pdf = urlProcessing.html_or_pdf(urls)
+    checkpoint.flush()
+    if selected is not None:
+        urls_html = RecrawlScheduler.order(urls_html, selected)
+        urls_pdf = RecrawlScheduler.order(urls_pdf, selected)
+
+    downloadContent = DownloadContent(
+        urls_html, urls_pdf, checkpoint, concurrency, session, keep_files=keep_files
+    )
+    with metrics.stage("download_pdf"):
+        downloadContent.download_files_request()
+        # downloadContent.download_files_wget()
+
+    with metrics.stage("download_html"):
+        downloadContent.download_html_request()
+        # downloadContent.download_html_requestsHTMLsession()
+    checkpoint.flush()
+
+    # Ids of the new URLs are read from the registry again by the sink.
+    processing.url_ids = None
+    processing.keep_files = keep_files
+    with metrics.stage("process_pdf"):
+        processing.processing_pdf()
+    with metrics.stage("process_html"):
+        processing.processing_html()
+    checkpoint.flush()
+
+
+def crawl(frontier, registry, checkpoint, concurrency, session, processing):
+    """
+    Crawls the URLs discovered by following links, one round per depth, until
+    the frontier is empty. Every round appends its URLs to the registry with new
+    ids and checks, downloads and processes them in batches like the input URLs;
+    the other registry columns of all rounds are filled in afterwards from
+    analytics.log.
+    Args:
+        frontier (CrawlFrontier): Frontier filled by processing of the input pages.
+        registry (FormingResultsRegistry): Registry of the run.
+        checkpoint (Checkpoint): Progress of the run.
+        concurrency (AdaptiveConcurrency): Controller of requests in flight.
+        session (requests.Session): Session shared by the requests of all batches.
+        processing (ProcessingDownloadContent): Processing that adds links to the frontier.
+    """
+    while len(frontier):
+        start = registry.get_max_id() + 1
+        records = (
+            (id, url, url, "clean_url")
+            for id, url in enumerate(frontier.drain(), start=start)
+        )
+        for batch in Reader.batches(records, PIPELINE_BATCH_SIZE):
+            urls = list(registry.add_cleaned_records(batch))
+            # Rounds keep the raw and processed files of the input and earlier rounds.
+            run_batch(
+                urls, checkpoint, concurrency, session, processing, keep_files=True
+            )
+
+
+def seed(frontier, records):
+    """
+    Adds the clean URLs of the input to the frontier as they pass.
+    Args:
+        frontier (CrawlFrontier): Frontier of the crawl.
+        records (iterable): (id, source_url, url, status) tuples.
+    Return:
+        generator of tuple: The same records.
+    """
+    for record in records:
+        if record[3] in ("clean_url", "not_scheduled"):
+            frontier.add_seed(record[2])
+        yield record
 
 
 def main():
-    if len(sys.argv) == 2:
+    parser = argparse.ArgumentParser(
+        description="Download and process URLs from a CSV file."
+    )
+    parser.add_argument("filename", nargs="?")
+    Reader.add_arguments(parser)
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue an interrupted run, skipping work recorded in the checkpoint",
+    )
+    parser.add_argument(
+        "--recrawl-budget",
+        type=int,
+        help="crawl only this many URLs, those most likely to have changed",
+    )
+    parser.add_argument(
+        "--crawl-depth",
+        type=int,
+        default=0,
+        help="also crawl pages and documents linked from the input pages, up to this many links deep",
+    )
+    args = parser.parse_args()
+    setup_logging(append=args.resume)
+
+    if args.filename:
         reader = Reader()
-        try:
-            urls = reader.read_file(sys.argv[1])
-        except Exception as error:
-            print(f"Error: {error}")
+        options = Reader.options(args.column, args.header, args.delimiter)
+        checkpoint = Checkpoint()
+        if args.resume:
+            checkpoint.load()
+        else:
+            checkpoint.reset()
+        concurrency = AdaptiveConcurrency()
+        scheduler = RecrawlScheduler().load()
+        selected = None
+        frontier = None
+        if args.crawl_depth > 0:
+            frontier = CrawlFrontier(args.crawl_depth)
 
+        metrics.start()
         try:
-            formingResultsRegistry = FormingResultsRegistry()
-            formingResultsRegistry.create_results_registry_csv()
-            formingResultsRegistry.add_source_url(urls)
+            from HTTPTimings import timed_session
 
-            urlProcessing = URLProcessing()
-            new_urls = urlProcessing.cleaner(urls)
+            session = timed_session()
+            records = reader.iter_records(args.filename, **options)
 
-            urls_html, urls_pdf = urlProcessing.html_or_pdf(new_urls)
-            formingResultsRegistry.add_processing_info_from_check()
-
-            downloadContent = DownloadContent(urls_html, urls_pdf)
-            downloadContent.download_files_request()
-            # downloadContent.download_files_wget()
-
-            downloadContent.download_html_request()
-            # downloadContent.download_html_requestsHTMLsession()
-            formingResultsRegistry.add_download_info()
+            formingResultsRegistry = FormingResultsRegistry()
+            formingResultsRegistry.create_results_registry_csv()
 
-            processingDownloadContent = ProcessingDownloadContent()
-            processingDownloadContent.processing_pdf()
-            processingDownloadContent.processing_html()
+            urlProcessing = URLProcessing(
+                checkpoint=checkpoint, concurrency=concurrency, session=session
+            )
+            cleaned = urlProcessing.iter_cleaner(records)
+            if args.recrawl_budget is not None:
+                # The input is read twice, so only the chosen URLs are kept in memory.
+                selected = scheduler.select(
+                    (
+                        url
+                        for _, _, url, status in urlProcessing.iter_cleaner(
+                            reader.iter_records(args.filename, **options)
+                        )
+                        if status == "clean_url"
+                    ),
+                    args.recrawl_budget,
+                )
+                cleaned = scheduler.schedule(cleaned, selected)
+            if frontier is not None:
+                cleaned = seed(frontier, cleaned)
+            processingDownloadContent = ProcessingDownloadContent(checkpoint, frontier)
+            # Rows of a batch are written to the registry before its URLs are
+            # checked, so the sink finds their ids.
+            for number, batch in enumerate(
+                Reader.batches(cleaned, PIPELINE_BATCH_SIZE), start=1
+            ):
+                run_batch(
+                    list(formingResultsRegistry.add_cleaned_records(batch)),
+                    checkpoint,
+                    concurrency,
+                    session,
+                    processingDownloadContent,
+                    number > 1,
+                    selected,
+                )
+            scheduler.observe_checkpoint(checkpoint)
+            scheduler.save()
 
-            formingResultsRegistry.add_processed_info()
-            formingResultsRegistry.add_other()
+            if frontier is not None:
+                crawl(
+                    frontier,
+                    formingResultsRegistry,
+                    checkpoint,
+                    concurrency,
+                    session,
+                    processingDownloadContent,
+                )
 
-            formingResultsRegistry.registry_sort()
+            # The registry is updated once for all batches and crawl rounds: its
+            # log-driven updates would overwrite the rows of earlier ones.
+            with metrics.stage("registry_build"):
+                formingResultsRegistry.add_processing_info_from_check()
+                formingResultsRegistry.add_download_info()
+                formingResultsRegistry.add_processed_info()
+                formingResultsRegistry.add_other()
+                formingResultsRegistry.registry_sort()
 
         except Exception as error:
             print(f"Error: {error}")
+            sys.exit(1)
+        finally:
+            checkpoint.flush()
+            metrics.stop()
 
     else:
         print("Error: Enter filename")
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,448 @@
+import cProfile
+import json
+import logging
+import os
+import pstats
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from functools import wraps
+
+from config import *
+
+
+class Histogram:
+    """
+    Cumulative latency histogram with fixed bucket bounds (in seconds).
+    Attributes:
+        bounds (list): Upper bounds of the buckets.
+        counts (list): Number of observations per bucket, the last one is +Inf.
+        total (float): Sum of all observed values.
+        count (int): Number of observations.
+    """
+
+    BOUNDS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+    def __init__(self):
+        self.bounds = self.BOUNDS
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, fraction):
+        """
+        Estimates a quantile as the upper bound of the bucket that contains it.
+        Args:
+            fraction (float): Quantile as a fraction, e.g. 0.99.
+        Return:
+            float: Estimated value, None if nothing was observed.
+        """
+        if self.count == 0:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for i, bucket in enumerate(self.counts[:-1]):
+            seen += bucket
+            if seen >= rank:
+                return self.bounds[i]
+        return float("inf")
+
+
+class Metrics:
+    """
+    Process-wide store of counters, gauges and latency histograms.
+    Every metric is identified by its name and a set of labels (stage, host, ...).
+    The store is periodically flushed to a JSON file and a Prometheus text file.
+    Stages can be profiled with cProfile or a sampling profiler, enabled with
+    the WEBDATAPARSER_PROFILE environment variable.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.started = time.time()
+        self.flush_thread = None
+        self.flush_lock = threading.Lock()
+        self.umask = os.umask(0)
+        os.umask(self.umask)
+        self.stop_event = threading.Event()
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        """
+        Increments a counter.
+        Args:
+            name (str): Name of the counter.
+            value (int): Increment.
+            **labels: Labels of the counter.
+        """
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        """
+        Sets a gauge to the given value.
+        Args:
+            name (str): Name of the gauge.
+            value (float): New value.
+            **labels: Labels of the gauge.
+        """
+        key = self.key(name, labels)
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        """
+        Adds an observation to a histogram.
+        Args:
+            name (str): Name of the histogram.
+            value (float): Observed value in seconds.
+            **labels: Labels of the histogram.
+        """
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Context manager that observes the duration of its block.
+        Args:
+            name (str): Name of the histogram.
+            **labels: Labels of the histogram.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def timed(self, name, **labels):
+        """
+        Decorator that observes the duration of every call of the function.
+        Args:
+            name (str): Name of the histogram.
+            **labels: Labels of the histogram.
+        """
+
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return function(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager for a whole pipeline stage: observes its duration and
+        runs the profiler if profiling is enabled for the stage.
+        Args:
+            name (str): Name of the stage.
+        """
+        self.set_gauge("stage_running", 1, stage=name)
+        try:
+            with self.profile(name), self.timer("stage_seconds", stage=name):
+                yield
+        finally:
+            self.set_gauge("stage_running", 0, stage=name)
+            try:
+                self.flush()
+            except OSError as error:
+                logging.warning(f"Metrics weren't flushed. Error: {error}")
+
+    @contextmanager
+    def profile(self, stage):
+        """
+        Profiles the block if the stage is listed in WEBDATAPARSER_PROFILE
+        (comma-separated stage names or 'all'). WEBDATAPARSER_PROFILER selects
+        'cprofile' (default, writes profiles/<stage>.prof) or 'sampling'
+        (writes collapsed stacks to profiles/<stage>.folded).
+        Args:
+            stage (str): Name of the stage.
+        """
+        enabled = os.environ.get("WEBDATAPARSER_PROFILE", "")
+        stages = {name.strip() for name in enabled.split(",") if name.strip()}
+        if stage not in stages and "all" not in stages:
+            yield
+            return
+
+        os.makedirs(PROFILE_FOLDER, exist_ok=True)
+        profiler = os.environ.get("WEBDATAPARSER_PROFILER", "cprofile")
+        if profiler == "sampling":
+            sampler = SamplingProfiler()
+            sampler.start()
+            try:
+                yield
+            finally:
+                sampler.stop()
+                sampler.dump(os.path.join(PROFILE_FOLDER, f"{stage}.folded"))
+        else:
+            profiler = ThreadProfiler()
+            profiler.start()
+            try:
+                yield
+            finally:
+                profiler.stop()
+                profiler.dump(os.path.join(PROFILE_FOLDER, f"{stage}.prof"))
+
+    def snapshot(self):
+        """
+        Returns a consistent copy of all metrics.
+        Return:
+            dict: Counters, gauges and histograms as JSON-serializable lists.
+        """
+        with self.lock:
+            counters = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self.counters.items())
+            ]
+            gauges = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self.gauges.items())
+            ]
+            histograms = [
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": histogram.count,
+                    "sum": histogram.total,
+                    "p50": histogram.quantile(0.50),
+                    "p99": histogram.quantile(0.99),
+                    "buckets": dict(
+                        zip(
+                            [str(b) for b in histogram.bounds] + ["+Inf"],
+                            histogram.counts,
+                        )
+                    ),
+                }
+                for (name, labels), histogram in sorted(
+                    self.histograms.items(), key=lambda item: item[0]
+                )
+            ]
+        return {
+            "timestamp": time.time(),
+            "uptime_seconds": time.time() - self.started,
+            "counters": counters,
+            "gauges": gauges,
+            "histograms": histograms,
+        }
+
+    def to_prometheus(self, snapshot):
+        """
+        Formats a snapshot in the Prometheus text exposition format.
+        Args:
+            snapshot (dict): Result of snapshot().
+        Return:
+            str: Metrics in Prometheus text format.
+        """
+
+        def labels_text(labels, extra=None):
+            items = list(labels.items()) + list((extra or {}).items())
+            if not items:
+                return ""
+            escaped = []
+            for key, value in items:
+                value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+                escaped.append(f'{key}="{value}"')
+            return "{" + ",".join(escaped) + "}"
+
+        lines = []
+        typed = set()
+        for kind, prom_type in (("counters", "counter"), ("gauges", "gauge")):
+            for metric in snapshot[kind]:
+                name = f"webdataparser_{metric['name']}"
+                if name not in typed:
+                    lines.append(f"# TYPE {name} {prom_type}")
+                    typed.add(name)
+                lines.append(f"{name}{labels_text(metric['labels'])} {metric['value']}")
+        for metric in snapshot["histograms"]:
+            name = f"webdataparser_{metric['name']}"
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for bound, count in metric["buckets"].items():
+                cumulative += count
+                lines.append(
+                    f"{name}_bucket{labels_text(metric['labels'], {'le': bound})} {cumulative}"
+                )
+            lines.append(f"{name}_sum{labels_text(metric['labels'])} {metric['sum']}")
+            lines.append(
+                f"{name}_count{labels_text(metric['labels'])} {metric['count']}"
+            )
+        return "\n".join(lines) + "\n"
+
+    def flush(self):
+        """
+        Writes the current metrics to METRICS_FILE and METRICS_PROMETHEUS_FILE.
+        Files are replaced atomically so readers never see a partial write, and
+        flushes of the stages and of the background thread don't interleave.
+        """
+        with self.flush_lock:
+            snapshot = self.snapshot()
+            for path, text in (
+                (METRICS_FILE, json.dumps(snapshot, indent=1)),
+                (METRICS_PROMETHEUS_FILE, self.to_prometheus(snapshot)),
+            ):
+                descriptor, temp_path = tempfile.mkstemp(
+                    prefix=os.path.basename(path) + ".",
+                    suffix=".tmp",
+                    dir=os.path.dirname(path) or ".",
+                )
+                try:
+                    with os.fdopen(descriptor, "w") as file:
+                        file.write(text)
+                    # mkstemp creates files readable by the owner only.
+                    os.chmod(temp_path, 0o666 & ~self.umask)
+                    os.replace(temp_path, path)
+                except BaseException:
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
+                    raise
+
+    def start(self, interval=None):
+        """
+        Starts a background thread that flushes the metrics periodically.
+        Args:
+            interval (float): Seconds between flushes, METRICS_FLUSH_INTERVAL by default.
+        """
+        if self.flush_thread is not None:
+            return
+        interval = interval or METRICS_FLUSH_INTERVAL
+        self.stop_event.clear()
+
+        def loop():
+            while not self.stop_event.wait(interval):
+                try:
+                    self.flush()
+                except OSError as error:
+                    logging.warning(f"Metrics weren't flushed. Error: {error}")
+
+        self.flush_thread = threading.Thread(target=loop, daemon=True)
+        self.flush_thread.start()
+
+    def stop(self):
+        """
+        Stops the background flush thread and writes the final metrics.
+        """
+        if self.flush_thread is not None:
+            self.stop_event.set()
+            self.flush_thread.join()
+            self.flush_thread = None
+        self.flush()
+
+
+class ThreadProfiler:
+    """
+    cProfile of a block that also covers the threads it starts, e.g. the
+    workers of the thread pools of a stage. Before Python 3.12 a
+    cProfile.Profile sees only the thread that enabled it, so every thread
+    started while the profiler runs gets its own profile, and the profiles are
+    merged when they are dumped. Since Python 3.12 one profile sees every thread.
+    Attributes:
+        profiles (list): Profiles of the calling thread and of the started threads.
+    """
+
+    PER_THREAD = sys.version_info < (3, 12)
+
+    def __init__(self):
+        self.profiles = [cProfile.Profile()]
+        self.lock = threading.Lock()
+
+    def profile_thread(self, frame, event, arg):
+        # First event of a new thread: its own profile replaces this hook.
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        profile.enable()
+
+    def start(self):
+        if self.PER_THREAD:
+            threading.setprofile(self.profile_thread)
+        self.profiles[0].enable()
+
+    def stop(self):
+        self.profiles[0].disable()
+        if self.PER_THREAD:
+            threading.setprofile(None)
+
+    def dump(self, path):
+        with self.lock:
+            profiles = list(self.profiles)
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(path)
+
+
+class SamplingProfiler:
+    """
+    Low-overhead profiler that periodically samples the stacks of all threads
+    and counts them in the collapsed format used by flame graph tools.
+    Attributes:
+        interval (float): Seconds between samples.
+        stacks (dict): Mapping of collapsed stack to number of samples.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = {}
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def sample(self):
+        own = threading.get_ident()
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own:
+                continue
+            stack = ";".join(
+                f"{os.path.basename(entry.filename)}:{entry.name}"
+                for entry in traceback.extract_stack(frame)
+            )
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def start(self):
+        def loop():
+            while not self.stop_event.wait(self.interval):
+                self.sample()
+
+        self.thread = threading.Thread(target=loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def dump(self, path):
+        with open(path, "w") as file:
+            for stack, count in sorted(self.stacks.items()):
+                file.write(f"{stack} {count}\n")
+
+
+metrics = Metrics()
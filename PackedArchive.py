@@ -0,0 +1,500 @@
+import codecs
+import json
+import mmap
+import os
+import shutil
+import threading
+import uuid
+import zlib
+from datetime import datetime, timezone
+
+from config import *
+
+
+class ArchiveRecord:
+    """
+    One response stored in a packed archive.
+    Attributes:
+        locator (str): 'container#offset' address of the record.
+        headers (dict): WARC headers of the record.
+        http_headers (str): Status line and headers of the HTTP response.
+        body (memoryview): Body of the HTTP response, a view of the
+            decompressed record, so the body isn't copied.
+        length (int): Compressed size of the record in the container, set by
+            PackedArchive.scan, otherwise None.
+    """
+
+    def __init__(self, locator, headers, http_headers, body):
+        self.locator = locator
+        self.headers = headers
+        self.http_headers = http_headers
+        self.body = body
+        self.length = None
+
+    @property
+    def url(self):
+        return self.headers.get("WARC-Target-URI")
+
+    @property
+    def name(self):
+        return self.headers.get("WebDataParser-Name")
+
+    def text(self):
+        """
+        Decodes the body with the encoding of the response.
+        Return:
+            str: Text of the body.
+        """
+        encoding = self.headers.get("WebDataParser-Encoding") or "utf-8"
+        try:
+            return str(self.body, encoding, errors="replace")
+        except LookupError:
+            return str(self.body, "utf-8", errors="replace")
+
+
+class ArchiveStream(ArchiveRecord):
+    """
+    Record of a packed archive opened for reading in parts: only the WARC and
+    HTTP headers are decompressed when it is opened, the body is decompressed
+    from the container while it is read, so it is never held in memory whole.
+    The body can be read once; the container is closed after it.
+    Attributes:
+        size (int): Size of the body in bytes.
+    """
+
+    def __init__(self, locator, chunk_size=65536):
+        container, offset = locator.rsplit("#", 1)
+        self.chunk_size = chunk_size
+        self.decompressor = zlib.decompressobj(wbits=31)
+        self.file = open(container, "rb")
+        try:
+            self.file.seek(int(offset))
+            data = bytearray()
+            end = separator = -1
+            while separator == -1:
+                chunk = self.decompress()
+                if not chunk:
+                    raise ValueError(f"Record {locator} is truncated")
+                data += chunk
+                if end == -1:
+                    end = data.find(b"\r\n\r\n")
+                if end != -1:
+                    separator = data.find(b"\r\n\r\n", end + 4)
+        except Exception:
+            self.file.close()
+            raise
+        headers = PackedArchive.parse_headers(data[:end])
+        super().__init__(
+            locator, headers, bytes(data[end + 4 : separator]).decode("latin-1"), None
+        )
+        # Content-Length covers the HTTP headers and the body.
+        self.size = int(headers.get("Content-Length", 0)) - (separator - end)
+        self.pending = bytes(data[separator + 4 :])
+
+    def decompress(self):
+        """
+        Decompresses the next part of the record, at most chunk_size bytes.
+        Return:
+            bytes: Part of the record, empty at its end.
+        Raises:
+            ValueError: If the container ends before the record.
+        """
+        while not self.decompressor.eof:
+            data = self.decompressor.unconsumed_tail or self.file.read(self.chunk_size)
+            if not data:
+                raise ValueError(f"Record {self.locator} is truncated")
+            output = self.decompressor.decompress(data, self.chunk_size)
+            if output:
+                return output
+        return b""
+
+    def close(self):
+        self.file.close()
+
+    def text(self):
+        return "".join(self.iter_text())
+
+    def iter_text(self, chunk_size=None):
+        """
+        Decodes the body with the encoding of the response, in parts.
+        Args:
+            chunk_size (int): Maximum number of bytes decompressed at once.
+        Return:
+            generator of str: Consecutive parts of the text.
+        """
+        self.chunk_size = chunk_size or self.chunk_size
+        encoding = self.headers.get("WebDataParser-Encoding") or "utf-8"
+        try:
+            decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+        except LookupError:
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        remaining = self.size
+        data, self.pending = self.pending, b""
+        try:
+            while remaining > 0:
+                if not data:
+                    data = self.decompress()
+                    if not data:
+                        break
+                part = data[:remaining]
+                remaining -= len(part)
+                data = b""
+                yield decoder.decode(part)
+            yield decoder.decode(b"", final=True)
+        finally:
+            self.close()
+
+
+class PackedArchive:
+    """
+    WARC-like storage of raw downloads: responses are appended to rolling,
+    size-capped container files instead of being saved one file per URL.
+    Every record is a separate gzip member, so a record can be read by random
+    access from its offset and a container can be scanned sequentially.
+    The offset of every record is kept in index.jsonl next to the containers,
+    which is synced to disk together with the container it points to, and records are addressed by 'container#offset' locators, which are used as
+    raw file paths in the log, the checkpoint and the registry.
+    Attributes:
+        folder (str): Folder with the containers and the index.
+        max_size (int): Size of a container after which a new one is started.
+    """
+
+    INDEX_FILE = "index.jsonl"
+
+    def __init__(self, folder, max_size=None):
+        self.folder = folder
+        self.max_size = max_size or ARCHIVE_MAX_SIZE
+        self.lock = threading.Lock()
+        self.file = None
+        self.index = None
+        self.container = None
+        self.number = None
+
+    @staticmethod
+    def folder_for(raw_folder):
+        """
+        Returns the archive folder that replaces a raw downloads folder,
+        e.g. raw_archive/documents/ for raw_downloads/documents/ and
+        batches/1/raw_archive/pages/ for batches/1/raw_downloads/pages/.
+        Args:
+            raw_folder (str): Raw downloads folder.
+        Return:
+            str: Archive folder.
+        """
+        raw_folder = raw_folder.rstrip("/")
+        return os.path.join(
+            os.path.dirname(os.path.dirname(raw_folder)),
+            ARCHIVE_FOLDER,
+            os.path.basename(raw_folder),
+        )
+
+    @staticmethod
+    def is_locator(path):
+        return "#" in path and path.split("#", 1)[1].isdigit()
+
+    def index_path(self):
+        return os.path.join(self.folder, self.INDEX_FILE)
+
+    def containers(self):
+        if not os.path.isdir(self.folder):
+            return []
+        return sorted(
+            os.path.join(self.folder, name)
+            for name in os.listdir(self.folder)
+            if name.startswith("archive_") and name.endswith(".warc.gz")
+        )
+
+    def reset(self):
+        """
+        Starts a new archive: removes the containers and the index of the previous run.
+        """
+        if os.path.exists(self.folder):
+            shutil.rmtree(self.folder)
+        os.makedirs(self.folder)
+
+    def open(self):
+        """
+        Opens the archive for writing. Records are appended to a new container,
+        so a container left truncated by a crash is never written again.
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        numbers = [
+            int(os.path.basename(container)[len("archive_") : -len(".warc.gz")])
+            for container in self.containers()
+        ]
+        self.number = max(numbers, default=-1)
+        self.index = open(self.index_path(), "a", encoding="utf-8")
+        self.roll()
+
+    def sync(self):
+        # The container goes first, so the index never points at unsynced records.
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.index.flush()
+        os.fsync(self.index.fileno())
+
+    def roll(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+        self.number += 1
+        self.container = os.path.join(self.folder, f"archive_{self.number:05d}.warc.gz")
+        self.file = open(self.container, "ab")
+
+    def close(self):
+        """
+        Syncs and closes the current container and the index.
+        """
+        with self.lock:
+            if self.file is not None:
+                self.sync()
+                self.file.close()
+                self.index.close()
+                self.file = None
+                self.index = None
+
+    def append(self, url, response, content, name):
+        """
+        Appends a response to the archive.
+        Args:
+            url (str): Requested URL.
+            response (requests.Response): Response, its status line and headers are stored.
+            content (bytes): Body of the response.
+            name (str): File name the response would have in raw_downloads/,
+                used to name the processed file.
+        Return:
+            str: Locator of the record.
+        """
+        http_headers = (
+            f"HTTP/1.1 {response.status_code} {response.reason}\r\n"
+            + "".join(f"{key}: {value}\r\n" for key, value in response.headers.items())
+        )
+        http_block = http_headers.encode("latin-1", errors="replace") + b"\r\n"
+        headers = {
+            "WARC-Type": "response",
+            "WARC-Target-URI": url,
+            "WARC-Date": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "WARC-Record-ID": f"<urn:uuid:{uuid.uuid4()}>",
+            "Content-Type": "application/http; msgtype=response",
+            "Content-Length": str(len(http_block) + len(content)),
+            "WebDataParser-Name": name,
+            # The encoding response.text decodes with in the files mode.
+            "WebDataParser-Encoding": response.encoding
+            or response.apparent_encoding
+            or "",
+        }
+        record = (
+            "WARC/1.0\r\n"
+            + "".join(f"{key}: {value}\r\n" for key, value in headers.items())
+            + "\r\n"
+        ).encode("utf-8")
+        # Parts are compressed one by one, so the body isn't copied into the record.
+        member = zlib.compressobj(wbits=31)
+        data = b"".join(
+            [
+                member.compress(record),
+                member.compress(http_block),
+                member.compress(content),
+                member.compress(b"\r\n\r\n"),
+                member.flush(),
+            ]
+        )
+
+        with self.lock:
+            if self.file is None:
+                raise ValueError(f"Archive {self.folder} is not open")
+            if self.file.tell() > 0 and self.file.tell() + len(data) > self.max_size:
+                self.roll()
+            offset = self.file.tell()
+            self.file.write(data)
+            self.file.flush()
+            locator = f"{self.container}#{offset}"
+            self.index.write(
+                json.dumps(
+                    {
+                        "url": url,
+                        "name": name,
+                        "path": locator,
+                        "length": len(data),
+                        "size": len(content),
+                    },
+                    ensure_ascii=False,
+                )
+                + "\n"
+            )
+            self.index.flush()
+        return locator
+
+    def records(self):
+        """
+        Reads the index of the archive. A truncated last line is ignored.
+        Return:
+            list: Index entries (url, name, path, length, size) in write order.
+        """
+        if not os.path.exists(self.index_path()):
+            return []
+        entries = []
+        with open(self.index_path(), "r", encoding="utf-8") as index:
+            for line in index:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue
+        return entries
+
+    def next_index(self):
+        """
+        Returns the first index to prefix names of new records with.
+        """
+        indexes = [
+            int(entry["name"].split("_", 1)[0])
+            for entry in self.records()
+            if entry["name"].split("_", 1)[0].isdigit()
+        ]
+        return max(indexes, default=-1) + 1
+
+    @staticmethod
+    def parse_headers(block):
+        """
+        Parses the WARC version line and headers of a record.
+        Args:
+            block (bytes-like): Headers without the empty line after them.
+        Return:
+            dict: Header -> value.
+        """
+        headers = {}
+        for line in bytes(block).decode("utf-8").split("\r\n")[1:]:
+            key, _, value = line.partition(": ")
+            headers[key] = value
+        return headers
+
+    @staticmethod
+    def parse(locator, data):
+        """
+        Parses an uncompressed record.
+        Args:
+            locator (str): Locator of the record.
+            data (bytearray): Uncompressed record, the body is a view of it.
+        Return:
+            ArchiveRecord: Parsed record.
+        """
+        view = memoryview(data)
+        end = data.find(b"\r\n\r\n")
+        if end == -1:
+            end = len(data)
+        headers = PackedArchive.parse_headers(view[:end])
+        start = min(end + 4, len(data))
+        block_end = min(
+            len(data), start + int(headers.get("Content-Length", len(data) - start))
+        )
+        separator = data.find(b"\r\n\r\n", start, block_end)
+        if separator == -1:
+            http_headers, body = view[start:block_end], view[block_end:block_end]
+        else:
+            http_headers, body = view[start:separator], view[separator + 4 : block_end]
+        return ArchiveRecord(
+            locator, headers, bytes(http_headers).decode("latin-1"), body
+        )
+
+    @staticmethod
+    def read(locator):
+        """
+        Reads one record by random access. The record is decompressed into one
+        buffer, which holds the only copy of the body.
+        Args:
+            locator (str): 'container#offset' locator of the record.
+        Return:
+            ArchiveRecord: The record.
+        Raises:
+            ValueError: If the locator doesn't point at a complete record.
+        """
+        container, offset = locator.rsplit("#", 1)
+        decompressor = zlib.decompressobj(wbits=31)
+        data = bytearray()
+        with open(container, "rb") as file:
+            file.seek(int(offset))
+            while not decompressor.eof:
+                chunk = file.read(65536)
+                if not chunk:
+                    raise ValueError(f"Record {locator} is truncated")
+                data += decompressor.decompress(chunk)
+        return PackedArchive.parse(locator, data)
+
+    @staticmethod
+    def stream(locator, chunk_size=65536):
+        """
+        Opens one record by random access for reading its body in parts.
+        Args:
+            locator (str): 'container#offset' locator of the record.
+            chunk_size (int): Maximum number of bytes decompressed at once.
+        Return:
+            ArchiveStream: The record with its headers read.
+        Raises:
+            ValueError: If the locator doesn't point at a complete record.
+        """
+        return ArchiveStream(locator, chunk_size)
+
+    def scan(self, container):
+        """
+        Reads all records of a container sequentially through a memory map.
+        A record truncated by a crash ends the scan.
+        Args:
+            container (str): Path of the container.
+        Return:
+            generator of ArchiveRecord: Records in write order.
+        """
+        if os.path.getsize(container) == 0:
+            return
+        with open(container, "rb") as file, mmap.mmap(
+            file.fileno(), 0, access=mmap.ACCESS_READ
+        ) as data:
+            offset = 0
+            while offset < len(data):
+                decompressor = zlib.decompressobj(wbits=31)
+                record, position = bytearray(), offset
+                try:
+                    while not decompressor.eof and position < len(data):
+                        chunk = data[position : position + 65536]
+                        position += len(chunk)
+                        record += decompressor.decompress(chunk)
+                except zlib.error:
+                    logging.warning(
+                        f"Archive {container}. Error: broken record at {offset}"
+                    )
+                    return
+                if not decompressor.eof:
+                    logging.warning(
+                        f"Archive {container}. Error: truncated record at {offset}"
+                    )
+                    return
+                end = position - len(decompressor.unused_data)
+                parsed = self.parse(f"{container}#{offset}", record)
+                parsed.length = end - offset
+                yield parsed
+                offset = end
+
+    def rebuild_index(self):
+        """
+        Rebuilds index.jsonl by scanning all containers, e.g. after the index was lost.
+        """
+        temp_path = self.index_path() + ".temp"
+        with open(temp_path, "w", encoding="utf-8") as index:
+            for container in self.containers():
+                for record in self.scan(container):
+                    index.write(
+                        json.dumps(
+                            {
+                                "url": record.url,
+                                "name": record.name,
+                                "path": record.locator,
+                                "length": record.length,
+                                "size": len(record.body),
+                            },
+                            ensure_ascii=False,
+                        )
+                        + "\n"
+                    )
+            index.flush()
+            os.fsync(index.fileno())
+        os.replace(temp_path, self.index_path())
+        logging.info(f"Index of archive {self.folder} was rebuilt")
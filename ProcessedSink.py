@@ -0,0 +1,243 @@
+import json
+import os
+import queue
+import threading
+import time
+import zlib
+
+from config import *
+from Metrics import metrics
+
+
+class ProcessedSink:
+    """
+    Output of processed documents as records in rolling, compressed JSON Lines
+    shards (part-NNNNN.jsonl.gz) instead of one .txt file per document.
+    Extraction workers only put records into a bounded queue; a single writer
+    thread takes them in batches and appends every batch to its shard as one
+    gzip member, so shards stay readable with zcat. The offset of the member
+    holding every id is kept in index.jsonl, which allows lookup by id without
+    reading whole shards.
+    Records are addressed as 'shard#id' locators, which are logged as the
+    processed file path and end up in the registry. A record whose URL has no
+    id in the registry is keyed by its URL instead.
+    Attributes:
+        folder (str): Folder with the shards and the index.
+        max_size (int): Uncompressed size of a shard after which a new one is started.
+        batch_size (int): Maximum number of records in one gzip member.
+        interval (float): Maximum time a record waits in the writer thread.
+    """
+
+    INDEX_FILE = "index.jsonl"
+
+    def __init__(self, folder, max_size=None, batch_size=None, interval=None):
+        self.folder = folder
+        self.max_size = max_size or SINK_MAX_SIZE
+        self.batch_size = batch_size or SINK_BATCH_SIZE
+        self.interval = interval or SINK_FLUSH_INTERVAL
+        self.queue = queue.Queue(maxsize=SINK_QUEUE_SIZE)
+        self.lock = threading.Lock()
+        self.number = None
+        self.shard_size = 0
+        self.thread = None
+        self.error = None
+        self.index = None
+
+    def index_path(self):
+        return os.path.join(self.folder, self.INDEX_FILE)
+
+    def shard_path(self, number):
+        return os.path.join(self.folder, f"part-{number:05d}.jsonl.gz")
+
+    def shards(self):
+        if not os.path.isdir(self.folder):
+            return []
+        return sorted(
+            os.path.join(self.folder, name)
+            for name in os.listdir(self.folder)
+            if name.startswith("part-") and name.endswith(".jsonl.gz")
+        )
+
+    def reset(self):
+        """
+        Starts new output: removes the shards and the index of the previous run.
+        """
+        for shard in self.shards():
+            os.remove(shard)
+        if os.path.exists(self.index_path()):
+            os.remove(self.index_path())
+
+    def start(self):
+        """
+        Starts the writer thread. Records are written to a new shard, shards of
+        a previous run are kept.
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        numbers = [
+            int(os.path.basename(shard)[len("part-") : -len(".jsonl.gz")])
+            for shard in self.shards()
+        ]
+        self.number = max(numbers, default=-1) + 1
+        self.shard_size = 0
+        self.thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def key_of(entry):
+        """
+        Returns the key a record or index entry is looked up by: its id or,
+        without an id, its URL.
+        """
+        id = entry.get("id")
+        return str(id) if id is not None else entry.get("url")
+
+    def put(self, **record):
+        """
+        Queues a processed document for writing. Blocks while the queue is full.
+        Args:
+            **record: Fields of the record: id, url, type, language, page_count, text.
+        Return:
+            str: Locator of the record.
+        Raises:
+            ValueError: If the writer thread failed or the record has neither an
+                id nor a URL.
+        """
+        if self.error is not None:
+            raise ValueError(f"Sink {self.folder} failed: {self.error}")
+        key = self.key_of(record)
+        if key is None:
+            raise ValueError("Record has neither an id nor a URL")
+        if record.get("id") is None:
+            logging.warning(
+                f"URL {key} has no id in the registry, record is keyed by URL"
+            )
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        with self.lock:
+            # Shards are assigned here, so the locator is known before the write.
+            if self.shard_size > 0 and self.shard_size + len(line) > self.max_size:
+                self.number += 1
+                self.shard_size = 0
+            self.shard_size += len(line)
+            shard = self.shard_path(self.number)
+        self.queue.put((shard, record.get("id"), record.get("url"), line))
+        metrics.set_gauge("sink_queue_depth", self.queue.qsize())
+        return f"{shard}#{key}"
+
+    def write_loop(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False
+            if item:
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.interval
+            if batch and (
+                item is None or item is False or len(batch) >= self.batch_size
+            ):
+                try:
+                    self.write_batch(batch)
+                except Exception as error:
+                    self.error = error
+                    logging.warning(f"Sink {self.folder}. Error: {error}")
+                batch, deadline = [], None
+            if item is None:
+                return
+
+    def write_batch(self, batch):
+        """
+        Writes a batch of records: one gzip member per shard, then the index entries.
+        Args:
+            batch (list): (shard, id, url, line) tuples.
+        """
+        started = time.perf_counter()
+        by_shard = {}
+        for item in batch:
+            by_shard.setdefault(item[0], []).append(item)
+
+        entries = []
+        for shard, items in by_shard.items():
+            member = zlib.compressobj(wbits=31)
+            data = member.compress(b"".join(item[3] for item in items)) + member.flush()
+            with open(shard, "ab") as file:
+                offset = file.tell()
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+            for _, id, url, _ in items:
+                entries.append(
+                    json.dumps(
+                        {"id": id, "url": url, "path": shard, "offset": offset},
+                        ensure_ascii=False,
+                    )
+                    + "\n"
+                )
+        with open(self.index_path(), "a", encoding="utf-8") as index:
+            index.writelines(entries)
+        metrics.observe("sink_write_seconds", time.perf_counter() - started)
+        metrics.inc("sink_records_total", len(batch))
+
+    def close(self):
+        """
+        Writes the queued records and stops the writer thread.
+        Raises:
+            ValueError: If the writer thread failed.
+        """
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            raise ValueError(f"Sink {self.folder} failed: {self.error}")
+
+    def load_index(self):
+        """
+        Reads the index of the sink. A truncated last line is ignored, and when
+        an id was written several times, e.g. by a resumed run, the last record wins.
+        Return:
+            dict: ID (or URL of a record without an id) -> index entry (id, url,
+                path, offset).
+        """
+        index = {}
+        if os.path.exists(self.index_path()):
+            with open(self.index_path(), "r", encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    index[self.key_of(entry)] = entry
+        return index
+
+    def get(self, id):
+        """
+        Looks up a processed document by id: only the gzip member holding it is read.
+        Args:
+            id (str): ID of the URL in the registry, or the URL of a record without an id.
+        Return:
+            dict: The record or None if there is no record with this id.
+        """
+        if self.index is None:
+            self.index = self.load_index()
+        entry = self.index.get(str(id))
+        if entry is None:
+            return None
+
+        decompressor = zlib.decompressobj(wbits=31)
+        chunks = []
+        with open(entry["path"], "rb") as file:
+            file.seek(entry["offset"])
+            while not decompressor.eof:
+                chunk = file.read(65536)
+                if not chunk:
+                    break
+                chunks.append(decompressor.decompress(chunk))
+        for line in b"".join(chunks).splitlines():
+            record = json.loads(line)
+            if self.key_of(record) == str(id):
+                return record
+        return None
@@ -1,49 +1,228 @@
-from PyPDF2 import PdfReader
+import io
 import os
+import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from config import *
-from bs4 import BeautifulSoup
-from config import *
-from langdetect import detect
+from Metrics import metrics
+from PackedArchive import PackedArchive
+from ProcessedSink import ProcessedSink
+from FormingResultsRegistry import FormingResultsRegistry
 
 
 class ProcessingDownloadContent:
     """
     Class for processing PDF and HTML files: extracts text content
     and saves it to specified folders.
+    Attributes:
+        checkpoint (Checkpoint): Progress of the run or None.
+        sinks (dict): JSON Lines sink of every output folder, when
+            PROCESSED_STORAGE is 'jsonl'.
+        frontier (CrawlFrontier): Frontier that links of HTML pages are added to, or None.
+        keep_files (bool): Whether output of earlier calls is kept and their files are skipped.
+        failed (set): Raw files whose processing failed, not retried by later calls.
     """
 
+    def __init__(self, checkpoint=None, frontier=None, keep_files=False):
+        """
+        Initializes the ProcessingDownloadContent instance.
+        Args:
+            checkpoint (Checkpoint): Progress of the run. Processed files are recorded
+                in it, and when it was resumed, files processed before are skipped.
+            frontier (CrawlFrontier): Frontier of the crawl mode. Links of processed
+                HTML pages are added to it.
+            keep_files (bool): Whether the output folders keep the files of the
+                previous run. Every call then processes only the raw files that
+                the checkpoint doesn't record as processed, e.g. of the current
+                batch or crawl round.
+        """
+        self.checkpoint = checkpoint
+        self.frontier = frontier
+        self.keep_files = keep_files
+        self.failed = set()
+        self.sinks = {}
+        self.url_ids = None
+        self.downloaded_urls = None
+
+    def mark_processed(self, file_path):
+        if self.checkpoint is not None:
+            self.checkpoint.record(
+                "processed", url=self.checkpoint.url_of(file_path), path=file_path
+            )
+
+    def open_sink(self, folder):
+        """
+        Starts the JSON Lines sink of the output folder when PROCESSED_STORAGE is
+        'jsonl'. A new run replaces the output of the previous run, unless
+        keep_files is set.
+        Args:
+            folder (str): Output folder.
+        """
+        if PROCESSED_STORAGE != "jsonl":
+            return
+        sink = ProcessedSink(folder)
+        if not self.keep_files and (
+            self.checkpoint is None or not self.checkpoint.resumed
+        ):
+            sink.reset()
+        sink.start()
+        self.sinks[folder] = sink
+
+        if self.url_ids is None:
+            registry = FormingResultsRegistry()
+            try:
+                self.url_ids = registry.get_url_ids()
+                self.downloaded_urls = registry.get_downloaded_urls()
+            except FileNotFoundError:
+                logging.warning(
+                    "Registry or log not found, records are saved without ids"
+                )
+                self.url_ids, self.downloaded_urls = {}, {}
+
+    def url_of(self, file_path):
+        """
+        Returns the URL a raw file was downloaded from, by the checkpoint or,
+        without it, by analytics.log.
+        Args:
+            file_path (str): Path of the raw file or locator of the archive record.
+        Return:
+            str: URL or None if unknown.
+        """
+        url = None
+        if self.checkpoint is not None:
+            url = self.checkpoint.url_of(file_path)
+        if url is None:
+            if self.downloaded_urls is None:
+                try:
+                    self.downloaded_urls = (
+                        FormingResultsRegistry().get_downloaded_urls()
+                    )
+                except FileNotFoundError:
+                    self.downloaded_urls = {}
+            url = self.downloaded_urls.get(file_path)
+        return url
+
+    def close_sink(self, folder):
+        sink = self.sinks.pop(folder, None)
+        if sink is not None:
+            sink.close()
+
+    def save_text(self, folder, file_name, file_path, text, **fields):
+        """
+        Saves the extracted text to a TXT file or, when PROCESSED_STORAGE is
+        'jsonl', as a record of the sink together with the id and URL of the file.
+        Args:
+            folder (str): Output folder.
+            file_name (str): Name of the raw file.
+            file_path (str): Path of the raw file or locator of the archive record.
+            text (str): Extracted text.
+            **fields: Other fields of the record: type, language, page_count.
+        Return:
+            str: Path of the TXT file or locator of the record.
+        """
+        sink = self.sinks.get(folder)
+        if sink is not None:
+            url = self.url_of(file_path)
+            return sink.put(id=self.url_ids.get(url), url=url, **fields, text=text)
+
+        output_path = os.path.join(folder, file_name) + ".txt"
+        with open(output_path, "w", encoding="utf-8") as file:
+            file.write(text)
+        return output_path
+
+    def pending_files(self, folder):
+        """
+        Lists the files of the folder that still have to be processed.
+        When RAW_STORAGE is 'archive', lists the records of the packed archive
+        that replaces the folder.
+        Args:
+            folder (str): Folder with raw files.
+        Return:
+            list: Paths of the files or locators of the archive records.
+        """
+        if RAW_STORAGE == "archive":
+            archive = PackedArchive(PackedArchive.folder_for(folder))
+            candidates = [entry["path"] for entry in archive.records()]
+        else:
+            candidates = [
+                os.path.join(folder, file_name) for file_name in os.listdir(folder)
+            ]
+
+        files_paths = []
+        for file_path in candidates:
+            if PackedArchive.is_locator(file_path) or os.path.isfile(file_path):
+                if file_path in self.failed:
+                    continue
+                if self.checkpoint is not None and (
+                    self.checkpoint.resumed or self.keep_files
+                ):
+                    if file_path in self.checkpoint.processed:
+                        continue
+                    # Files left by downloads the checkpoint didn't record
+                    # were downloaded again under another name.
+                    if self.checkpoint.url_of(file_path) is None:
+                        continue
+                files_paths.append(file_path)
+        return files_paths
+
     def processing_one_pdf(self, file_path, folder):
         """
         Processes a single PDF file: extracts text from all pages and saves it as a TXT file.
         Args:
             file_path (str): Path to the source PDF file
             folder (str): Folder to save the output TXT file
+        Return:
+            tuple: Path of the output (or locator of the record), language and number of pages.
         Raises:
             ValueError: If an error occurs during file processing
         """
-        try:
-            reader = PdfReader(file_path)
-            output_path = os.path.join(folder, os.path.basename(file_path)) + ".txt"
+        from PyPDF2 import PdfReader
+        from langdetect import detect
 
-            full_text = ""
+        try:
+            if PackedArchive.is_locator(file_path):
+                record = PackedArchive.read(file_path)
+                reader = PdfReader(io.BytesIO(record.body))
+                file_name = record.name
+            else:
+                reader = PdfReader(file_path)
+                file_name = os.path.basename(file_path)
 
-            with open(output_path, "a", encoding="utf-8") as file:
-                count = 0
-                for page in reader.pages:
-                    text = page.extract_text()
-                    if text:
-                        file.write(text)
-                        full_text += text
-                    count += 1
+            texts = []
+            count = 0
+            for page in reader.pages:
+                started = time.perf_counter()
+                text = page.extract_text()
+                metrics.observe(
+                    "pdf_page_extract_seconds", time.perf_counter() - started
+                )
+                if text:
+                    texts.append(text)
+                count += 1
+            full_text = "".join(texts)
 
+            metrics.inc("pdf_pages_total", count)
             if full_text:
+                started = time.perf_counter()
                 language = detect(full_text)
+                metrics.observe(
+                    "language_detect_seconds", time.perf_counter() - started
+                )
             else:
                 language = "unknown"
+            output_path = self.save_text(
+                folder,
+                file_name,
+                file_path,
+                full_text,
+                type="pdf",
+                language=language,
+                page_count=count,
+            )
             logging.info(
                 f"From {file_path} was successfully processed PDF in {output_path} with language {language} and {count} pages."
             )
+            self.mark_processed(file_path)
+            return output_path, language, count
         except Exception as error:
             logging.warning(f"Error processing {file_path}: {error}")
             raise ValueError(f"Error processing: {error}")
@@ -55,61 +234,172 @@ class ProcessingDownloadContent:
         folder = "processed_data/documents/"
         os.makedirs(folder, exist_ok=True)
 
-        files_paths = []
-
         logging.info("Start processing PDF")
 
-        for file_name in os.listdir("raw_downloads/documents/"):
-            file_path = os.path.join("raw_downloads/documents/", file_name)
-            if os.path.isfile(file_path):
-                files_paths.append(file_path)
+        files_paths = self.pending_files("raw_downloads/documents/")
 
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            futures = {
-                executor.submit(self.processing_one_pdf, file_path, folder): file_path
-                for file_path in files_paths
-            }
-            for future in as_completed(futures):
-                file_path = futures[future]
-                try:
-                    future.result()
-                except Exception as error:
-                    logging.warning(
-                        f"Processing failed for {file_path} with error: {error}"
-                    )
+        self.open_sink(folder)
+        try:
+            with ThreadPoolExecutor(max_workers=PROCESSING_WORKERS) as executor:
+                futures = {
+                    executor.submit(
+                        self.processing_one_pdf, file_path, folder
+                    ): file_path
+                    for file_path in files_paths
+                }
+                pending = len(futures)
+                metrics.set_gauge("queue_depth", pending, stage="process_pdf")
+                for future in as_completed(futures):
+                    pending -= 1
+                    metrics.set_gauge("queue_depth", pending, stage="process_pdf")
+                    file_path = futures[future]
+                    try:
+                        future.result()
+                        metrics.inc("urls_total", stage="process_pdf", result="success")
+                    except Exception as error:
+                        metrics.inc("urls_total", stage="process_pdf", result="failed")
+                        self.failed.add(file_path)
+                        logging.warning(
+                            f"Processing failed for {file_path} with error: {error}"
+                        )
+        finally:
+            self.close_sink(folder)
         logging.info("Files was processed correct")
 
+    def follow_links(self, file_path, links):
+        """
+        Adds the links of a processed page to the frontier of the crawl mode.
+        Args:
+            file_path (str): Path of the raw file or locator of the archive record.
+            links (list): href values of the links of the page.
+        """
+        page_url = self.url_of(file_path)
+        if page_url is not None:
+            self.frontier.add_links(page_url, links)
+
+    def processing_html_streaming(self, file_path, chunks, folder, file_name):
+        """
+        Extracts the text of a page larger than HTML_STREAMING_THRESHOLD with an
+        event-based parser instead of a BeautifulSoup tree. Unless the output is
+        the JSON Lines sink, the text is written to the TXT file while parsing.
+        Args:
+            file_path (str): Path of the raw file or locator of the archive record.
+            chunks (iterable): Consecutive parts of the page as strings.
+            folder (str): Folder to save the output TXT file.
+            file_name (str): Name of the raw file.
+        Return:
+            tuple: Path of the output (or locator of the record) and language.
+        """
+        from StreamingHTMLExtractor import StreamingHTMLExtractor
+
+        links = [] if self.frontier is not None else None
+        if folder in self.sinks:
+            out = io.StringIO()
+            extractor = StreamingHTMLExtractor(out, links)
+            language = extractor.extract(chunks)
+            output_path = self.save_text(
+                folder,
+                file_name,
+                file_path,
+                out.getvalue(),
+                type="html",
+                language=language,
+            )
+        else:
+            output_path = os.path.join(folder, file_name) + ".txt"
+            with open(output_path, "w", encoding="utf-8") as out:
+                extractor = StreamingHTMLExtractor(out, links)
+                language = extractor.extract(chunks)
+        if links is not None:
+            self.follow_links(file_path, links)
+        metrics.inc("html_streamed_total")
+        return output_path, language
+
     def processing_one_html(self, file_path, folder):
         """
         Processes a single HTML file: removes scripts/styles, extracts text, and saves as TXT.
         Args:
             file_path (str): Path to the source HTML file
             folder (str): Folder to save the output TXT file
+        Return:
+            tuple: Path of the output (or locator of the record), language and None.
+            Pages larger than HTML_STREAMING_THRESHOLD are extracted by
+            processing_html_streaming with the same result.
         Raises:
             ValueError: If an error occurs during file processing
         """
-        try:
-            with open(file_path, "r") as file:
-                html_content = file.read()
-
-                soup = BeautifulSoup(html_content, "html.parser")
-                for script_or_style in soup(["script", "style"]):
-                    script_or_style.decompose()
-                text = soup.get_text()
-                output_path = os.path.join(folder, os.path.basename(file_path)) + ".txt"
+        from bs4 import BeautifulSoup
 
-                with open(output_path, "a") as file:
-                    file.write(text)
+        record = None
+        try:
+            if PackedArchive.is_locator(file_path):
+                # Only the headers are decompressed here, the body while it is parsed.
+                record = PackedArchive.stream(file_path)
+                size = record.size
+                file_name = record.name
+            else:
+                size = os.path.getsize(file_path)
+                file_name = os.path.basename(file_path)
 
-                language = None
-                if soup.html:
-                    language = soup.html.get("lang", None)
+            if size > HTML_STREAMING_THRESHOLD:
+                started = time.perf_counter()
+                if record is not None:
+                    output_path, language = self.processing_html_streaming(
+                        file_path,
+                        record.iter_text(HTML_STREAMING_CHUNK),
+                        folder,
+                        file_name,
+                    )
+                else:
+                    with open(file_path, "r") as file:
+                        output_path, language = self.processing_html_streaming(
+                            file_path,
+                            iter(lambda: file.read(HTML_STREAMING_CHUNK), ""),
+                            folder,
+                            file_name,
+                        )
+                metrics.observe("html_parse_seconds", time.perf_counter() - started)
+                metrics.inc("html_bytes_total", size)
                 logging.info(
                     f"From {file_path} was successfully processed HTML in {output_path} with language {language}."
                 )
+                self.mark_processed(file_path)
+                return output_path, language, None
+
+            if record is not None:
+                html_content = record.text()
+            else:
+                with open(file_path, "r") as file:
+                    html_content = file.read()
+
+            started = time.perf_counter()
+            soup = BeautifulSoup(html_content, "html.parser")
+            for script_or_style in soup(["script", "style"]):
+                script_or_style.decompose()
+            text = soup.get_text()
+            metrics.observe("html_parse_seconds", time.perf_counter() - started)
+            metrics.inc("html_bytes_total", len(html_content))
+            language = None
+            if soup.html:
+                language = soup.html.get("lang", None)
+            if self.frontier is not None:
+                self.follow_links(
+                    file_path, [link["href"] for link in soup.find_all("a", href=True)]
+                )
+            output_path = self.save_text(
+                folder, file_name, file_path, text, type="html", language=language
+            )
+            logging.info(
+                f"From {file_path} was successfully processed HTML in {output_path} with language {language}."
+            )
+            self.mark_processed(file_path)
+            return output_path, language, None
         except Exception as error:
             logging.warning(f"Error processing {file_path}: {error}")
             raise ValueError(f"Error processing: {error}")
+        finally:
+            if record is not None:
+                record.close()
 
     def processing_html(self):
         """
@@ -118,24 +408,34 @@ class ProcessingDownloadContent:
         folder = "processed_data/pages/"
         os.makedirs(folder, exist_ok=True)
 
-        files_paths = []
+        files_paths = self.pending_files("raw_downloads/pages/")
 
-        for file_name in os.listdir("raw_downloads/pages/"):
-            file_path = os.path.join("raw_downloads/pages/", file_name)
-            if os.path.isfile(file_path):
-                files_paths.append(file_path)
-
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            futures = {
-                executor.submit(self.processing_one_html, file_path, folder): file_path
-                for file_path in files_paths
-            }
-            for future in as_completed(futures):
-                file_path = futures[future]
-                try:
-                    future.result()
-                except Exception as error:
-                    logging.warning(
-                        f"Processing failed for {file_path} with error: {error}"
-                    )
+        self.open_sink(folder)
+        try:
+            with ThreadPoolExecutor(max_workers=PROCESSING_WORKERS) as executor:
+                futures = {
+                    executor.submit(
+                        self.processing_one_html, file_path, folder
+                    ): file_path
+                    for file_path in files_paths
+                }
+                pending = len(futures)
+                metrics.set_gauge("queue_depth", pending, stage="process_html")
+                for future in as_completed(futures):
+                    pending -= 1
+                    metrics.set_gauge("queue_depth", pending, stage="process_html")
+                    file_path = futures[future]
+                    try:
+                        future.result()
+                        metrics.inc(
+                            "urls_total", stage="process_html", result="success"
+                        )
+                    except Exception as error:
+                        metrics.inc("urls_total", stage="process_html", result="failed")
+                        self.failed.add(file_path)
+                        logging.warning(
+                            f"Processing failed for {file_path} with error: {error}"
+                        )
+        finally:
+            self.close_sink(folder)
         logging.info("Files was processed correct")
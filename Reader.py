@@ -1,3 +1,9 @@
+import csv
+import gzip
+import io
+from itertools import islice
+
+
 class Reader:
     """
     File reader class
@@ -17,13 +23,142 @@ class Reader:
             ValueError: If the file is empty or does not exist
         """
 
+        return [url for id, url in self.iter_records(filename)]
+
+    def open_file(self, filename):
+        """
+        Opens a text file, decompressing .gz and .zst files on the fly
+        Args:
+            filename (str): Path to the file to open
+        Return:
+            file object: Text stream over the file content
+        Raises:
+            ValueError: If the file does not exist or zstandard is not installed for a .zst file
+        """
         try:
-            with open(filename, "r") as file:
-                lines = [
-                    line.strip() for line in file.readlines() if line.strip() != ""
-                ]
-                if len(lines) == 0:
-                    raise ValueError("File is empty")
-                return lines
+            if filename.endswith(".gz"):
+                return gzip.open(filename, "rt", encoding="utf-8", newline="")
+            if filename.endswith(".zst"):
+                try:
+                    import zstandard
+                except ImportError:
+                    raise ValueError("Install zstandard to read .zst files")
+                raw = open(filename, "rb")
+                stream = zstandard.ZstdDecompressor().stream_reader(raw, closefd=True)
+                return io.TextIOWrapper(stream, encoding="utf-8", newline="")
+            return open(filename, "r", encoding="utf-8", newline="")
         except FileNotFoundError:
             raise ValueError("File not found")
+
+    @staticmethod
+    def add_arguments(parser):
+        """
+        Adds the options of iter_records to a command-line parser
+        Args:
+            parser (ArgumentParser): Parser of an entry point that reads an input file
+        """
+        parser.add_argument(
+            "--column",
+            help="CSV column with URLs, by index or, with --header, by name; "
+            "by default every line is a URL",
+        )
+        parser.add_argument(
+            "--header", action="store_true", help="the first line is a header"
+        )
+        parser.add_argument("--delimiter", default=",", help="CSV delimiter")
+
+    @staticmethod
+    def options(column=None, header=False, delimiter=None):
+        """
+        Converts command-line values to keyword arguments of iter_records
+        Args:
+            column (str): Column index or name, None for one URL per line
+            header (bool): Whether the first line is a header
+            delimiter (str): CSV delimiter, ',' by default
+        Return:
+            dict: column, has_header and delimiter
+        """
+        if column is not None and column.isdigit():
+            column = int(column)
+        return {"column": column, "has_header": header, "delimiter": delimiter or ","}
+
+    def iter_records(self, filename, column=None, has_header=False, delimiter=","):
+        """
+        Lazily read a file and yield (id, url) records one by one, so memory use
+        doesn't depend on the size of the file. The file is opened and its first
+        record is read at once, so an empty file is reported before any record is used
+        Args:
+            filename (str): Path to the file to read, may be compressed with gzip or zstd
+            column (int or str): Column with URLs. If None, the whole line is the URL,
+                otherwise lines are parsed as CSV and the column is selected by index
+                or, with has_header, by name
+            has_header (bool): Whether the first line is a header to skip
+            delimiter (str): CSV delimiter
+        Return:
+            generator of tuple: (id, url), ids are sequential and start from 1
+        Raises:
+            ValueError: If the file is empty, does not exist or the column is missing
+        """
+        file = self.open_file(filename)
+        try:
+            if column is None:
+                if has_header:
+                    next(file, None)
+                rows = (line.strip() for line in file)
+            else:
+                reader = csv.reader(file, delimiter=delimiter)
+                index = column
+                if has_header:
+                    header = next(reader, [])
+                    if not isinstance(column, int):
+                        if column not in header:
+                            raise ValueError(f"Column {column} not found")
+                        index = header.index(column)
+                elif not isinstance(column, int):
+                    raise ValueError(
+                        f"Column {column} is selected by name without a header"
+                    )
+                rows = (
+                    row[index].strip() if len(row) > index else "" for row in reader
+                )
+            urls = (url for url in rows if url != "")
+            first = next(urls, None)
+            if first is None:
+                raise ValueError("File is empty")
+        except BaseException:
+            file.close()
+            raise
+        return self.numbered(file, first, urls)
+
+    @staticmethod
+    def numbered(file, first, urls):
+        """
+        Yields records with sequential ids and closes the file at the end
+        Args:
+            file (file object): Stream the URLs are read from
+            first (str): First URL, already read
+            urls (iterator): Remaining URLs
+        Return:
+            generator of tuple: (id, url)
+        """
+        with file:
+            yield 1, first
+            for id, url in enumerate(urls, start=2):
+                yield id, url
+
+    @staticmethod
+    def batches(records, size):
+        """
+        Split an iterable into lists of at most size elements
+        Args:
+            records (iterable): Records to split
+            size (int): Maximum size of one batch
+        Return:
+            generator of list: Consecutive batches
+        """
+        iterator = iter(records)
+        while True:
+            batch = list(islice(iterator, size))
+            if not batch:
+                return
+            yield batch
@@ -0,0 +1,186 @@
+import heapq
+import json
+import math
+import os
+import time
+
+from config import *
+from Metrics import metrics
+
+
+class RecrawlScheduler:
+    """
+    Change-rate-aware choice of the URLs to recrawl.
+    The content hash of every downloaded URL is recorded after each run. Treating
+    changes of a URL as a Poisson process, its change rate is estimated from the
+    number of checks n and the number of checks that found a change X with the
+    estimator of Cho and Garcia-Molina, which stays finite when every check found
+    a change: rate = -ln((n - X + 0.5) / (n + 0.5)) / mean interval between checks.
+    The priority of a URL is the probability that it changed since its last
+    crawl, 1 - exp(-rate * time since the last crawl); URLs that were never
+    crawled come first. A run with a budget recrawls only the URLs with the
+    highest priority.
+    Attributes:
+        path (str): Path of the change history.
+        prior_interval (float): Assumed mean time between changes of a URL
+            without history, in seconds.
+        history (dict): URL -> hash, first and last crawl time, checks, changes and
+            elapsed time between checks.
+    """
+
+    def __init__(self, path=None, prior_interval=None):
+        self.path = path or RECRAWL_HISTORY_FILE
+        self.prior_interval = prior_interval or RECRAWL_PRIOR_INTERVAL
+        self.history = {}
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                self.history = json.load(file)
+        except FileNotFoundError:
+            self.history = {}
+        return self
+
+    def save(self):
+        temp_path = self.path + ".temp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump(self.history, file)
+        os.replace(temp_path, self.path)
+
+    def observe(self, url, sha256, timestamp=None):
+        """
+        Records the content hash of a URL downloaded by this run.
+        Observations closer than RECRAWL_MIN_INTERVAL to the previous one, e.g.
+        repeated by a resumed run, don't count as a check.
+        Args:
+            url (str): Downloaded URL.
+            sha256 (str): Hash of the content.
+            timestamp (float): Time of the download, now by default.
+        """
+        timestamp = timestamp or time.time()
+        state = self.history.get(url)
+        if state is None:
+            self.history[url] = {
+                "hash": sha256,
+                "first": timestamp,
+                "last": timestamp,
+                "checks": 0,
+                "changes": 0,
+                "elapsed": 0,
+            }
+            return
+
+        interval = timestamp - state["last"]
+        if interval < RECRAWL_MIN_INTERVAL:
+            return
+        state["checks"] += 1
+        state["elapsed"] += interval
+        if sha256 != state["hash"]:
+            state["changes"] += 1
+            state["hash"] = sha256
+        state["last"] = timestamp
+
+    def observe_checkpoint(self, checkpoint):
+        """
+        Records the hashes of all URLs downloaded by the run of the checkpoint.
+        Args:
+            checkpoint (Checkpoint): Progress of the run.
+        """
+        timestamp = time.time()
+        for url, record in checkpoint.downloaded.items():
+            self.observe(url, record["sha256"], timestamp)
+        logging.info(
+            f"Change history was updated with {len(checkpoint.downloaded)} URLs"
+        )
+
+    def rate(self, url):
+        """
+        Estimates the change rate of a URL.
+        Args:
+            url (str): URL.
+        Return:
+            float: Expected number of changes per second.
+        """
+        state = self.history.get(url)
+        if state is None or state["checks"] == 0:
+            return 1 / self.prior_interval
+        checks, changes = state["checks"], state["changes"]
+        mean_interval = state["elapsed"] / checks
+        return -math.log((checks - changes + 0.5) / (checks + 0.5)) / mean_interval
+
+    def priority(self, url, now=None):
+        """
+        Returns the probability that the URL changed since its last crawl.
+        Args:
+            url (str): URL.
+            now (float): Current time.
+        Return:
+            float: Priority, infinite for URLs that were never crawled.
+        """
+        state = self.history.get(url)
+        if state is None:
+            return math.inf
+        elapsed = max(0, (now or time.time()) - state["last"])
+        return 1 - math.exp(-self.rate(url) * elapsed)
+
+    def select(self, urls, budget):
+        """
+        Chooses the URLs to crawl within the request budget. Only the chosen
+        URLs are kept in memory, in a heap of the size of the budget.
+        Args:
+            urls (iterable): Clean URLs.
+            budget (int): Maximum number of URLs to crawl.
+        Return:
+            dict: Chosen URL -> priority.
+        """
+        now = time.time()
+        heap = []
+        total = 0
+        for url in urls:
+            total += 1
+            item = (self.priority(url, now), url)
+            if len(heap) < budget:
+                heapq.heappush(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
+
+        selected = {url: priority for priority, url in heap}
+        metrics.set_gauge("recrawl_selected", len(selected))
+        metrics.set_gauge("recrawl_skipped", total - len(selected))
+        logging.info(
+            f"Recrawl scheduler selected {len(selected)} of {total} URLs with budget {budget}"
+        )
+        return selected
+
+    @staticmethod
+    def schedule(records, selected):
+        """
+        Marks the cleaned records of URLs that weren't selected as 'not_scheduled'.
+        Args:
+            records (iterable): (id, source_url, url, status) tuples from URLProcessing.iter_cleaner.
+            selected (dict): URLs chosen by select.
+        Return:
+            generator of tuple: (id, source_url, url, status) tuples.
+        """
+        for id, source_url, url, status in records:
+            if status == "clean_url" and url not in selected:
+                status = "not_scheduled"
+            yield id, source_url, url, status
+
+    @staticmethod
+    def order(urls, selected):
+        """
+        Feeds URLs to the download queue from a priority heap, highest priority
+        first. The downloads read the queue lazily, so the first requests start
+        once the heap is built, without sorting all URLs first.
+        Args:
+            urls (iterable): URLs.
+            selected (dict): URL -> priority.
+        Return:
+            generator of str: URLs, highest priority first, URLs of the same
+                priority in input order.
+        """
+        heap = [(-selected.get(url, 0), number, url) for number, url in enumerate(urls)]
+        heapq.heapify(heap)
+        while heap:
+            yield heapq.heappop(heap)[2]
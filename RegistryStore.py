@@ -0,0 +1,452 @@
+import csv
+import os
+import pathlib
+import sqlite3
+import threading
+from urllib.parse import urlparse
+
+from config import *
+
+COLUMNS = [
+    "id",
+    "source_url",
+    "final_url",
+    "processing_timestamp",
+    "download_timestamp",
+    "download_status",
+    "error_message",
+    "content_type_detected",
+    "raw_file_path",
+    "processed_file_path",
+    "file_size_bytes",
+    "document_page_count",
+    "detected_language",
+    "extracted_keywords",
+    "extracted_entities",
+    "summary",
+    "metadata_author",
+    "metadata_creation_date",
+]
+
+# Outcome of a URL, derived from its columns, for aggregations.
+STATUS = """CASE
+    WHEN error_message = 'URL was deleted cause URL is duplicate' THEN 'duplicate'
+    WHEN error_message = 'Line was deleted cause line isn''t URL' THEN 'not_url'
+    WHEN error_message = 'URL wasn''t scheduled for recrawl' THEN 'not_scheduled'
+    WHEN processed_file_path NOT IN ('', ' ', '-') THEN 'processed'
+    WHEN error_message NOT IN ('', ' ', '-') THEN 'failed'
+    WHEN raw_file_path NOT IN ('', ' ', '-') THEN 'downloaded'
+    ELSE 'not_downloaded'
+END"""
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS registry (
+    id INTEGER PRIMARY KEY,
+    {", ".join(f"{column} TEXT NOT NULL DEFAULT ' '" for column in COLUMNS[1:])},
+    host TEXT NOT NULL DEFAULT '-',
+    status TEXT GENERATED ALWAYS AS ({STATUS}) VIRTUAL
+);
+CREATE INDEX IF NOT EXISTS registry_final_url ON registry (final_url);
+CREATE INDEX IF NOT EXISTS registry_raw_file_path ON registry (raw_file_path);
+CREATE INDEX IF NOT EXISTS registry_status ON registry (status);
+CREATE INDEX IF NOT EXISTS registry_host_status ON registry (host, status);
+
+CREATE TABLE IF NOT EXISTS status_counts (
+    status TEXT PRIMARY KEY,
+    count INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS host_counts (
+    host TEXT NOT NULL,
+    status TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (host, status)
+);
+CREATE INDEX IF NOT EXISTS host_counts_by_count ON host_counts (status, count);
+
+CREATE TRIGGER IF NOT EXISTS registry_insert AFTER INSERT ON registry BEGIN
+    INSERT INTO status_counts VALUES (NEW.status, 1)
+        ON CONFLICT (status) DO UPDATE SET count = count + 1;
+    INSERT INTO host_counts VALUES (NEW.host, NEW.status, 1)
+        ON CONFLICT (host, status) DO UPDATE SET count = count + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS registry_update AFTER UPDATE ON registry
+WHEN OLD.status IS NOT NEW.status OR OLD.host IS NOT NEW.host BEGIN
+    UPDATE status_counts SET count = count - 1 WHERE status = OLD.status;
+    UPDATE host_counts SET count = count - 1
+        WHERE host = OLD.host AND status = OLD.status;
+    INSERT INTO status_counts VALUES (NEW.status, 1)
+        ON CONFLICT (status) DO UPDATE SET count = count + 1;
+    INSERT INTO host_counts VALUES (NEW.host, NEW.status, 1)
+        ON CONFLICT (host, status) DO UPDATE SET count = count + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS registry_delete AFTER DELETE ON registry BEGIN
+    UPDATE status_counts SET count = count - 1 WHERE status = OLD.status;
+    UPDATE host_counts SET count = count - 1
+        WHERE host = OLD.host AND status = OLD.status;
+END;
+"""
+
+
+def host_of(*urls):
+    """
+    Returns the host of the first URL that has one, for aggregations by host.
+    Args:
+        *urls (str): Candidate URLs, e.g. the final and the source URL.
+    Return:
+        str: Lowercase host or '-'.
+    """
+    for url in urls:
+        try:
+            host = urlparse(url).hostname
+        except ValueError:
+            host = None
+        if host:
+            return host
+    return "-"
+
+
+class RegistryStore:
+    """
+    SQLite database behind the results registry.
+    Rows are keyed by id and indexed by final URL and raw file path, so the
+    stages update them from analytics.log by index lookups instead of
+    rewriting the whole registry. Writes are grouped into transactions of at
+    most batch_size rows. Counts of rows per status and per host and status
+    are kept up to date by triggers in status_counts and host_counts, so
+    aggregations read only the rows of their result. The database is in WAL
+    mode: it can be queried while a run writes to it.
+    results_registry.csv and the columnar export are produced from it.
+    Attributes:
+        path (str): Path of the database.
+        batch_size (int): Maximum number of rows written in one transaction.
+        read_only (bool): Whether the database is only read, e.g. by queries
+            and exports. It is then opened read-only and never created.
+    """
+
+    def __init__(self, path=None, batch_size=None, read_only=False):
+        self.path = path or REGISTRY_DB_FILE
+        self.batch_size = batch_size or REGISTRY_BATCH_SIZE
+        self.read_only = read_only
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        """
+        Opens the database, creating its tables unless it is read-only.
+        Return:
+            sqlite3.Connection: The connection.
+        Raises:
+            FileNotFoundError: If a read-only database doesn't exist.
+        """
+        if self.connection is None and self.read_only:
+            if not os.path.exists(self.path):
+                raise FileNotFoundError(f"Registry {self.path} not found")
+            self.connection = sqlite3.connect(
+                pathlib.Path(self.path).resolve().as_uri() + "?mode=ro",
+                uri=True,
+                timeout=60,
+                check_same_thread=False,
+            )
+        if self.connection is None:
+            self.connection = sqlite3.connect(
+                self.path, timeout=60, check_same_thread=False
+            )
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            # Rows replaced by INSERT OR REPLACE are then counted out by the delete trigger.
+            self.connection.execute("PRAGMA recursive_triggers=ON")
+            self.connection.executescript(SCHEMA)
+        return self.connection
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def reset(self):
+        """
+        Starts a new registry: removes the rows of the previous run.
+        """
+        self.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+        self.connect()
+
+    def insert(self, rows):
+        """
+        Inserts rows, replacing rows with the same id.
+        Args:
+            rows (iterable): Dicts of column -> value, with at least id and source_url.
+        """
+        connection = self.connect()
+        batch = []
+
+        def write():
+            # Rows with the same columns are written by one statement.
+            groups = {}
+            for row in batch:
+                groups.setdefault(tuple(row), []).append(
+                    list(row.values())
+                    + [host_of(row.get("final_url", ""), row["source_url"])]
+                )
+            with self.lock, connection:
+                for columns, parameters in groups.items():
+                    columns = list(columns) + ["host"]
+                    connection.executemany(
+                        f"INSERT OR REPLACE INTO registry ({', '.join(columns)}) "
+                        f"VALUES ({', '.join('?' * len(columns))})",
+                        parameters,
+                    )
+
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                write()
+                batch = []
+        if batch:
+            write()
+
+    def update_rows(self, rows):
+        """
+        Sets columns of rows by id, in transactions of at most batch_size rows.
+        Columns missing from a row keep their values.
+        Args:
+            rows (iterable): Dicts of column -> value with at least id.
+        """
+        connection = self.connect()
+        batch = []
+
+        def write():
+            groups = {}
+            for row in batch:
+                columns = [column for column in row if column != "id"]
+                groups.setdefault(tuple(columns), []).append(
+                    [row[column] for column in columns] + [row["id"]]
+                )
+            with self.lock, connection:
+                for columns, parameters in groups.items():
+                    assignments = ", ".join(f"{column} = ?" for column in columns)
+                    connection.executemany(
+                        f"UPDATE registry SET {assignments} WHERE id = ?", parameters
+                    )
+
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                write()
+                batch = []
+        if batch:
+            write()
+
+    def apply(self, key, results, unmatched, condition="1"):
+        """
+        Applies results of a stage, parsed from analytics.log, to the rows in one
+        transaction. Rows whose key column has a result and that meet the
+        condition get the columns of the result, all other rows get the
+        unmatched columns.
+        Args:
+            key (str): Column the results are keyed by, e.g. final_url.
+            results (dict): Key -> dict of column -> value.
+            unmatched (dict): Column -> value for rows without a result.
+            condition (str): SQL condition the matched rows have to meet.
+        """
+        connection = self.connect()
+        with self.lock, connection:
+            connection.execute("DROP TABLE IF EXISTS temp.matched")
+            connection.execute("CREATE TEMP TABLE matched (key TEXT PRIMARY KEY)")
+            connection.executemany(
+                "INSERT INTO temp.matched VALUES (?)", ((value,) for value in results)
+            )
+            assignments = ", ".join(f"{column} = ?" for column in unmatched)
+            connection.execute(
+                f"UPDATE registry SET {assignments} WHERE NOT "
+                f"({key} IN (SELECT key FROM temp.matched) AND {condition})",
+                list(unmatched.values()),
+            )
+            # Results setting the same columns are written by one statement.
+            groups = {}
+            for value, columns in results.items():
+                groups.setdefault(tuple(columns), []).append(
+                    list(columns.values()) + [value]
+                )
+            for columns, parameters in groups.items():
+                assignments = ", ".join(f"{column} = ?" for column in columns)
+                connection.executemany(
+                    f"UPDATE registry SET {assignments} WHERE {key} = ? AND {condition}",
+                    parameters,
+                )
+            connection.execute("DROP TABLE temp.matched")
+
+    def update(self, where, parameters, **columns):
+        """
+        Sets columns of the rows matching a condition.
+        Args:
+            where (str): SQL condition.
+            parameters (list): Parameters of the condition.
+            **columns: Column -> value.
+        """
+        connection = self.connect()
+        assignments = ", ".join(f"{column} = ?" for column in columns)
+        with self.lock, connection:
+            connection.execute(
+                f"UPDATE registry SET {assignments} WHERE {where}",
+                list(columns.values()) + list(parameters),
+            )
+
+    def select(self, sql, parameters=()):
+        """
+        Runs a query. The connection is shared with the writers, so every batch
+        of rows is fetched under the lock; rows are yielded outside of it.
+        Args:
+            sql (str): SQL query.
+            parameters (tuple): Parameters of the query.
+        Return:
+            generator of tuple: Rows of the result.
+        """
+        connection = self.connect()
+        with self.lock:
+            cursor = connection.execute(sql, parameters)
+        while True:
+            with self.lock:
+                rows = cursor.fetchmany(self.batch_size)
+            if not rows:
+                return
+            yield from rows
+
+    def rows(self, status=None, host=None, limit=None):
+        """
+        Reads registry rows in id order, optionally only of a status and a host.
+        Args:
+            status (str): Status, e.g. 'failed'.
+            host (str): Host.
+            limit (int): Maximum number of rows.
+        Return:
+            generator of list: Values of COLUMNS.
+        """
+        conditions, parameters = [], []
+        if status is not None:
+            conditions.append("status = ?")
+            parameters.append(status)
+        if host is not None:
+            conditions.append("host = ?")
+            parameters.append(host.lower())
+        sql = f"SELECT {', '.join(COLUMNS)} FROM registry"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY id"
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        for row in self.select(sql, parameters):
+            yield [str(row[0])] + list(row[1:])
+
+    def max_id(self):
+        """
+        Return:
+            int: Largest id in the registry, 0 if it is empty.
+        """
+        for (id,) in self.select("SELECT MAX(id) FROM registry"):
+            return id or 0
+        return 0
+
+    def status_counts(self):
+        """
+        Return:
+            list: (status, count) tuples, most frequent first.
+        """
+        return list(
+            self.select(
+                "SELECT status, count FROM status_counts WHERE count > 0 "
+                "ORDER BY count DESC"
+            )
+        )
+
+    def host_counts(self, status, limit=None):
+        """
+        Finds the hosts with the most rows of a status.
+        Args:
+            status (str): Status, e.g. 'failed'.
+            limit (int): Maximum number of hosts.
+        Return:
+            list: (host, count) tuples, most rows first.
+        """
+        sql = (
+            "SELECT host, count FROM host_counts WHERE status = ? AND count > 0 "
+            "ORDER BY count DESC"
+        )
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        return list(self.select(sql, (status,)))
+
+    def export_csv(self, path):
+        """
+        Writes the registry sorted by id to a CSV file. Values with commas,
+        quotes or line breaks are quoted.
+        Args:
+            path (str): Path of the CSV file.
+        """
+        # A missing read-only database fails here, before the file is created.
+        self.connect()
+        temp_path = path + ".temp"
+        with open(temp_path, "w", newline="") as file:
+            writer = csv.writer(file, lineterminator="\n")
+            writer.writerow(COLUMNS)
+            writer.writerows(self.rows())
+        os.replace(temp_path, path)
+
+    def export_parquet(self, path):
+        """
+        Writes the registry sorted by id to a Parquet file for analytics. Sizes
+        and page counts are stored as integers, the other columns as strings.
+        Args:
+            path (str): Path of the Parquet file.
+        Raises:
+            ValueError: If pyarrow is not installed.
+        """
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ValueError("Install pyarrow to export Parquet")
+        self.connect()
+
+        numeric = ("id", "file_size_bytes", "document_page_count")
+        schema = pyarrow.schema(
+            [
+                (column, pyarrow.int64() if column in numeric else pyarrow.string())
+                for column in COLUMNS
+            ]
+            + [("host", pyarrow.string()), ("status", pyarrow.string())]
+        )
+        names = schema.names
+
+        def value(column, cell):
+            if column in numeric:
+                return int(cell) if str(cell).isdigit() else None
+            return cell
+
+        temp_path = path + ".temp"
+        with pyarrow.parquet.ParquetWriter(temp_path, schema) as writer:
+            batch = []
+            for row in self.select(
+                f"SELECT {', '.join(names)} FROM registry ORDER BY id"
+            ):
+                batch.append(row)
+                if len(batch) >= self.batch_size:
+                    writer.write_batch(self.record_batch(schema, names, batch, value))
+                    batch = []
+            if batch:
+                writer.write_batch(self.record_batch(schema, names, batch, value))
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def record_batch(schema, names, rows, value):
+        import pyarrow
+
+        return pyarrow.record_batch(
+            [
+                [value(column, row[index]) for row in rows]
+                for index, column in enumerate(names)
+            ],
+            schema=schema,
+        )
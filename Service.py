@@ -0,0 +1,422 @@
+import argparse
+import itertools
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from config import *
+from Metrics import metrics
+from Reader import Reader
+from URLProcessing import URLProcessing
+from DownloadContent import DownloadContent
+from ProcessingDownloadContent import ProcessingDownloadContent
+from AdaptiveConcurrency import AdaptiveConcurrency
+from RegistryStore import COLUMNS, RegistryStore
+
+
+def now():
+    return time.strftime("%Y-%m-%d %H:%M:%S")
+
+
+class Batch:
+    """
+    One submitted list of URLs, processed in its own folder.
+    Attributes:
+        id (str): Batch id.
+        folder (str): Folder with the input, downloads, processed data and registry.
+        options (dict): Keyword arguments of Reader.iter_records for the input.
+        rows (queue.Queue): Completed registry rows, None after the last one.
+        store (RegistryStore): Registry of the batch.
+        pending (list): Completed rows not yet written to the registry.
+    """
+
+    def __init__(self, id, folder, options=None):
+        self.id = id
+        self.folder = folder
+        self.options = options or {}
+        self.rows = queue.Queue()
+        self.store = RegistryStore(self.path(REGISTRY_DB_FILE))
+        self.pending = []
+        self.lock = threading.Lock()
+        self.indexes = itertools.count()
+
+    def path(self, *parts):
+        return os.path.join(self.folder, *parts)
+
+    def stream(self):
+        """
+        Yields registry rows as they complete, until the batch is done.
+        """
+        while True:
+            row = self.rows.get()
+            if row is None:
+                return
+            yield row
+
+
+class Service:
+    """
+    Long-running mode: the pipeline stages, the HTTP session pool, the robots.txt
+    cache, the adaptive concurrency controller and the download and processing
+    pools are created once and reused by every submitted batch.
+    Every batch gets its own folder in SERVICE_FOLDER with input.csv,
+    raw_downloads/ (or raw_archive/), processed_data/ and a registry
+    (registry.db, exported to results_registry.csv when the batch is done),
+    so batches never overwrite each other. A URL goes through the same stages as
+    in Main (cleaning, content type check, download, text extraction) and its
+    registry row is reported as soon as its last stage completes.
+    Attributes:
+        folder (str): Folder with the batch folders.
+        header (dict): HTTP headers to send with requests.
+    """
+
+    def __init__(self, folder=None):
+        from HTTPTimings import timed_session
+
+        self.folder = folder or SERVICE_FOLDER
+        os.makedirs(self.folder, exist_ok=True)
+        self.header = {
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36"
+        }
+        self.session = timed_session()
+
+        self.concurrency = AdaptiveConcurrency()
+        self.urlProcessing = URLProcessing(
+            concurrency=self.concurrency, session=self.session
+        )
+        self.downloadContent = DownloadContent(
+            [], [], concurrency=self.concurrency, session=self.session
+        )
+        # Requests of all batches share one pool, the controller limits them.
+        self.download_pool = ThreadPoolExecutor(max_workers=self.concurrency.maximum)
+        self.processing_pool = ThreadPoolExecutor(max_workers=PROCESSING_WORKERS)
+        self.batch_numbers = itertools.count(1)
+        self.lock = threading.Lock()
+        self.active = 0
+
+    def submit(self, data, options=None):
+        """
+        Starts processing of a batch in the background.
+        Args:
+            data (bytes): Input file content, one URL per line or a CSV file.
+            options (dict): Keyword arguments of Reader.iter_records, e.g. the CSV column.
+        Return:
+            Batch: The started batch.
+        """
+        id = f"{time.strftime('%Y%m%d-%H%M%S')}-{next(self.batch_numbers):04d}"
+        batch = Batch(id, os.path.join(self.folder, id), options)
+        os.makedirs(batch.folder)
+        with open(batch.path("input.csv"), "wb") as file:
+            file.write(data)
+        threading.Thread(target=self.run_batch, args=(batch,), daemon=True).start()
+        metrics.inc("service_batches_total")
+        return batch
+
+    def emit(self, batch, row):
+        # Rows are written to the registry in transactions of batch_size rows.
+        with batch.lock:
+            batch.pending.append(row)
+            if len(batch.pending) >= batch.store.batch_size:
+                batch.store.insert(batch.pending)
+                batch.pending = []
+        batch.rows.put(row)
+        metrics.inc("service_rows_total")
+
+    def run_batch(self, batch):
+        """
+        Processes a batch and reports its registry rows.
+        Args:
+            batch (Batch): Batch to process.
+        """
+        with self.lock:
+            self.active += 1
+        logging.info(f"Batch {batch.id} starts work")
+        raw_folders = {
+            "pdf": batch.path("raw_downloads", "documents") + "/",
+            "html": batch.path("raw_downloads", "pages") + "/",
+        }
+        processed_folders = {
+            "pdf": batch.path("processed_data", "documents") + "/",
+            "html": batch.path("processed_data", "pages") + "/",
+        }
+        processing = ProcessingDownloadContent()
+        # Ids and URLs of the JSON Lines records are filled in as files are downloaded.
+        processing.url_ids, processing.downloaded_urls = {}, {}
+        count = 0
+        try:
+            for kind in ("pdf", "html"):
+                self.downloadContent.prepare_folder(raw_folders[kind])
+                os.makedirs(processed_folders[kind], exist_ok=True)
+                processing.open_sink(processed_folders[kind])
+
+            def clean_records():
+                nonlocal count
+                records = Reader().iter_records(
+                    batch.path("input.csv"), **batch.options
+                )
+                for id, source_url, url, status in self.urlProcessing.iter_cleaner(
+                    records
+                ):
+                    count += 1
+                    row = dict.fromkeys(COLUMNS, "-")
+                    row.update(id=str(id), source_url=source_url)
+                    if status == "clean_url":
+                        row["final_url"] = url
+                        yield row
+                    else:
+                        row["error_message"] = (
+                            "URL was deleted cause URL is duplicate"
+                            if status == "duplicate_url"
+                            else "Line was deleted cause line isn't URL"
+                        )
+                        self.emit(batch, row)
+
+            futures = []
+            for row, future in self.concurrency.map_unordered(
+                lambda row: self.fetch(batch, row, raw_folders),
+                clean_records(),
+                lambda row: urlparse(row["final_url"]).netloc,
+                "service",
+                executor=self.download_pool,
+            ):
+                try:
+                    url_type = future.result()
+                except Exception as error:
+                    row["error_message"] = str(error)
+                    url_type = None
+                if row["raw_file_path"] == "-":
+                    self.emit(batch, row)
+                    continue
+                futures.append(
+                    self.processing_pool.submit(
+                        self.process,
+                        processing,
+                        row,
+                        url_type,
+                        processed_folders,
+                        lambda row: self.emit(batch, row),
+                    )
+                )
+            wait(futures)
+
+            for kind in ("pdf", "html"):
+                processing.close_sink(processed_folders[kind])
+                archive = self.downloadContent.archives.pop(raw_folders[kind], None)
+                if archive is not None:
+                    archive.close()
+            # Rows are written as they complete, the export is sorted by id.
+            batch.store.insert(batch.pending)
+            batch.pending = []
+            batch.store.export_csv(batch.path("results_registry.csv"))
+            logging.info(f"Batch {batch.id} was processed correct: {count} URLs")
+        except Exception as error:
+            logging.warning(f"Batch {batch.id}. Error: {error}")
+            batch.rows.put({"batch": batch.id, "error": str(error)})
+        finally:
+            batch.store.close()
+            with self.lock:
+                self.active -= 1
+            batch.rows.put({"batch": batch.id, "done": True, "urls": count})
+            batch.rows.put(None)
+
+    def fetch(self, batch, row, raw_folders):
+        """
+        Checks the content type of a clean URL and downloads it.
+        Args:
+            batch (Batch): Batch of the URL.
+            row (dict): Registry row of the URL, updated in place.
+            raw_folders (dict): Download folder of every content type.
+        Return:
+            str: Content type, 'html', 'pdf' or ''.
+        """
+        url = row["final_url"]
+        _, url_type = self.urlProcessing.check_html_or_pdf(url, self.header)
+        row["content_type_detected"] = url_type or "-"
+        if not url_type:
+            row["error_message"] = "Content type wasn't determined as html or pdf"
+            return url_type
+
+        try:
+            path, size = self.downloadContent.save_to_file(
+                url,
+                raw_folders[url_type],
+                self.header,
+                next(batch.indexes),
+                "wb" if url_type == "pdf" else "w",
+            )
+        except Exception as error:
+            row["error_message"] = f"File wasn't saved {error}"
+            return url_type
+        if path is None:
+            row["error_message"] = "Non-200 status code received"
+            return url_type
+
+        row["download_timestamp"] = now()
+        row["download_status"] = "Successful download"
+        row["raw_file_path"] = path
+        row["file_size_bytes"] = str(size)
+        return url_type
+
+    def process(self, processing, row, url_type, processed_folders, emit):
+        """
+        Extracts the text of a downloaded URL and reports its registry row.
+        Args:
+            processing (ProcessingDownloadContent): Processing of the batch.
+            row (dict): Registry row of the URL.
+            url_type (str): 'html' or 'pdf'.
+            processed_folders (dict): Output folder of every content type.
+            emit (callable): Reports the completed row.
+        """
+        try:
+            self.extract(processing, row, url_type, processed_folders)
+        finally:
+            emit(row)
+
+    def extract(self, processing, row, url_type, processed_folders):
+        path = row["raw_file_path"]
+        processing.downloaded_urls[path] = row["final_url"]
+        processing.url_ids[row["final_url"]] = row["id"]
+        try:
+            if url_type == "pdf":
+                output_path, language, pages = processing.processing_one_pdf(
+                    path, processed_folders["pdf"]
+                )
+            else:
+                output_path, language, pages = processing.processing_one_html(
+                    path, processed_folders["html"]
+                )
+        except Exception as error:
+            row["error_message"] = str(error)
+            return
+        row["processing_timestamp"] = now()
+        row["processed_file_path"] = output_path
+        row["detected_language"] = str(language)
+        if pages is not None:
+            row["document_page_count"] = str(pages)
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """
+    Local API of the service:
+        POST /batches - body is an input file with one URL per line or, with
+            the column (index or name), header=1 and delimiter query parameters,
+            a CSV file; the response streams the registry rows of the batch as
+            NDJSON as they complete, followed by {"batch": ..., "done": true, "urls": N};
+        GET /health - state of the service.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def send_json(self, status, body):
+        data = (json.dumps(body) + "\n").encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def write_chunk(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path != "/health":
+            self.send_json(404, {"error": "not found"})
+            return
+        service = self.server.service
+        self.send_json(
+            200,
+            {
+                "status": "ok",
+                "active_batches": service.active,
+                "concurrency_limit": service.concurrency.global_limit,
+            },
+        )
+
+    def do_POST(self):
+        url_parsed = urlparse(self.path)
+        if url_parsed.path != "/batches":
+            self.send_json(404, {"error": "not found"})
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        if length == 0:
+            self.send_json(400, {"error": "empty batch"})
+            return
+        parameters = {
+            name: values[-1] for name, values in parse_qs(url_parsed.query).items()
+        }
+        options = Reader.options(
+            parameters.get("column"),
+            parameters.get("header") in ("1", "true"),
+            parameters.get("delimiter"),
+        )
+        batch = self.server.service.submit(self.rfile.read(length), options)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("X-Batch-Id", batch.id)
+        self.end_headers()
+        try:
+            for row in batch.stream():
+                self.write_chunk((json.dumps(row, ensure_ascii=False) + "\n").encode())
+            self.write_chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            # The batch keeps running, its rows stay in its registry.
+            logging.warning(f"Batch {batch.id}. Error: client disconnected")
+
+    def log_message(self, format, *args):
+        logging.info(f"Service request: {format % args}")
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # BaseHTTPRequestHandler expects an (address, port) client address.
+        return request, ("local", 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run the pipeline as a service accepting URL batches."
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--socket", help="listen on a Unix socket instead of TCP")
+    parser.add_argument("--folder", help="folder with the batch folders")
+    args = parser.parse_args()
+    setup_logging()
+
+    service = Service(args.folder)
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = UnixHTTPServer(args.socket, ServiceHandler)
+        address = args.socket
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), ServiceHandler)
+        address = f"http://{args.host}:{server.server_port}"
+    server.service = service
+
+    metrics.start()
+    logging.info(f"Service listens on {address}")
+    print(f"Service listens on {address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        metrics.stop()
+
+
+if __name__ == "__main__":
+    main()
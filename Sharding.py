@@ -0,0 +1,268 @@
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+
+from config import *
+from Reader import Reader
+from URLProcessing import URLProcessing
+from FormingResultsRegistry import FormingResultsRegistry
+from RegistryStore import COLUMNS, RegistryStore
+
+
+class ShardedRun:
+    """
+    Sharded crawl mode: the cleaned URL set is partitioned by host hash into
+    N shards, every shard is processed by its own Main.py process in its own
+    directory (so raw_downloads/, processed_data/, analytics.log and
+    registry never collide), and the per-shard registries are merged back into
+    one registry with the ids of the input file.
+    Shards only need a shared filesystem, so they can run on different machines.
+    Attributes:
+        folder (str): Folder with the shard directories and the manifest.
+    """
+
+    def __init__(self, folder="shards/"):
+        self.folder = folder
+
+    def shard_dir(self, index):
+        return os.path.join(self.folder, f"shard_{index:03d}")
+
+    def manifest_path(self):
+        return os.path.join(self.folder, "manifest.json")
+
+    def load_manifest(self):
+        try:
+            with open(self.manifest_path()) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            raise ValueError("Shards not found, run split first")
+
+    @staticmethod
+    def shard_of(url, shards):
+        """
+        Returns the shard of the URL: all URLs of one host go to the same shard,
+        so per-host politeness and robots.txt stay within one process.
+        Args:
+            url (str): Cleaned URL.
+            shards (int): Number of shards.
+        Return:
+            int: Shard index.
+        """
+        host = urlparse(url).netloc.lower()
+        digest = hashlib.blake2b(host.encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "big") % shards
+
+    def split(self, filename, shards, options=None):
+        """
+        Cleans the input file and writes the clean URLs of every shard to
+        <shard>/input.csv, together with <shard>/ids.csv holding the global id of
+        every line. The registry of the whole input (with duplicates and invalid
+        lines) is written to results_registry.csv and later completed by merge.
+        Args:
+            filename (str): Input file with URLs.
+            shards (int): Number of shards.
+            options (dict): Keyword arguments of Reader.iter_records, e.g. the CSV column.
+        """
+        if shards < 1:
+            raise ValueError("Number of shards must be positive")
+        os.makedirs(self.folder, exist_ok=True)
+
+        inputs, ids = [], []
+        for index in range(shards):
+            os.makedirs(self.shard_dir(index), exist_ok=True)
+            inputs.append(open(os.path.join(self.shard_dir(index), "input.csv"), "w"))
+            ids.append(open(os.path.join(self.shard_dir(index), "ids.csv"), "w"))
+
+        registry = FormingResultsRegistry()
+        registry.create_results_registry_csv()
+        counts = [0] * shards
+
+        def route(records):
+            for id, source_url, url, status in records:
+                if status == "clean_url":
+                    index = self.shard_of(url, shards)
+                    inputs[index].write(url + "\n")
+                    ids[index].write(f"{id}\n")
+                    counts[index] += 1
+                yield id, source_url, url, status
+
+        try:
+            records = Reader().iter_records(filename, **(options or {}))
+            for url in registry.add_cleaned_records(
+                route(URLProcessing().iter_cleaner(records))
+            ):
+                pass
+        finally:
+            for file in inputs + ids:
+                file.close()
+        registry.registry_sort()
+
+        with open(self.manifest_path(), "w") as file:
+            json.dump({"shards": shards, "input": filename, "urls": counts}, file)
+        logging.info(f"Input {filename} was split into {shards} shards: {counts}")
+
+    def run_shard(self, index):
+        """
+        Runs the whole pipeline for one shard in its own directory.
+        Args:
+            index (int): Shard index.
+        Raises:
+            ValueError: If the shard process fails.
+        """
+        shard_dir = self.shard_dir(index)
+        if os.path.getsize(os.path.join(shard_dir, "input.csv")) == 0:
+            logging.info(f"Shard {index} is empty")
+            return
+
+        main_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Main.py")
+        logging.info(f"Shard {index} starts work")
+        result = subprocess.run(
+            [sys.executable, main_path, "input.csv"],
+            cwd=shard_dir,
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0:
+            logging.warning(f"Shard {index}. Error: {result.stdout}{result.stderr}")
+            raise ValueError(f"Shard {index} failed: {result.stdout}{result.stderr}")
+        logging.info(f"Shard {index} was processed correct")
+
+    def run(self, indexes=None, processes=None):
+        """
+        Runs the given shards, at most `processes` of them at the same time.
+        Args:
+            indexes (list): Shard indexes to run, all shards by default.
+            processes (int): Number of concurrent shard processes, one per CPU by default.
+        """
+        manifest = self.load_manifest()
+        if indexes is None:
+            indexes = range(manifest["shards"])
+        processes = processes or os.cpu_count() or 1
+
+        with ThreadPoolExecutor(max_workers=processes) as executor:
+            futures = {
+                executor.submit(self.run_shard, index): index for index in indexes
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as error:
+                    logging.warning(f"Shard run failed with error: {error}")
+
+    def shard_rows(self, index):
+        """
+        Reads the registry of one shard, replacing local ids by global ids and
+        making file paths relative to the working directory of the merge.
+        Shard registries are read by local id and local ids grow with global ids,
+        so ids.csv is read once along with them.
+        Args:
+            index (int): Shard index.
+        Return:
+            generator of dict: Columns of the shard rows, without source_url:
+                shards get clean URLs, the source URLs are in the registry of split.
+        Raises:
+            ValueError: If the registry has rows beyond the lines of ids.csv.
+        """
+        shard_dir = self.shard_dir(index)
+        registry_path = os.path.join(shard_dir, REGISTRY_DB_FILE)
+        if not os.path.exists(registry_path):
+            logging.warning(f"Shard {index}. Error: registry not found, shard skipped")
+            return
+
+        store = RegistryStore(registry_path)
+        try:
+            with open(os.path.join(shard_dir, "ids.csv")) as ids_file:
+                line_number, global_id = 0, None
+                for row in store.rows():
+                    local_id = int(row[0])
+                    while line_number < local_id:
+                        line = next(ids_file, None)
+                        if line is None:
+                            raise ValueError(
+                                f"Shard {index}: registry row {local_id} has no "
+                                f"global id, ids.csv has {line_number} lines"
+                            )
+                        global_id = int(line)
+                        line_number += 1
+                    columns = dict(zip(COLUMNS, row))
+                    columns["id"] = global_id
+                    del columns["source_url"]
+                    for column in ("raw_file_path", "processed_file_path"):
+                        if columns[column] not in ("-", " ", ""):
+                            columns[column] = os.path.join(shard_dir, columns[column])
+                    yield columns
+        finally:
+            store.close()
+
+    def merge(self):
+        """
+        Merges the per-shard registries into the registry written by split: the
+        rows of the clean URLs get the columns of their shard rows. The registry
+        database is updated in batches, memory doesn't depend on the number of
+        rows, and results_registry.csv is exported from it sorted by id.
+        """
+        manifest = self.load_manifest()
+        registry = FormingResultsRegistry()
+        for index in range(manifest["shards"]):
+            registry.store.update_rows(self.shard_rows(index))
+        registry.registry_sort()
+        logging.info(f"Registries of {manifest['shards']} shards were merged")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Sharded crawl: split the input by host, run shards, merge registries."
+    )
+    parser.add_argument("--folder", default="shards/", help="folder with the shards")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    split_parser = subparsers.add_parser(
+        "split", help="partition the input into shards"
+    )
+    split_parser.add_argument("filename")
+    split_parser.add_argument("--shards", type=int, required=True)
+    Reader.add_arguments(split_parser)
+
+    run_parser = subparsers.add_parser("run", help="run shards")
+    run_parser.add_argument(
+        "--shard", type=int, action="append", help="shard index, all shards by default"
+    )
+    run_parser.add_argument("--processes", type=int)
+
+    subparsers.add_parser("merge", help="merge the shard registries")
+
+    all_parser = subparsers.add_parser("all", help="split, run every shard and merge")
+    all_parser.add_argument("filename")
+    all_parser.add_argument("--shards", type=int, required=True)
+    all_parser.add_argument("--processes", type=int)
+    Reader.add_arguments(all_parser)
+
+    args = parser.parse_args()
+    # Steps of a sharded run started separately share the log of split.
+    setup_logging(append=args.command in ("run", "merge"))
+    shardedRun = ShardedRun(args.folder)
+    try:
+        if args.command in ("split", "all"):
+            shardedRun.split(
+                args.filename,
+                args.shards,
+                Reader.options(args.column, args.header, args.delimiter),
+            )
+        if args.command == "run":
+            shardedRun.run(args.shard, args.processes)
+        if args.command == "all":
+            shardedRun.run(processes=args.processes)
+        if args.command in ("merge", "all"):
+            shardedRun.merge()
+    except Exception as error:
+        print(f"Error: {error}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+from html import unescape
+from html.entities import html5
+from html.parser import HTMLParser
+
+ASCII_SPACES = str.maketrans("", "", "\x20\x0a\x09\x0c\x0d")
+
+
+class StreamingHTMLExtractor(HTMLParser):
+    """
+    Event-based extraction of the visible text of an HTML page, for pages too
+    large to build a BeautifulSoup tree of.
+    The page is fed in chunks and text is written to the output as soon as it
+    is parsed, so memory doesn't depend on the size of the page. The output is
+    the same as get_text() of the tree after script and style were removed:
+    text and CDATA sections in document order, without comments, declarations,
+    and the contents of script, style and template elements. As in the tree,
+    text between two tags that consists of spaces only is replaced with one
+    newline or space, except in pre and textarea.
+    Attributes:
+        out (file): Text file-like object the text is written to.
+        links (list): href values of the links of the page, or None if links
+            aren't collected.
+        language (str): lang attribute of the html element or None.
+    """
+
+    SKIPPED_TAGS = ("script", "style", "template")
+    PRESERVED_TAGS = ("pre", "textarea")
+
+    def __init__(self, out, links=None):
+        # References are resolved by the handlers below, as the tree builder does.
+        super().__init__(convert_charrefs=False)
+        self.out = out
+        self.links = links
+        self.language = None
+        self.seen_html = False
+        self.skipped = 0
+        self.preserved = 0
+        # Text since the last tag while it has spaces only, None after other text.
+        self.spaces = []
+
+    def extract(self, chunks):
+        """
+        Parses the page.
+        Args:
+            chunks (iterable): Consecutive parts of the page as strings.
+        Return:
+            str: Language of the page from the lang attribute or None.
+        """
+        for chunk in chunks:
+            self.feed(chunk)
+        self.close()
+        self.end_text()
+        return self.language
+
+    def end_text(self):
+        if self.spaces:
+            spaces = "".join(self.spaces)
+            if not self.preserved:
+                spaces = "\n" if "\n" in spaces else " "
+            self.out.write(spaces)
+        self.spaces = []
+
+    def handle_starttag(self, tag, attrs):
+        self.end_text()
+        if tag in self.SKIPPED_TAGS:
+            self.skipped += 1
+        elif tag in self.PRESERVED_TAGS:
+            self.preserved += 1
+        elif tag == "html" and not self.seen_html:
+            # Like the tree, the last of repeated attributes wins and an
+            # attribute without a value is an empty string.
+            self.seen_html = True
+            attributes = dict(attrs)
+            if "lang" in attributes:
+                self.language = attributes["lang"] or ""
+        elif tag == "a" and self.links is not None:
+            attributes = dict(attrs)
+            if "href" in attributes:
+                self.links.append(attributes["href"] or "")
+
+    def handle_endtag(self, tag):
+        self.end_text()
+        if tag in self.SKIPPED_TAGS and self.skipped > 0:
+            self.skipped -= 1
+        elif tag in self.PRESERVED_TAGS and self.preserved > 0:
+            self.preserved -= 1
+
+    def handle_data(self, data):
+        if self.skipped:
+            return
+        if self.spaces is None:
+            self.out.write(data)
+            return
+        self.spaces.append(data)
+        if data.translate(ASCII_SPACES):
+            self.out.write("".join(self.spaces))
+            self.spaces = None
+
+    def handle_entityref(self, name):
+        # An unknown entity stays literal text, without its semicolon.
+        self.handle_data(html5.get(name + ";", "&" + name))
+
+    def handle_charref(self, name):
+        self.handle_data(unescape(f"&#{name};"))
+
+    def handle_comment(self, data):
+        self.end_text()
+
+    def handle_decl(self, decl):
+        self.end_text()
+
+    def handle_pi(self, data):
+        self.end_text()
+
+    def unknown_decl(self, data):
+        self.end_text()
+        if data.upper().startswith("CDATA["):
+            self.handle_data(data[len("CDATA[") :])
+            self.end_text()
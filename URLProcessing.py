@@ -1,9 +1,11 @@
 from urllib.parse import urlparse, urlunparse, parse_qs, urlencode
-import requests
-from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging
+import time
+import hashlib
 from config import *
 from FormingResultsRegistry import *
+from Metrics import metrics
+from AdaptiveConcurrency import AdaptiveConcurrency
 
 
 class URLProcessing:
@@ -12,14 +14,26 @@ class URLProcessing:
     Attributes:
         params_to_remove (list): List of query parameters to remove from URLs.
         It can be set, but by default it clears from utm_source, fbclid, etc.
+        checkpoint (Checkpoint): Progress of the run or None.
+        concurrency (AdaptiveConcurrency): Controller of requests in flight.
+        session (requests.Session): Session for requests or None.
 
     """
 
-    def __init__(self, params_to_remove=None):
+    def __init__(
+        self, params_to_remove=None, checkpoint=None, concurrency=None, session=None
+    ):
         """
         Initializes the URLProcessing instance.
         Args:
             params_to_remove (list): List of query parameters to remove from URLs.
+            checkpoint (Checkpoint): Progress of the run, URLs classified by a
+                previous run aren't checked again.
+            concurrency (AdaptiveConcurrency): Controller of requests in flight,
+                shared with other stages. A new one is created by default.
+            session (requests.Session): Session whose connection pool is reused
+                by requests, e.g. by the long-running service. Without it every
+                request opens a new connection.
         """
         logging.info("URLProcessing starts work")
         if params_to_remove == None:
@@ -37,6 +51,9 @@ class URLProcessing:
             self.params_to_remove = params_to_remove
 
         self.registry = FormingResultsRegistry()
+        self.checkpoint = checkpoint
+        self.concurrency = concurrency or AdaptiveConcurrency()
+        self.session = session
 
     def reassembly_url(self, url_parsed, query_params):
         """
@@ -61,6 +78,28 @@ class URLProcessing:
         logging.info(f"URL was reassembly, new URL: {new_url}")
         return new_url
 
+    def clean_url(self, url):
+        """
+        Cleans one URL by removing unwanted query parameters.
+        Args:
+            url (str): URL string to clean.
+        Return:
+            str: Cleaned URL or None if the line isn't an http(s) URL.
+        """
+        url_parsed = urlparse(url)
+        if url_parsed.scheme != "https" and url_parsed.scheme != "http":
+            return None
+
+        query_params = parse_qs(url_parsed.query)
+        query_params_temp = query_params.copy()
+        for param in self.params_to_remove:
+            query_params.pop(param, None)
+
+        if query_params_temp != query_params:
+            logging.info(f"query_params was changed for {url}")
+            url = self.reassembly_url(url_parsed, query_params)
+        return url
+
     def cleaner(self, urls):
         """
         Cleans a list of URLs by removing unwanted query parameters.
@@ -71,31 +110,41 @@ class URLProcessing:
         """
 
         cleaned_urls = []
-        for id, url in enumerate(urls, start=0):
-            url_parsed = urlparse(url)
-            if url_parsed.scheme == "https" or url_parsed.scheme == "http":
-                query_params = parse_qs(url_parsed.query)
-                query_params_temp = query_params.copy()
-                for param in self.params_to_remove:
-                    query_params.pop(param, None)
-
-                if query_params_temp != query_params:
-                    logging.info(f"query_params was changed for {url}")
-                    url = self.reassembly_url(url_parsed, query_params)
-
-                if url not in cleaned_urls:
-                    cleaned_urls.append(url)
-                    self.registry.add_processing_info_from_cleaner(id, url, "clean_url")
-                else:
-                    self.registry.add_processing_info_from_cleaner(
-                        id, url, "duplicate_url"
-                    )
-            else:
+        for id, source_url, url, status in self.iter_cleaner(enumerate(urls, start=0)):
+            if status == "clean_url":
+                cleaned_urls.append(url)
+            self.registry.add_processing_info_from_cleaner(id, url, status)
+
+        return cleaned_urls
+
+    def iter_cleaner(self, records):
+        """
+        Lazily cleans (id, url) records, e.g. from Reader.iter_records.
+        Duplicates are detected by a set of 8-byte URL digests instead of the
+        URLs. Memory still grows with the number of unique URLs, by about 70-100
+        bytes per URL (the digest object and its set slot).
+        Args:
+            records (iterable): (id, url) tuples.
+        Return:
+            generator of tuple: (id, source_url, url, status), where url is the
+            cleaned URL and status is 'clean_url', 'duplicate_url' or 'Not url'.
+        """
+        seen = set()
+        for id, url in records:
+            cleaned_url = self.clean_url(url)
+            if cleaned_url is None:
                 logging.info(f"Line {url} isn't URL")
-                self.registry.add_processing_info_from_cleaner(id, url, "Not url")
+                yield id, url, url, "Not url"
+                continue
+
+            digest = hashlib.blake2b(cleaned_url.encode(), digest_size=8).digest()
+            if digest not in seen:
+                seen.add(digest)
+                yield id, url, cleaned_url, "clean_url"
+            else:
+                yield id, url, cleaned_url, "duplicate_url"
 
         logging.info("Every URL was cleaned")
-        return cleaned_urls
 
     def check_html_or_pdf(self, url, header):
         """
@@ -108,9 +157,20 @@ class URLProcessing:
             - url (str): The URL that was checked.
             - return_url_type (str): The content type of the URL, which can be 'html', 'pdf', or an empty string if unknown.
         """
+        import requests
+
         return_url_type = ""
+        host = urlparse(url).netloc
+        started = time.perf_counter()
         try:
-            response = requests.head(url, headers=header, timeout=15)
+            client = self.session if self.session is not None else requests
+            response = client.head(url, headers=header, timeout=15)
+            self.concurrency.record(
+                response.status_code, response.elapsed.total_seconds()
+            )
+            metrics.inc(
+                "classify_responses_total", host=host, status=response.status_code
+            )
             if response.status_code == 200:
                 content_type = response.headers.get("Content-Type", "")
                 if "text/html" in content_type:
@@ -121,21 +181,29 @@ class URLProcessing:
                     logging.info(f"URL {url} is PDF")
             else:
                 logging.warning(
-                    f"URL {url}.Error: Non-200 status code {response.status_code}"
+                    f"URL {url}. Error: Non-200 status code {response.status_code}"
                 )
         except Exception as error:
             logging.warning(f"URL {url} can't be checked html or pdf. Error: {error}")
+            metrics.inc("classify_errors_total", host=host)
+            self.concurrency.record(failed=True)
             # Ignore URLs that cause exceptions
             pass
 
+        metrics.observe("classify_seconds", time.perf_counter() - started, host=host)
+        if self.checkpoint is not None:
+            self.checkpoint.record("classified", url=url, url_type=return_url_type)
+        metrics.inc("urls_total", stage="classify", result=return_url_type or "unknown")
         logging.info("URL type was been determined")
         return url, return_url_type
 
     def html_or_pdf(self, urls):
         """
         Sorts URLs into HTML and PDF categories based on their Content-Type.
+        URLs are consumed lazily, so any iterable can be passed, and checked
+        concurrently within the limits of the adaptive concurrency controller.
         Args:
-            urls (list): List of URL strings to classify.
+            urls (iterable): URL strings to classify.
         Return:
             tuple: Two lists containing URLs with HTML and PDF content types.
                 - urls_html (list of str): URLs with 'text/html' content type.
@@ -146,17 +214,27 @@ class URLProcessing:
         }
         urls_html, urls_pdf = [], []
         logging.info("Start checking pdf or html")
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            futures = {
-                executor.submit(self.check_html_or_pdf, url, header): url
-                for url in urls
-            }
-            for future in as_completed(futures):
-                url, url_type = future.result()
-                if url_type == "html":
-                    urls_html.append(url)
-                elif url_type == "pdf":
-                    urls_pdf.append(url)
+
+        def add(url, url_type):
+            if url_type == "html":
+                urls_html.append(url)
+            elif url_type == "pdf":
+                urls_pdf.append(url)
+
+        def unchecked(urls):
+            for url in urls:
+                if self.checkpoint is not None and url in self.checkpoint.classified:
+                    add(url, self.checkpoint.classified[url])
+                else:
+                    yield url
+
+        for url, future in self.concurrency.map_unordered(
+            lambda url: self.check_html_or_pdf(url, header),
+            unchecked(urls),
+            lambda url: urlparse(url).netloc,
+            "classify",
+        ):
+            add(*future.result())
 
         logging.info("URLs types were been determined")
         return urls_html, urls_pdf
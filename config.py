@@ -1,8 +1,91 @@
 import logging
+import os
 
-logging.basicConfig(
-    level=logging.INFO,
-    filename="analytics.log",
-    filemode="w",
-    format="%(asctime)s %(levelname)s %(message)s",
-)
+LOG_FILE = "analytics.log"
+
+
+def setup_logging(append=False):
+    """
+    Directs the log to LOG_FILE. Entry points call it once their arguments are
+    parsed: a new run starts a new log, while resumed runs and later stages of
+    a run split into separate commands (see Cli.py) append to it.
+    Args:
+        append (bool): Whether to append to the log instead of replacing it.
+    """
+    logging.basicConfig(
+        level=logging.INFO,
+        filename=LOG_FILE,
+        filemode="a" if append else "w",
+        format="%(asctime)s %(levelname)s %(message)s",
+        force=True,
+    )
+
+
+METRICS_FILE = "metrics.json"
+METRICS_PROMETHEUS_FILE = "metrics.prom"
+METRICS_FLUSH_INTERVAL = 10
+PROFILE_FOLDER = "profiles/"
+
+CHECKPOINT_FILE = "checkpoint.jsonl"
+CHECKPOINT_BATCH_SIZE = 100
+CHECKPOINT_FLUSH_INTERVAL = 5
+
+IMPORT_TIME_BUDGET = 0.25
+
+CONCURRENCY_INITIAL = 10
+CONCURRENCY_MAX = 64
+CONCURRENCY_MIN = 1
+HOST_CONCURRENCY_INITIAL = 4
+HOST_CONCURRENCY_MAX = 16
+CONCURRENCY_DECREASE = 0.5
+CONCURRENCY_LATENCY_SPIKE = 3.0
+PROCESSING_WORKERS = os.cpu_count() or 4
+# Main.py checks, downloads and processes the input in batches of this many
+# records, so memory doesn't depend on the size of the input.
+PIPELINE_BATCH_SIZE = 10000
+# Downloaded bodies are written to raw_downloads/ in parts of this size.
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# "files" saves every download to raw_downloads/, "archive" packs them into
+# rolling WARC-like containers in ARCHIVE_FOLDER (see PackedArchive.py).
+RAW_STORAGE = os.environ.get("WEBDATAPARSER_RAW_STORAGE", "files")
+ARCHIVE_FOLDER = "raw_archive/"
+ARCHIVE_MAX_SIZE = 1024 * 1024 * 1024
+
+# "files" writes every processed document to a .txt file, "jsonl" writes them
+# as records into rolling compressed JSON Lines shards (see ProcessedSink.py).
+PROCESSED_STORAGE = os.environ.get("WEBDATAPARSER_PROCESSED_STORAGE", "files")
+SINK_MAX_SIZE = 256 * 1024 * 1024
+SINK_BATCH_SIZE = 500
+SINK_FLUSH_INTERVAL = 2
+SINK_QUEUE_SIZE = 1000
+
+INDEX_FOLDER = "full_text_index/"
+INDEX_SEGMENT_DOCS = 10000
+# Above this many segments the smallest ones are merged (see FullTextIndex.merge).
+INDEX_MERGE_SEGMENTS = 10
+
+ROBOTS_CACHE_TTL = 3600
+SERVICE_FOLDER = "batches/"
+
+RECRAWL_HISTORY_FILE = "recrawl_history.json"
+RECRAWL_PRIOR_INTERVAL = 7 * 24 * 3600
+RECRAWL_MIN_INTERVAL = 60
+
+# Crawl mode (Main.py --crawl-depth) follows links of processed HTML pages.
+# "host" keeps links to the hosts of the input URLs, "domain" also to other
+# hosts of their domains, approximated without the public suffix list (see
+# CrawlFrontier.scope_of), "any" follows links to every host.
+FRONTIER_SCOPE = os.environ.get("WEBDATAPARSER_FRONTIER_SCOPE", "host")
+FRONTIER_EXPECTED_URLS = 10000000
+FRONTIER_FALSE_POSITIVE = 0.001
+FRONTIER_MEMORY_URLS = 100000
+FRONTIER_SPILL_FILE = "frontier_spill.txt"
+
+# HTML pages larger than this are extracted by a streaming parser
+# (see StreamingHTMLExtractor.py) instead of a BeautifulSoup tree.
+HTML_STREAMING_THRESHOLD = 8 * 1024 * 1024
+HTML_STREAMING_CHUNK = 1024 * 1024
+
+REGISTRY_DB_FILE = "registry.db"
+REGISTRY_BATCH_SIZE = 1000